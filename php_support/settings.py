@@ -71,11 +71,48 @@ WSGI_APPLICATION = 'php_support.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': env('DB_ENGINE', 'django.db.backends.sqlite3'),
+        'ENGINE': env('DB_ENGINE', 'telegram_bot.sqlite'),
         'NAME': os.path.join(BASE_DIR, env('DB_NAME', 'db.sqlite3')),
+        # Соединения переиспользуются между обновлениями и запросами, поэтому PRAGMA выполняются
+        # один раз на соединение, а не на каждое обновление
+        'CONN_MAX_AGE': env.int('DB_CONN_MAX_AGE', 600),
     }
 }
 
+# Реплика основной базы только для чтения: на нее идут списки задач и обращений в боте и списки в админке.
+# Копирование данных на реплику настраивается отдельно, Django только читает из нее
+DATABASE_REPLICA_ALIAS = env('DB_REPLICA_ALIAS', 'replica')
+if env('DB_REPLICA_NAME', None):
+    DATABASES[DATABASE_REPLICA_ALIAS] = {
+        'ENGINE': DATABASES['default']['ENGINE'],
+        'NAME': os.path.join(BASE_DIR, env('DB_REPLICA_NAME')),
+        'CONN_MAX_AGE': DATABASES['default']['CONN_MAX_AGE'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['telegram_bot.db_router.ReplicaRouter']
+
+# Сколько секунд после записи чат читает из основной базы, чтобы увидеть свои изменения при отставании реплики
+DATABASE_REPLICA_STICKY_SECONDS = env.float('DB_REPLICA_STICKY_SECONDS', 5.0)
+
+# Настройки соединений с SQLite, применяются к каждому новому соединению.
+# WAL позволяет читать во время записи, synchronous=NORMAL в режиме WAL не делает fsync на каждую транзакцию,
+# busy_timeout - сколько миллисекунд ждать освобождения блокировки вместо ошибки "database is locked"
+SQLITE_PRAGMAS = {
+    'busy_timeout': env.int('SQLITE_BUSY_TIMEOUT', 5000),
+    'journal_mode': env('SQLITE_JOURNAL_MODE', 'wal'),
+    'synchronous': env('SQLITE_SYNCHRONOUS', 'normal'),
+    'mmap_size': env.int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+    'cache_size': env.int('SQLITE_CACHE_SIZE', -64000),
+    'temp_store': env('SQLITE_TEMP_STORE', 'memory'),
+}
+
+# Режим начала транзакций для движка telegram_bot.sqlite: DEFERRED, IMMEDIATE или EXCLUSIVE
+SQLITE_TRANSACTION_MODE = env('SQLITE_TRANSACTION_MODE', 'IMMEDIATE')
+
+# Как часто бот переносит журнал WAL в базу и выполняет PRAGMA optimize, в секундах
+SQLITE_MAINTENANCE_INTERVAL = env.float('SQLITE_MAINTENANCE_INTERVAL', 600.0)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -129,4 +166,48 @@ MEDIA_URL = '/media/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-TG_BOT_TOKEN = env("TG_BOT_TOKEN")
\ No newline at end of file
+TG_BOT_TOKEN = env("TG_BOT_TOKEN")
+
+AGREEMENT_PATH = os.path.join(BASE_DIR, env('AGREEMENT_PATH', 'agreement.pdf'))
+
+TG_BOT_WORKERS = env.int("TG_BOT_WORKERS", 8)
+
+TG_OUTBOX_WORKERS = env.int("TG_OUTBOX_WORKERS", 4)
+
+TG_GLOBAL_RATE_LIMIT = env.float("TG_GLOBAL_RATE_LIMIT", 30)
+
+TG_CHAT_RATE_LIMIT = env.float("TG_CHAT_RATE_LIMIT", 1)
+
+TG_BROADCAST_CHUNK_SIZE = env.int("TG_BROADCAST_CHUNK_SIZE", 100)
+
+TG_BROADCAST_RATE = env.float("TG_BROADCAST_RATE", 20)
+
+TG_PERSISTENCE_FLUSH_INTERVAL = env.float("TG_PERSISTENCE_FLUSH_INTERVAL", 5.0)
+
+TG_WRITE_BUFFER_SIZE = env.int("TG_WRITE_BUFFER_SIZE", 0)
+
+TG_WRITE_BUFFER_INTERVAL = env.float("TG_WRITE_BUFFER_INTERVAL", 1.0)
+
+TG_TASKS_PAGE_SIZE = env.int("TG_TASKS_PAGE_SIZE", 10)
+
+TG_MESSAGES_PAGE_SIZE = env.int("TG_MESSAGES_PAGE_SIZE", 10)
+
+TG_USER_CACHE_SIZE = env.int("TG_USER_CACHE_SIZE", 10000)
+
+TG_USER_CACHE_TTL = env.float("TG_USER_CACHE_TTL", 60.0)
+
+TG_SUBSCRIPTION_CHECK_INTERVAL = env.float("TG_SUBSCRIPTION_CHECK_INTERVAL", 60.0)
+
+TG_HANDLER_BUDGET = env.float("TG_HANDLER_BUDGET", 0.5)
+
+TG_HANDLER_QUERY_BUDGET = env.int("TG_HANDLER_QUERY_BUDGET", 20)
+
+TG_METRICS_PORT = env.int("TG_METRICS_PORT", None)
+
+TG_METRICS_TOKEN = env("TG_METRICS_TOKEN", None)
+
+TG_WEBHOOK_URL = env("TG_WEBHOOK_URL", None)
+
+TG_WEBHOOK_SECRET = env("TG_WEBHOOK_SECRET", None)
+
+TG_WEBHOOK_MAX_CONNECTIONS = env.int("TG_WEBHOOK_MAX_CONNECTIONS", 40)
\ No newline at end of file
@@ -16,6 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from telegram_bot.views import metrics, telegram_webhook
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('telegram/webhook/', telegram_webhook, name='telegram_webhook'),
+    path('metrics/', metrics, name='metrics'),
 ]
@@ -1,54 +1,304 @@
-from django.contrib import admin
+import re
 
-from .models import Task, Subscription, User, Support, Message
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.forms.models import BaseInlineFormSet
+from django.db.models.functions import Substr
+from django.http import HttpResponseBadRequest
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
 
+from .db_router import read_from_replica
+from .data_operations import decode_cursor, encode_cursor, get_tasks_page
+from .models import Task, Subscription, User, Support, Message, normalize_name, normalize_phone
 
-class SubscriptionInline(admin.TabularInline):
+
+class CappedCountPaginator(Paginator):
+    """Пагинатор, который считает записи не дальше max_count.
+
+    COUNT(*) по большой таблице читает ее целиком на каждой странице списка,
+    а ограниченный подсчет стоит не больше max_count строк индекса.
+    Дальние страницы доступны через фильтры и иерархию дат.
+    """
+    max_count = 10000
+
+    @property
+    def count(self):
+        if '_count' not in self.__dict__:
+            self._count = self.object_list[:self.max_count].count()
+        return self._count
+
+
+def startswith_range(field: str, prefix: str) -> dict:
+    """Поиск по началу строки диапазоном, который база всегда читает по индексу, в отличие от LIKE"""
+    return {f'{field}__gte': prefix, f'{field}__lt': f'{prefix}\U0010ffff'}
+
+
+def follows_change(request) -> bool:
+    """Открыт ли список сразу после сохранения или удаления записи.
+
+    После изменения админка возвращает к списку с сообщением о результате, и список должен
+    читаться с основной базы, чтобы показать изменение, даже если реплика отстает.
+    """
+    return '_changelist_filters' in request.GET or len(messages.get_messages(request)) > 0
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = CappedCountPaginator
+    show_full_result_count = False
+
+    def changelist_view(self, request, extra_context=None):
+        # Просмотр списка читает с реплики, а действия и правка в списке работают с основной базой
+        if request.method != 'GET' or follows_change(request):
+            return super().changelist_view(request, extra_context)
+        with read_from_replica():
+            response = super().changelist_view(request, extra_context)
+            # Строки списка читаются при отрисовке шаблона, поэтому она тоже выполняется внутри блока
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+
+
+class CappedInlineFormSet(BaseInlineFormSet):
+    """Формсет, который выводит только первые max_shown записей в порядке inline.ordering"""
+    max_shown = 10
+
+    def get_queryset(self):
+        if not hasattr(self, '_capped_queryset'):
+            self._capped_queryset = super().get_queryset()[:self.max_shown]
+        return self._capped_queryset
+
+
+class CappedInline(admin.TabularInline):
+    """Inline с последними записями вместо всей истории, чтобы страница открывалась за ограниченное время"""
+    formset = CappedInlineFormSet
+    max_shown = 10
+    extra = 0
+    # Заголовок строки inline - __str__ записи, связи из него подгружаются сразу
+    str_related = []
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(*self.str_related)
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.max_shown = self.max_shown
+        return formset
+
+
+class HistoryInline(CappedInline):
+    """Последние записи истории пользователя только для чтения, полный список - по ссылке на форме"""
+    can_delete = False
+    show_change_link = True
+    ordering = ['-created_at']
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_readonly_fields(self, request, obj=None):
+        return self.fields
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(preview=Substr('text', 1, 60))
+
+    @admin.display(description='Задача')
+    def task_number(self, row):
+        return getattr(row, f'{self.task_field}_id') or '-'
+
+    @admin.display(description='Текст')
+    def text_preview(self, row):
+        return row.preview
+
+
+class SubscriptionInline(CappedInline):
     model = Subscription
+    extra = 1
+    ordering = ['-starts_at']
+    str_related = ['user']
 
 
-class MessageFirstInline(admin.TabularInline):
+class MessageFirstInline(HistoryInline):
     model = Message
     fk_name = "first_person"
+    verbose_name_plural = 'Последние сообщения как клиента'
+    task_field = 'task_message'
+    str_related = ['first_person', 'second_person', 'task_message__client']
+    fields = ['created_at', 'task_number', 'text_preview']
 
 
-class MessagSecondInline(admin.TabularInline):
+class MessagSecondInline(HistoryInline):
     model = Message
     fk_name = "second_person"
+    verbose_name_plural = 'Последние сообщения как исполнителя'
+    task_field = 'task_message'
+    str_related = ['first_person', 'second_person', 'task_message__client']
+    fields = ['created_at', 'task_number', 'text_preview']
 
 
-class SupportionInline(admin.TabularInline):
+class SupportionInline(HistoryInline):
     model = Support
+    verbose_name_plural = 'Последние обращения в поддержку'
+    task_field = 'task'
+    str_related = ['user', 'task__client']
+    fields = ['created_at', 'status', 'task_number', 'text_preview']
 
 
 @admin.register(User)
-class ProductAdmin(admin.ModelAdmin):
-    search_fields = [
-        'name',
-        'phonenumber',
-        'role',
-    ]
-    ordering = ['name', 'role', ]
+class ProductAdmin(LargeTableAdmin):
+    # Поиск идет по нормализованным полям, см. get_search_results
+    search_fields = ['name_search']
+    search_help_text = 'Поиск по началу имени или номера телефона'
+    list_display = ['name', 'phonenumber', 'role', 'subscription_lvl', 'subscription_end_at']
+    list_filter = ['role']
+    ordering = ['name_search']
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        if re.fullmatch(r'[\d\s()+-]+', search_term):
+            phone = normalize_phone(search_term)
+            # Российские номера вводят и с 8, и с +7, а хранятся с 7
+            if phone.startswith('8'):
+                phone = f'7{phone[1:]}'
+            return queryset.filter(**startswith_range('phone_search', phone)), False
+        return queryset.filter(**startswith_range('name_search', normalize_name(search_term))), False
 
     inlines = [SubscriptionInline, MessageFirstInline, MessagSecondInline, SupportionInline]
+    readonly_fields = ['history_links']
+
+    @admin.display(description='Вся история')
+    def history_links(self, user):
+        if user.pk is None:
+            return '-'
+        links = [
+            ('telegram_bot_message_changelist', 'first_person__id__exact', 'Сообщения как клиента'),
+            ('telegram_bot_message_changelist', 'second_person__id__exact', 'Сообщения как исполнителя'),
+            ('telegram_bot_support_changelist', 'user__id__exact', 'Обращения в поддержку'),
+        ]
+        return format_html_join(
+            ', ',
+            '<a href="{}?{}={}">{}</a>',
+            ((reverse(f'admin:{url_name}'), lookup, user.pk, title) for url_name, lookup, title in links),
+        )
 
 
 @admin.register(Task)
-class TaskAdmin(admin.ModelAdmin):
-    search_fields = [
-        'worker',
-        'client',
-        'task',
-        'status',
-    ]
-    ordering = ['status', 'task', ]
+class TaskAdmin(LargeTableAdmin):
+    # Поиск идет по полнотекстовому индексу, см. get_search_results
+    search_fields = ['task']
+    search_help_text = 'Поиск по словам из текста задачи'
+    list_display = ['id', 'task_preview', 'status', 'client', 'worker', 'created_at', 'end_at']
+    list_display_links = ['id', 'task_preview']
+    list_select_related = ['client', 'worker']
+    autocomplete_fields = ['client', 'worker']
+    list_filter = ['status']
+    date_hierarchy = 'created_at'
+    ordering = ['-created_at']
+    readonly_fields = ['messages_link']
+    messages_page_size = 50
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(preview=Substr('task', 1, 60))
+
+    @admin.display(description='Задача')
+    def task_preview(self, task):
+        return task.preview
+
+    @admin.display(description='Переписка')
+    def messages_link(self, task):
+        if task.pk is None:
+            return '-'
+        url = reverse('admin:telegram_bot_task_messages', args=[task.pk])
+        return format_html('<a href="{}">Открыть переписку по задаче</a>', url)
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return queryset.search(search_term), False
+
+    def get_urls(self):
+        return [
+            path(
+                '<int:task_id>/messages/',
+                self.admin_site.admin_view(self.messages_view),
+                name='telegram_bot_task_messages',
+            ),
+            *super().get_urls(),
+        ]
+
+    def messages_view(self, request, task_id):
+        """Переписка по задаче страницами по курсору, начиная с последних сообщений"""
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        task = get_object_or_404(Task.objects.only('id'), pk=task_id)
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            try:
+                decode_cursor(cursor)
+            except (ValueError, OverflowError, OSError):
+                return HttpResponseBadRequest('Некорректный курсор')
+        backwards = request.GET.get('direction', 'p') == 'p'
+        messages, has_previous, has_next = get_tasks_page(
+            Message.objects.filter(task_message_id=task.pk).select_related('first_person', 'second_person'),
+            cursor=cursor,
+            backwards=backwards,
+            page_size=self.messages_page_size,
+        )
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f'Переписка по задаче №{task.pk}',
+            'task': task,
+            'task_messages': messages,
+            'previous_cursor': encode_cursor(messages[0]) if has_previous else None,
+            'next_cursor': encode_cursor(messages[-1]) if has_next else None,
+        }
+        return TemplateResponse(request, 'admin/telegram_bot/task/messages.html', context)
 
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
-    pass
+class MessageAdmin(LargeTableAdmin):
+    list_display = ['id', 'task_number', 'first_person', 'second_person', 'text_preview', 'created_at']
+    list_select_related = ['first_person', 'second_person']
+    autocomplete_fields = ['first_person', 'second_person', 'task_message']
+    date_hierarchy = 'created_at'
+    ordering = ['-created_at']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(preview=Substr('text', 1, 60))
+
+    @admin.display(description='Задача', ordering='task_message')
+    def task_number(self, message):
+        return message.task_message_id
+
+    @admin.display(description='Сообщение')
+    def text_preview(self, message):
+        return message.preview
 
 
 @admin.register(Support)
-class SupportMessageAdmin(admin.ModelAdmin):
-    pass
+class SupportMessageAdmin(LargeTableAdmin):
+    list_display = ['id', 'status', 'user', 'task_number', 'text_preview', 'created_at']
+    list_select_related = ['user']
+    autocomplete_fields = ['user', 'task']
+    list_filter = ['status']
+    date_hierarchy = 'created_at'
+    ordering = ['-created_at']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(preview=Substr('text', 1, 60))
+
+    @admin.display(description='Задача', ordering='task')
+    def task_number(self, support):
+        return support.task_id
+
+    @admin.display(description='Обращение')
+    def text_preview(self, support):
+        return support.preview
@@ -0,0 +1,569 @@
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+from typing import NamedTuple
+
+from django.test.utils import override_settings
+
+from telegram_bot import metrics
+from telegram_bot.bot import build_persistence, build_updater, setup_dispatcher, stop_dispatcher
+from telegram_bot.data_operations import user_cache
+from telegram_bot.models import Task, User
+from telegram_bot.routing import TASK_ACTION, encode_callback_data
+from telegram_bot.sqlite import apply_pragmas
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = '123456:benchmark'
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class FakeBotAPI:
+    """Локальная замена Bot API: отдает обновления через getUpdates и запоминает ответы бота по чатам"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._sent = {}
+        self.calls = {}
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update: dict) -> int:
+        with self._condition:
+            update['update_id'] = next(self._update_ids)
+            self._updates.append(update)
+            self._condition.notify_all()
+            return update['update_id']
+
+    def next_message_id(self):
+        return next(self._message_ids)
+
+    def sent_to(self, chat_id) -> list:
+        with self._condition:
+            return list(self._sent.get(chat_id, ()))
+
+    def wait_for(self, chat_id, position, expect, timeout):
+        """Ждет сообщение в чат, содержащее expect, среди сообщений, начиная с position"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                sent = self._sent.get(chat_id, [])
+                for index in range(position, len(sent)):
+                    if expect in sent[index]['text']:
+                        return index, sent[index]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, None
+                self._condition.wait(remaining)
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._condition:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _record_message(self, method, params):
+        chat_id = int(params['chat_id'])
+        reply_markup = params.get('reply_markup')
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        message = {
+            'message_id': int(params.get('message_id') or self.next_message_id()),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        text = params.get('text') or params.get('caption') or ''
+        if method == 'sendDocument':
+            message['caption'] = text
+            message['document'] = {'file_id': f'document-{message["message_id"]}', 'file_unique_id': 'document'}
+        else:
+            message['text'] = text
+        with self._condition:
+            self._sent.setdefault(chat_id, []).append({
+                'method': method,
+                'text': text,
+                'message_id': message['message_id'],
+                'reply_markup': reply_markup,
+                'sent_at': time.monotonic(),
+            })
+            self._condition.notify_all()
+        return message
+
+    def handle(self, method, params):
+        with self._condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if method in ('sendMessage', 'sendDocument', 'editMessageText'):
+            return self._record_message(method, params)
+        return True
+
+    def _build_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                params = parse_params(self.headers.get('Content-Type', ''), body)
+                payload = json.dumps({'ok': True, 'result': api.handle(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def parse_params(content_type, body) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+    params = {}
+    for part in message.get_payload():
+        if part.get_filename() is None:
+            params[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode()
+    return params
+
+
+class Step(NamedTuple):
+    action: str
+    value: str
+    expect: str
+
+
+def text(value, expect):
+    return Step('text', value, expect)
+
+
+def press(label, expect):
+    return Step('press', label, expect)
+
+
+def callback(data, expect):
+    return Step('callback', data, expect)
+
+
+def task_button(task_id):
+    """Данные кнопки задачи, которой нет среди кнопок последнего сообщения, например на другой странице списка"""
+    return encode_callback_data(TASK_ACTION, task_id=task_id)
+
+
+def client_registration():
+    return [
+        text('/start', 'Для использования сервиса'),
+        press('Принимаю', 'Введите имя и фамилию'),
+        text('Иван Петров', 'Введите телефон'),
+        text('+79991234567', 'Клиент - разместить заказ'),
+    ]
+
+
+def client_order(task_text):
+    return [
+        press('Клиент', 'Куда отправимся?'),
+        press('Подписки', 'У вас нет активных подписок'),
+        press('Оформить подписку', 'Тарифы'),
+        press('Эконом - 100$', 'Стоимость подписки'),
+        press('Оплатить подписку', 'Подписка успешно оплачена'),
+        press('В меню', 'Куда отправимся?'),
+        press('Оформить заказ', 'Для того чтобы создать задачу'),
+        text(task_text, 'Задача успешно создана'),
+    ]
+
+
+def worker_login():
+    return [
+        text('/start', 'Клиент - разместить заказ'),
+        press('Исполнитель', 'Выберете меню'),
+    ]
+
+
+def worker_take(task_id):
+    """Начинается и заканчивается в меню исполнителя, поэтому исполнителя можно переиспользовать"""
+    return [
+        press('Список задач', 'Выберите задачи'),
+        callback(task_button(task_id), f'Заказ №{task_id}'),
+        press('Взять заказ', 'Введите дату окончания работы'),
+        text('01.01.30', 'Подтвердите принятие заказа'),
+        press('Подтвердить', 'Теперь вы можете связаться с заказчиком'),
+        press('К задаче', f'Заказ №{task_id}'),
+        press('Написать заказчику', 'Введите ваше сообщение'),
+        text('Уточните, пожалуйста, версию PHP', 'Доставлено'),
+        press('В меню', 'Выберете меню'),
+        press('Текущие задачи', 'Ваши задачи'),
+        callback(task_button(task_id), f'Заказ №{task_id}'),
+        press('Сдать задачу', 'Отправьте результат'),
+        text('Сайт готов', 'Ожидаем подтверждения заказчиком'),
+        press('В меню', 'Выберете меню'),
+    ]
+
+
+def client_confirm(task_id):
+    return [
+        press('В меню', 'Куда отправимся?'),
+        press('История заказов', 'Ваши заказы'),
+        callback(task_button(task_id), f'Заказ №{task_id}'),
+        press('Подтвердить выполнение', 'Вы подтверждаете выполнение'),
+        press('Подтвердить', 'Вы подтвердили выполнение'),
+    ]
+
+
+class SyntheticUser:
+    """Пользователь Telegram, который отправляет боту сообщения и нажимает кнопки в его ответах"""
+
+    def __init__(self, api: FakeBotAPI, tg_id: int, timeout: float = 30):
+        self.api = api
+        self.tg_id = tg_id
+        self.timeout = timeout
+        self.position = 0
+        self.last_reply = None
+        self.latencies = []
+
+    def run(self, steps):
+        for step in steps:
+            self.run_step(step)
+
+    def run_step(self, step: Step):
+        if step.action == 'text':
+            update = {'message': self._message(step.value)}
+        elif step.action == 'press':
+            update = {'callback_query': self._callback_query(self._button_data(step.value))}
+        else:
+            update = {'callback_query': self._callback_query(step.value)}
+
+        started_at = time.monotonic()
+        self.api.push_update(update)
+        index, reply = self.api.wait_for(self.tg_id, self.position, step.expect, self.timeout)
+        if reply is None:
+            received = [message['text'][:80] for message in self.api.sent_to(self.tg_id)[self.position:]]
+            raise BenchmarkError(f'Пользователь {self.tg_id}: на шаг {step} не пришел ответ, получено {received}')
+        self.latencies.append(reply['sent_at'] - started_at)
+        self.position = index + 1
+        self.last_reply = reply
+
+    def _button_data(self, label):
+        for message in reversed(self.api.sent_to(self.tg_id)[:self.position]):
+            keyboard = (message['reply_markup'] or {}).get('inline_keyboard')
+            if keyboard is None:
+                continue
+            for row in keyboard:
+                for button in row:
+                    if button['text'] == label:
+                        return button['callback_data']
+            break
+        raise BenchmarkError(f'Пользователь {self.tg_id}: в последнем ответе нет кнопки «{label}»')
+
+    def _user(self):
+        return {'id': self.tg_id, 'is_bot': False, 'first_name': f'User {self.tg_id}'}
+
+    def _chat(self):
+        return {'id': self.tg_id, 'type': 'private'}
+
+    def _message(self, value):
+        message = {
+            'message_id': self.api.next_message_id(),
+            'date': int(time.time()),
+            'chat': self._chat(),
+            'from': self._user(),
+            'text': value,
+        }
+        if value.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(value)}]
+        return message
+
+    def _callback_query(self, data):
+        return {
+            'id': str(self.api.next_message_id()),
+            'from': self._user(),
+            'chat_instance': str(self.tg_id),
+            'data': data,
+            'message': {
+                'message_id': self.last_reply['message_id'] if self.last_reply else 0,
+                'date': int(time.time()),
+                'chat': self._chat(),
+            },
+        }
+
+
+class BenchmarkResult(NamedTuple):
+    scenarios: int
+    updates: int
+    duration: float
+    latencies: list
+    db_queries: int
+    api_calls: dict
+
+    @property
+    def throughput(self):
+        return self.updates / self.duration if self.duration else 0.0
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100, method='inclusive')[percent - 1]
+
+
+def run_scenario(api: FakeBotAPI, number: int, worker: SyntheticUser, timeout: float) -> list:
+    """Клиент регистрируется, покупает подписку и создает задачу, исполнитель берет ее,
+    пишет заказчику и сдает работу, клиент подтверждает выполнение"""
+    client = SyntheticUser(api, 1_000_000 + number, timeout)
+    client.run(client_registration())
+    client.run(client_order(f'Задача нагрузочного теста №{number}'))
+    task_id = Task.objects.filter(client__tg_id=client.tg_id).values_list('id', flat=True).get()
+
+    worker.latencies = []
+    if worker.last_reply is None:
+        worker.run(worker_login())
+    worker.run(worker_take(task_id))
+    client.run(client_confirm(task_id))
+    return client.latencies + worker.latencies
+
+
+def run_benchmark(scenarios: int, concurrency: int, workers: int, timeout: float = 30) -> BenchmarkResult:
+    """Прогоняет scenarios сценариев через настоящий Updater, подключенный к FakeBotAPI.
+
+    Ожидает пустую базу: данные сценариев в ней остаются.
+    Каждый одновременно работающий сценарий занимает своего исполнителя, поэтому исполнителей
+    столько же, сколько параллельных сценариев.
+    """
+    concurrency = max(1, min(concurrency, scenarios))
+    api = FakeBotAPI()
+    idle_workers = Queue()
+    for number in range(concurrency):
+        user = User.objects.create(
+            tg_id=2_000_000 + number,
+            name=f'Исполнитель {number}',
+            phonenumber='+79990000000',
+            role=User.UserRole.WORKER,
+        )
+        idle_workers.put(SyntheticUser(api, user.tg_id, timeout))
+    user_cache.clear()
+    for metric in metrics.registry:
+        metric.clear()
+
+    api.start()
+    with override_settings(
+        TG_GLOBAL_RATE_LIMIT=1_000_000,
+        TG_CHAT_RATE_LIMIT=1_000_000,
+        TG_BROADCAST_RATE=1_000_000,
+        TG_HANDLER_BUDGET=float('inf'),
+        TG_HANDLER_QUERY_BUDGET=1_000_000,
+    ):
+        updater = build_updater(workers, build_persistence(), token=BOT_TOKEN, base_url=api.base_url)
+        setup_dispatcher(updater.dispatcher)
+    updater.start_polling(poll_interval=0, timeout=1)
+
+    latencies = []
+    errors = []
+    numbers = Queue()
+    for number in range(scenarios):
+        numbers.put(number)
+    lock = threading.Lock()
+
+    def drive():
+        while True:
+            try:
+                number = numbers.get_nowait()
+            except Empty:
+                return
+            worker = idle_workers.get()
+            try:
+                scenario_latencies = run_scenario(api, number, worker, timeout)
+            except Exception as error:
+                logger.exception('Сценарий %s не выполнен', number)
+                with lock:
+                    errors.append(error)
+                continue
+            finally:
+                idle_workers.put(worker)
+            with lock:
+                latencies.extend(scenario_latencies)
+
+    started_at = time.monotonic()
+    threads = [threading.Thread(target=drive, name=f'benchmark-{number}') for number in range(concurrency)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - started_at
+    finally:
+        updater.stop()
+        stop_dispatcher(updater.dispatcher)
+        api.stop()
+
+    if errors:
+        raise BenchmarkError(f'Не выполнено сценариев: {len(errors)} из {scenarios}. Первая ошибка: {errors[0]}')
+
+    return BenchmarkResult(
+        scenarios=scenarios,
+        updates=len(latencies),
+        duration=duration,
+        latencies=latencies,
+        db_queries=sum(value for _, _, value in metrics.db_queries.collect()),
+        api_calls=dict(api.calls),
+    )
+
+
+def format_result(result: BenchmarkResult) -> str:
+    api_calls = ', '.join(f'{method}={count}' for method, count in sorted(result.api_calls.items()))
+    return '\n'.join([
+        f'Сценариев: {result.scenarios}, обновлений: {result.updates}, время: {result.duration:.2f} с',
+        f'Пропускная способность: {result.throughput:.1f} обновлений/с',
+        'Задержка ответа: p50={:.1f} мс, p95={:.1f} мс, p99={:.1f} мс'.format(
+            result.percentile(50) * 1000,
+            result.percentile(95) * 1000,
+            result.percentile(99) * 1000,
+        ),
+        'Запросов к базе в обработчиках: {} ({:.1f} на обновление)'.format(
+            result.db_queries,
+            result.db_queries / result.updates if result.updates else 0,
+        ),
+        f'Запросы к Bot API: {api_calls}',
+    ])
+
+
+# Настройки SQLite по умолчанию, с которыми сравнивается SQLITE_PRAGMAS
+DEFAULT_PRAGMAS = {'busy_timeout': 5000, 'journal_mode': 'delete', 'synchronous': 'full'}
+
+
+class WriteBenchmarkResult(NamedTuple):
+    writes: int
+    errors: int
+    duration: float
+
+    @property
+    def throughput(self):
+        return self.writes / self.duration if self.duration else 0
+
+
+def run_write_benchmark(path: str, pragmas: dict, writers: int, readers: int, writes: int) -> WriteBenchmarkResult:
+    """Пишет строки в файл SQLite короткими транзакциями из writers потоков, пока readers потоков читают.
+
+    Каждая транзакция записывает одну строку, как обработчик бота, сохраняющий сообщение.
+    """
+    with sqlite3.connect(path) as connection:
+        apply_pragmas(connection, pragmas)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS message (id INTEGER PRIMARY KEY, text TEXT, created_at REAL)',
+        )
+    connection.close()
+
+    done = threading.Event()
+    lock = threading.Lock()
+    counts = {'writes': 0, 'errors': 0}
+
+    def connect():
+        # Транзакции начинаются вручную, как в Django
+        connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        apply_pragmas(connection, pragmas)
+        return connection
+
+    def write(count):
+        connection = connect()
+        written = errors = 0
+        for number in range(count):
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute(
+                    'INSERT INTO message (text, created_at) VALUES (?, ?)',
+                    (f'Сообщение {number}', time.time()),
+                )
+                connection.execute('COMMIT')
+                written += 1
+            except sqlite3.OperationalError:
+                errors += 1
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+        connection.close()
+        with lock:
+            counts['writes'] += written
+            counts['errors'] += errors
+
+    def read():
+        connection = connect()
+        while not done.is_set():
+            try:
+                connection.execute('SELECT COUNT(*), MAX(created_at) FROM message').fetchone()
+            except sqlite3.OperationalError:
+                pass
+        connection.close()
+
+    reader_threads = [threading.Thread(target=read, daemon=True) for _ in range(readers)]
+    writer_threads = [
+        threading.Thread(target=write, args=(writes // writers + (number < writes % writers),))
+        for number in range(writers)
+    ]
+    for thread in reader_threads:
+        thread.start()
+    started_at = time.perf_counter()
+    for thread in writer_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    duration = time.perf_counter() - started_at
+    done.set()
+    for thread in reader_threads:
+        thread.join()
+    return WriteBenchmarkResult(counts['writes'], counts['errors'], duration)
+
+
+def compare_write_profiles(directory: str, profiles: dict, **kwargs) -> dict:
+    """Прогоняет run_write_benchmark для каждого набора PRAGMA на отдельном файле базы"""
+    return {
+        name: run_write_benchmark(os.path.join(directory, f'{name}.sqlite3'), pragmas, **kwargs)
+        for name, pragmas in profiles.items()
+    }
+
+
+def format_write_results(results: dict) -> str:
+    return '\n'.join(
+        f'{name}: {result.writes} записей за {result.duration:.2f} с, '
+        f'{result.throughput:.0f} записей/с, ошибок блокировки: {result.errors}'
+        for name, result in results.items()
+    )
@@ -0,0 +1,1554 @@
+import atexit
+import datetime
+import logging
+import threading
+from contextlib import nullcontext
+from enum import Enum, auto
+from queue import Queue
+from textwrap import dedent
+from typing import Callable, NamedTuple
+
+import phonenumbers
+from telegram import (
+    Bot,
+    KeyboardButton,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    ReplyKeyboardMarkup,
+    Update,
+)
+from telegram.ext import (
+    CommandHandler,
+    Dispatcher,
+    MessageHandler,
+    Filters,
+    ConversationHandler,
+    CallbackContext,
+    ExtBot,
+    JobQueue,
+    TypeHandler,
+    Updater,
+)
+from django.conf import settings
+from django.db import transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from telegram_bot.models import Subscription, Task, Message, Support
+from telegram_bot.data_operations import (
+    is_new_user,
+    save_user_data,
+    validate_fullname,
+    validate_phonenumber,
+    get_user_role,
+    get_cached_user,
+    get_tasks_page,
+    get_task_messages_page,
+    can_read_task_messages,
+    search_tasks_page,
+    get_remaining_tasks,
+    take_task_quota,
+    refresh_expired_subscriptions,
+    encode_cursor,
+)
+from telegram_bot.db_router import read_from_replica, set_current_chat
+from telegram_bot.dispatcher import ChatOrderedDispatcher
+from telegram_bot.documents import send_cached_document
+from telegram_bot import metrics
+from telegram_bot.instrumentation import instrument_conversation_handler
+from telegram_bot.notifications import TaskBroadcaster, create_task_with_broadcast
+from telegram_bot.outbox import Outbox
+from telegram_bot.persistence import DjangoPersistence
+from telegram_bot.routing import TASK_ACTION, CallbackRouter, encode_callback_data, register_actions
+from telegram_bot.sqlite import run_maintenance
+from telegram_bot.write_buffer import WriteBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class States(Enum):
+    start = auto()
+    authorization = auto()
+    get_phone = auto()
+    choose_role = auto()
+    client = auto()
+    worker = auto()
+    manager = auto()
+    handle_subscriptions = auto()
+    handle_task = auto()
+    show_client_tasks = auto()
+    handle_subscribe = auto()
+    handle_payment = auto()
+    work_choose = auto()
+    show_worker_tasks = auto()
+    take_work = auto()
+    handle_message = auto()
+    handle_support_message = auto()
+    worker_confirm = auto()
+    client_confirm = auto()
+
+
+class Transitions(Enum):
+    authorization_reject = auto()
+    authorization_approve = auto()
+    client = auto()
+    worker = auto()
+    manager = auto()
+    subscriptions = ()
+    create_task = auto()
+    tasks = auto()
+    subscribe = auto()
+    worklist = auto()
+    current_tasks = auto()
+    take = auto()
+    tech = auto()
+    unaccepted = auto()
+    expired = auto()
+    message = auto()
+    support_message = auto()
+    confirm = auto()
+
+
+# Новые переходы добавляются в конец Transitions: по порядку им назначаются коды в данных кнопок
+register_actions(str(transition) for transition in Transitions)
+
+
+def button_data(action, **params) -> str:
+    """Компактные данные кнопки: переход или действие из routing.ACTION_CODES и его параметры"""
+    return encode_callback_data(str(action), **params)
+
+
+def build_conversation_handler() -> ConversationHandler:
+    return ConversationHandler(
+        name='conversation',
+        persistent=True,
+        entry_points=[
+            CommandHandler('start', start),
+        ],
+        states={
+            States.authorization:
+                [
+                    CallbackRouter({}, default=callback_approve_handler),
+                    MessageHandler(Filters.text & ~Filters.command, get_phone),
+                ],
+            States.get_phone:
+                [
+                    MessageHandler(Filters.text & ~Filters.command, handle_phone),
+                    MessageHandler(Filters.contact, handle_phone),
+                ],
+            States.choose_role:
+                [
+                    CallbackRouter({}, default=handle_role),
+                ],
+            States.client:
+                [
+                    CallbackRouter({
+                        str(Transitions.subscriptions): show_subscriptions,
+                        str(Transitions.create_task): create_task,
+                        str(Transitions.tasks): show_client_tasks,
+                    }),
+                ],
+            States.handle_subscriptions:
+                [
+                    CallbackRouter({
+                        str(Transitions.client): handle_role,
+                        str(Transitions.subscribe): subscribe,
+                    }),
+                ],
+            States.handle_subscribe:
+                [
+                    CallbackRouter({
+                        str(Transitions.client): handle_role,
+                        'tier': handle_payment,
+                    }),
+                ],
+            States.handle_payment:
+                [
+                    CallbackRouter({
+                        str(Transitions.client): handle_role,
+                        'pay': create_subscription,
+                    }),
+                ],
+            States.handle_task:
+                [
+                    MessageHandler(Filters.text & ~Filters.command, register_task),
+                    CallbackRouter({
+                        str(Transitions.subscribe): show_subscriptions,
+                        str(Transitions.client): handle_role,
+                    }),
+                ],
+            States.show_client_tasks:
+                [
+                    CallbackRouter({
+                        str(Transitions.client): handle_role,
+                        str(Transitions.message): create_message,
+                        str(Transitions.support_message): create_support_message,
+                        str(Transitions.confirm): client_confirm,
+                        'page': show_tasks_page,
+                        'history': show_task_history,
+                        TASK_ACTION: show_client_task,
+                    }),
+                ],
+            States.worker:
+                [
+                    CallbackRouter({
+                        str(Transitions.worklist): show_available_tasks,
+                        str(Transitions.current_tasks): show_worker_tasks,
+                    }),
+                ],
+            States.show_worker_tasks:
+                [
+                    CallbackRouter({
+                        str(Transitions.worker): handle_role,
+                        str(Transitions.take): get_deadline,
+                        str(Transitions.message): create_message,
+                        str(Transitions.support_message): create_support_message,
+                        str(Transitions.confirm): worker_confirm,
+                        'page': show_tasks_page,
+                        'history': show_task_history,
+                        'search': show_search_page,
+                        TASK_ACTION: show_worker_task,
+                    }),
+                    CommandHandler('search', search_tasks),
+                    MessageHandler(Filters.text & ~Filters.command, get_deadline),
+                ],
+            States.work_choose:
+                [
+                    CallbackRouter({
+                        str(Transitions.worker): handle_role,
+                        str(Transitions.take): take_work,
+                    }),
+                    MessageHandler(Filters.text & ~Filters.command, get_deadline),
+                ],
+            States.handle_message:
+                [
+                    CallbackRouter({
+                        str(Transitions.client): handle_role,
+                        str(Transitions.worker): handle_role,
+                    }),
+                    MessageHandler(Filters.text & ~Filters.command, handle_message),
+                ],
+            States.handle_support_message:
+                [
+                    CallbackRouter({
+                        str(Transitions.client): handle_role,
+                        str(Transitions.worker): handle_role,
+                    }),
+                    MessageHandler(Filters.text & ~Filters.command, handle_support_message),
+                ],
+
+            States.manager:
+                [
+                    CallbackRouter({
+                        str(Transitions.manager): handle_role,
+                        str(Transitions.tech): show_support_messages,
+                        'support_page': show_support_page,
+                        'support_done': handle_support_done,
+                        str(Transitions.unaccepted): show_unaccepted,
+                        str(Transitions.expired): show_expired,
+                        'page': show_tasks_page,
+                        'history': show_task_history,
+                        'search': show_search_page,
+                        TASK_ACTION: show_task_details,
+                    }),
+                ],
+            States.client_confirm:
+                [
+                    CallbackRouter({
+                        str(Transitions.client): handle_role,
+                        str(Transitions.confirm): client_confirm_task,
+                    }),
+                    MessageHandler(Filters.text & ~Filters.command, client_confirm_task),
+                ],
+            States.worker_confirm:
+                [
+                    CallbackRouter({
+                        str(Transitions.worker): handle_role,
+                        str(Transitions.confirm): worker_confirm_task,
+                    }),
+                    MessageHandler(Filters.text & ~Filters.command, worker_confirm_task),
+                ],
+        },
+        fallbacks=[
+            CommandHandler('cancel', cancel),
+            CommandHandler('start', cancel),
+            CommandHandler('search', search_tasks),
+        ],
+    )
+
+
+def build_persistence(shared: bool = False) -> DjangoPersistence:
+    """Хранилище состояний диалогов.
+
+    shared=True - для вебхука, где обновления одного чата могут попасть в разные процессы Django:
+    состояние перечитывается на каждое обновление и записывается сразу после него.
+    """
+    return DjangoPersistence(
+        states=States,
+        flush_interval=0 if shared else settings.TG_PERSISTENCE_FLUSH_INTERVAL,
+        shared=shared,
+    )
+
+
+def setup_dispatcher(dispatcher: Dispatcher) -> Dispatcher:
+    outbox = Outbox(
+        dispatcher.bot,
+        workers=settings.TG_OUTBOX_WORKERS,
+        global_rate=settings.TG_GLOBAL_RATE_LIMIT,
+        chat_rate=settings.TG_CHAT_RATE_LIMIT,
+    )
+    outbox.start()
+    broadcaster = TaskBroadcaster(
+        outbox,
+        chunk_size=settings.TG_BROADCAST_CHUNK_SIZE,
+        rate=settings.TG_BROADCAST_RATE,
+    )
+    broadcaster.start()
+    dispatcher.bot_data['outbox'] = outbox
+    metrics.outbox_depth.callback = lambda: {(): outbox.stats()['depth']}
+    dispatcher.bot_data['broadcaster'] = broadcaster
+    if settings.TG_WRITE_BUFFER_SIZE:
+        dispatcher.bot_data['write_buffer'] = WriteBuffer(
+            max_size=settings.TG_WRITE_BUFFER_SIZE,
+            flush_interval=settings.TG_WRITE_BUFFER_INTERVAL,
+        )
+    if dispatcher.job_queue:
+        dispatcher.job_queue.run_repeating(
+            expire_subscriptions,
+            interval=settings.TG_SUBSCRIPTION_CHECK_INTERVAL,
+            first=0,
+            name='expire_subscriptions',
+        )
+        dispatcher.job_queue.run_repeating(
+            maintain_database,
+            interval=settings.SQLITE_MAINTENANCE_INTERVAL,
+            first=settings.SQLITE_MAINTENANCE_INTERVAL,
+            name='maintain_database',
+        )
+    # Запоминает чат каждого обновления до ConversationHandler, чтобы чтения после записи шли на основную базу
+    dispatcher.add_handler(TypeHandler(Update, remember_chat), group=-1)
+    dispatcher.add_handler(instrument_conversation_handler(
+        build_conversation_handler(),
+        budget=settings.TG_HANDLER_BUDGET,
+        query_budget=settings.TG_HANDLER_QUERY_BUDGET,
+    ))
+    return dispatcher
+
+
+def expire_subscriptions(context: CallbackContext):
+    refresh_expired_subscriptions()
+
+
+def remember_chat(update: Update, context: CallbackContext):
+    set_current_chat(update.effective_chat.id if update.effective_chat else None)
+
+
+def maintain_database(context: CallbackContext):
+    run_maintenance()
+
+
+def stop_dispatcher(dispatcher: Dispatcher):
+    """Дожидается отправки накопленных сообщений, записывает отложенные строки и сохраняет состояния диалогов"""
+    dispatcher.bot_data['broadcaster'].stop()
+    get_outbox(dispatcher).stop()
+    if 'write_buffer' in dispatcher.bot_data:
+        dispatcher.bot_data['write_buffer'].stop()
+    if dispatcher.persistence:
+        dispatcher.persistence.stop()
+
+
+def get_outbox(context) -> Outbox:
+    return context.bot_data['outbox']
+
+
+def get_broadcaster(context) -> TaskBroadcaster:
+    return context.bot_data['broadcaster']
+
+
+def save_row(context, row):
+    """Сохраняет новую строку сразу или через буфер отложенной записи, если он включен"""
+    write_buffer = context.bot_data.get('write_buffer')
+    if write_buffer is None:
+        row.save(force_insert=True)
+    else:
+        write_buffer.add(row)
+
+
+def flush_rows(context):
+    """Записывает отложенные строки перед экранами, которые их читают"""
+    write_buffer = context.bot_data.get('write_buffer')
+    if write_buffer is not None:
+        write_buffer.flush()
+
+
+def remember_button_task(context: CallbackContext):
+    """Номер задачи из нажатой кнопки; запоминается для следующего текстового сообщения пользователя.
+
+    Кнопки, отправленные до того, как в них появился номер задачи, берут его из user_data.
+    """
+    task_id = context.callback_data.task_id
+    if task_id is None:
+        return context.user_data['current_task']
+    context.user_data['current_task'] = task_id
+    return task_id
+
+
+def send_message(context: CallbackContext, chat_id, text, **kwargs):
+    """Ставит сообщение в очередь исходящих, не дожидаясь отправки"""
+    get_outbox(context).send_message(chat_id, text, **kwargs)
+
+
+_webhook_dispatcher = None
+_webhook_dispatcher_lock = threading.Lock()
+
+
+def build_updater(workers: int, persistence: DjangoPersistence, token=None, base_url=None) -> Updater:
+    """Updater для long polling. При workers > 1 чаты обрабатываются параллельно"""
+    # По соединению на каждый поток пула и очереди исходящих и еще несколько
+    # для long polling, JobQueue и служебных потоков диспетчера
+    request = metrics.InstrumentedRequest(con_pool_size=max(workers, 1) + settings.TG_OUTBOX_WORKERS + 8)
+    bot_kwargs = {'base_url': base_url} if base_url else {}
+    bot = ExtBot(token or settings.TG_BOT_TOKEN, request=request, **bot_kwargs)
+    if workers <= 1:
+        return Updater(bot=bot, persistence=persistence, use_context=True)
+
+    dispatcher = ChatOrderedDispatcher(
+        bot,
+        Queue(),
+        job_queue=JobQueue(),
+        use_context=True,
+        persistence=persistence,
+        pool_size=workers,
+    )
+    dispatcher.job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def get_webhook_dispatcher() -> Dispatcher:
+    """Диспетчер для обработки обновлений, пришедших через вебхук"""
+    global _webhook_dispatcher
+    with _webhook_dispatcher_lock:
+        if _webhook_dispatcher is None:
+            bot = Bot(token=settings.TG_BOT_TOKEN, request=metrics.InstrumentedRequest(
+                con_pool_size=settings.TG_OUTBOX_WORKERS + 8,
+            ))
+            dispatcher = Dispatcher(bot, Queue(), use_context=True, persistence=build_persistence(shared=True))
+            _webhook_dispatcher = setup_dispatcher(dispatcher)
+            atexit.register(stop_dispatcher, _webhook_dispatcher)
+    return _webhook_dispatcher
+
+
+def start(update: Update, context: CallbackContext) -> int:
+    user_id = update.effective_user.id
+    if is_new_user(user_id):
+        keyboard = [
+            [InlineKeyboardButton("Принимаю", callback_data=button_data(Transitions.authorization_approve))],
+            [InlineKeyboardButton("Отказываюсь", callback_data=button_data(Transitions.authorization_reject))],
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        send_cached_document(
+            get_outbox(context),
+            user_id,
+            settings.AGREEMENT_PATH,
+            filename="Соглашение на обработку персональных данных.pdf",
+            caption="Для использования сервиса, примите соглашение об обработке персональных данных",
+            reply_markup=reply_markup,
+            parse_mode="Markdown"
+        )
+        return States.authorization
+    else:
+        keyboard = [
+            [InlineKeyboardButton("Клиент", callback_data=button_data(Transitions.client))],
+            [InlineKeyboardButton("Исполнитель", callback_data=button_data(Transitions.worker))],
+            [InlineKeyboardButton("Менеджер", callback_data=button_data(Transitions.manager))],
+        ]
+        send_message(
+            context,
+            chat_id=user_id,
+            text=f"Клиент - разместить заказ\nИсполнитель - получить заказы\nМенеджер - для управляющих",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode="Markdown"
+        )
+        return States.choose_role
+
+
+def callback_approve_handler(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    action = context.callback_data.action
+
+    if action == str(Transitions.authorization_approve):
+        send_message(
+            context,
+            chat_id=chat_id,
+            text="Введите имя и фамилию"
+        )
+        return States.authorization
+    elif action == str(Transitions.authorization_reject):
+        send_message(
+            context,
+            chat_id=chat_id,
+            text="Без соглашения на обработку мы не можем оказать вам услугу"
+        )
+        return ConversationHandler.END
+
+
+def get_phone(update: Update, context: CallbackContext) -> int:
+    user_name = update.message.text
+    context.user_data["user_id"] = update.message.from_user.id
+    context.user_data["full_name"] = user_name
+    split_name = user_name.split()
+    if not validate_fullname(split_name):
+        send_message(
+            context,
+            update.effective_chat.id,
+            "*Введите корректные имя и фамилию!*\nПример: Василий Петров",
+            parse_mode="Markdown"
+        )
+    if validate_fullname(split_name):
+        message_keyboard = [[
+            KeyboardButton(
+                "Отправить свой номер телефона", request_contact=True
+            )
+        ]]
+        markup = ReplyKeyboardMarkup(
+            message_keyboard, one_time_keyboard=True, resize_keyboard=True
+        )
+        send_message(
+            context,
+            update.effective_chat.id,
+            f"Введите телефон в формате +7... или нажав на кнопку ниже:",
+            reply_markup=markup
+        )
+        return States.get_phone
+
+
+def handle_phone(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    try:
+        phone = update.message.contact.phone_number
+    except AttributeError:
+        phone = update.message.text
+    check_number = validate_phonenumber(phone)
+    if not check_number:
+        send_message(
+            context,
+            chat_id=chat_id,
+            text="Введен невалидный номер, попробуйте снова."
+        )
+        return States.get_phone
+    context.user_data["phone_number"] = phonenumbers.parse(phone, "RU")
+    if is_new_user(context.user_data["user_id"]):
+        save_user_data(context.user_data)
+    chat_id = update.effective_chat.id
+    send_message(
+        context,
+        chat_id=chat_id,
+        text="*Вы прошли регистрацию*",
+        parse_mode="Markdown"
+    )
+    keyboard = [
+        [InlineKeyboardButton("Клиент", callback_data=button_data(Transitions.client))],
+        [InlineKeyboardButton("Исполнитель", callback_data=button_data(Transitions.worker))],
+        [InlineKeyboardButton("Менеджер", callback_data=button_data(Transitions.manager))],
+    ]
+    send_message(
+        context,
+        chat_id=chat_id,
+        text=f"Клиент - разместить заказ\nИсполнитель - получить заказы\nМенеджер - для управляющих",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    return States.choose_role
+
+
+def handle_role(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    user_role = get_user_role(chat_id)
+    query = update.callback_query
+    query.answer()
+    action = context.callback_data.action
+    if action == str(Transitions.client):
+        keyboard = [
+            [InlineKeyboardButton("Подписки", callback_data=button_data(Transitions.subscriptions))],
+            [InlineKeyboardButton("Оформить заказ", callback_data=button_data(Transitions.create_task))],
+            [InlineKeyboardButton("История заказов", callback_data=button_data(Transitions.tasks))],
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        send_message(
+            context,
+            update.effective_chat.id,
+            text="Куда отправимся?",
+            reply_markup=reply_markup,
+        )
+        return States.client
+    elif action == str(Transitions.worker):
+        if user_role == "WK":
+            keyboard = [
+                [InlineKeyboardButton("Список задач", callback_data=button_data(Transitions.worklist))],
+                [InlineKeyboardButton("Текущие задачи", callback_data=button_data(Transitions.current_tasks))],
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            send_message(
+                context,
+                update.effective_chat.id,
+                text="Выберете меню",
+                reply_markup=reply_markup,
+            )
+            return States.worker
+        else:
+            message = "К сожалению вы не исполнитель"
+    elif action == str(Transitions.manager):
+        if user_role == "MNG":
+            keyboard = [
+                [InlineKeyboardButton("Обращения в техподдержку", callback_data=button_data(Transitions.tech))],
+                [InlineKeyboardButton("Непринятые заказы", callback_data=button_data(Transitions.unaccepted))],
+                [InlineKeyboardButton("Заказы с истекшим сроком", callback_data=button_data(Transitions.expired))],
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            send_message(
+                context,
+                update.effective_chat.id,
+                text="Выберете меню",
+                reply_markup=reply_markup,
+            )
+            return States.manager
+        else:
+            message = "К сожалению, вы не менеджер"
+    keyboard = [
+        [InlineKeyboardButton("Клиент", callback_data=button_data(Transitions.client))],
+        [InlineKeyboardButton("Исполнитель", callback_data=button_data(Transitions.worker))],
+        [InlineKeyboardButton("Менеджер", callback_data=button_data(Transitions.manager))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.choose_role
+
+
+def show_subscriptions(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    user = get_cached_user(chat_id)
+    if user.has_active_subscription:
+        level = Subscription.SubscriptionLevel(user.subscription_lvl).label
+        end_at = timezone.localtime(user.subscription_end_at)
+        message = f'Подписка «{level}», истекает {end_at:%d.%m.%Y %H:%M}'
+    else:
+        message = 'У вас нет активных подписок'
+    keyboard = [
+        [InlineKeyboardButton("Оформить подписку", callback_data=button_data(Transitions.subscribe))],
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.handle_subscriptions
+
+
+def handle_payment(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    tier = context.callback_data.tier
+    message = f'Стоимость подписки {SUBSCRIPTION_PRICES[tier]}$'
+    keyboard = [
+        [InlineKeyboardButton("Оплатить подписку", callback_data=button_data('pay', tier=tier))],
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.handle_payment
+
+
+def create_subscription(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    user = get_cached_user(chat_id)
+    starts_at = timezone.now()
+    end_at = starts_at + timezone.timedelta(days=30)
+    subscription_level = context.callback_data.tier
+    Subscription.objects.create(user_id=user.id, lvl=subscription_level, starts_at=starts_at, end_at=end_at)
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text='Подписка успешно оплачена',
+        reply_markup=reply_markup,
+    )
+    return States.handle_subscriptions
+
+
+def create_task(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    user = get_cached_user(chat_id)
+    remaining_tasks = get_remaining_tasks(user)
+    if remaining_tasks:
+        message = dedent(f'''
+            Для того чтобы создать задачу, отправьте задание в текстовом формате
+            Не указывайте в задаче паролей/логинов или других чувствительных данных
+            Осталось заявок по вашей подписке: {remaining_tasks}
+        ''')
+    elif user.has_active_subscription:
+        message = 'Вы исчерпали лимит заявок по вашей подписке'
+        keyboard.append([InlineKeyboardButton("К подпискам", callback_data=button_data(Transitions.subscribe))])
+    else:
+        message = 'У вас нет активных подписок'
+        keyboard.append([InlineKeyboardButton("К подпискам", callback_data=button_data(Transitions.subscribe))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.handle_task
+
+
+def register_task(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    text = update.effective_message.text
+
+    user = get_cached_user(chat_id)
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    with transaction.atomic():
+        task = take_task_quota(user) and create_task_with_broadcast(
+            client_id=user.id,
+            task=text,
+            created_at=timezone.now(),
+        )
+    if task:
+        get_broadcaster(context).notify(task)
+        message = f'Задача успешно создана\n\nТекст:\n{text}\n\nМы оповестим Вас как только найдем исполнителя '
+    else:
+        message = 'Не удалось создать задачу: по вашей подписке не осталось заявок'
+        keyboard.append([InlineKeyboardButton("К подпискам", callback_data=button_data(Transitions.subscribe))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        chat_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.handle_task
+
+
+def show_client_tasks(update: Update, context: CallbackContext) -> int:
+    return send_task_list(update, context, 'client')
+
+
+SUBSCRIPTION_PRICES = {
+    Subscription.SubscriptionLevel.ECONOMY: 100,
+    Subscription.SubscriptionLevel.DEFAULT: 200,
+    Subscription.SubscriptionLevel.VIP: 300,
+}
+
+
+def subscribe(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    message = dedent('''
+        Тарифы:
+        Эконом - до 5 заявок в месяц на помощь, по заявке ответят в течение суток
+        Стандарт - до 15 заявок в месяц, возможность закрепить подрядчика за собой, заявка будет рассмотрена в течение часа
+        VIP - до 60 заявок в месяц, возможность увидеть контакты подрядчика, заявка будет рассмотрена в течение часа 
+    ''')
+    levels = Subscription.SubscriptionLevel
+    keyboard = [
+        [InlineKeyboardButton("Эконом - 100$", callback_data=button_data('tier', tier=levels.ECONOMY))],
+        [InlineKeyboardButton("Стандарт - 200$", callback_data=button_data('tier', tier=levels.DEFAULT))],
+        [InlineKeyboardButton("♂dungeon master♂ - 300$", callback_data=button_data('tier', tier=levels.VIP))],
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.handle_subscribe
+
+
+def show_client_task(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    task_id = context.callback_data.task_id
+    context.user_data['current_task'] = task_id
+    task = Task.objects.get(id=task_id)
+    worker = task.worker
+    message = f'Заказ №{task.id}\n\n{task.task}'
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+        [InlineKeyboardButton("Написать в поддержку", callback_data=button_data(Transitions.support_message, task_id=task.id))],
+    ]
+    if worker:
+        message += f"Над вашим заказом работает {worker.name} Вы в любой момент можете связаться с ним"
+        keyboard.append([InlineKeyboardButton("Написать исполнителю", callback_data=button_data(Transitions.message, task_id=task.id))],)
+        keyboard.append([InlineKeyboardButton("История переписки", callback_data=button_data('history', task_id=task.id))])
+    if task.status == 'WAIT_CONFIRM':
+        keyboard.append([InlineKeyboardButton("Подтвердить выполнение", callback_data=button_data(Transitions.confirm, task_id=task.id))], )
+    if task.status == 'DONE':
+        message += '\n\nВы подтвердили выполнение'
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.show_client_tasks
+
+
+def create_message(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    remember_button_task(context)
+    message = 'Введите ваше сообщение текстом:'
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+    )
+    return States.handle_message
+
+
+def handle_message(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    user_message = update.message.text
+    context.user_data['message'] = user_message
+    message = f'Ваше сообщение:\n {user_message}\nДоставлено'
+    user = get_cached_user(chat_id)
+    task = Task.objects.get(id=context.user_data['current_task'])
+    if user.role == 'CL':
+        recipient_id = task.client.tg_id
+        save_row(context, Message(
+            task_message=task,
+            first_person_id=user.id,
+            text=user_message,
+            created_at=timezone.now(),
+        ))
+        send_message(
+            context,
+            recipient_id,
+            text=f'Сообщение от Исполниеля по вашему заказу №{task.id}:\n {user_message}',
+        )
+        keyboard = [
+            [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+        ]
+    elif user.role == 'WK':
+        recipient_id = task.worker.tg_id
+        save_row(context, Message(
+            task_message=task,
+            second_person_id=user.id,
+            text=user_message,
+            created_at=timezone.now(),
+        ))
+        send_message(
+            context,
+            recipient_id,
+            text=f'Сообщение от Заказчика по вашему заказу №{task.id}:\n {user_message}',
+        )
+        keyboard = [
+            [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+        ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        chat_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.handle_message
+
+
+def create_support_message(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    remember_button_task(context)
+    message = 'Введите причину вашего обращения в поддержку и ваше сообщение текстом:'
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+    )
+    return States.handle_support_message
+
+
+def handle_support_message(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    user_message = update.message.text
+    context.user_data['message'] = user_message
+    message = f'Ваше сообщение:\n {user_message}\nДоставлено в поддержку.'
+    user = get_cached_user(chat_id)
+    task = Task.objects.get(id=context.user_data['current_task'])
+    save_row(context, Support(user_id=user.id, task=task, created_at=timezone.now(), text=user_message))
+    if user.role == 'CL':
+        keyboard = [
+            [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+        ]
+    elif user.role == 'WK':
+        keyboard = [
+            [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+        ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        chat_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.handle_support_message
+
+
+def show_available_tasks(update: Update, context: CallbackContext) -> int:
+    """Показывает доступные задачи"""
+    return send_task_list(update, context, 'available')
+
+
+def show_worker_tasks(update: Update, context: CallbackContext) -> int:
+    """Показывает задачи, которые исполнитель уже принял"""
+    return send_task_list(update, context, 'worker')
+
+
+def show_worker_task(update: Update, context: CallbackContext) -> int:
+    """Показывает задачу по id, если задача взята, дает связаться с заказчиком, иначе дает принять задачу"""
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    task_id = context.callback_data.task_id
+    task = Task.objects.get(id=task_id)
+    context.user_data['current_task'] = task_id
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+    ]
+    try:
+        worker_id = task.worker.tg_id
+    except AttributeError:
+        worker_id = None
+    if worker_id == chat_id:
+
+        context.user_data['current_task'] = task_id
+        message = f'Заказ №{task.id}\n\n{task.task}\n'
+        keyboard.append([InlineKeyboardButton("Написать заказчику", callback_data=button_data(Transitions.message, task_id=task.id))],)
+        keyboard.append([InlineKeyboardButton("История переписки", callback_data=button_data('history', task_id=task.id))])
+        keyboard.append([InlineKeyboardButton("Написать в поддержку", callback_data=button_data(Transitions.support_message, task_id=task.id))],)
+        if task.status == 'WAIT_CONFIRM':
+            message += '\nОжидает принятия заказчиком'
+        else:
+            keyboard.append([InlineKeyboardButton("Сдать задачу", callback_data=button_data(Transitions.confirm, task_id=task.id))], )
+        if task.status == 'DONE':
+            message += '\nЗаказчик подтвердил выполнение'
+    else:
+        context.user_data['current_task'] = task_id
+        message = f'Заказ №{task.id}\n\n{task.task}\n'
+        message += 'За выполнение заказа вы получите 0$'
+        keyboard.append([InlineKeyboardButton("Взять заказ", callback_data=button_data(Transitions.take, task_id=task.id))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.show_worker_tasks
+
+
+def client_confirm(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    task_id = remember_button_task(context)
+    message = f'Вы подтверждаете выполнение задачи №{task_id}'
+    keyboard = [
+        [InlineKeyboardButton("Подтвердить", callback_data=button_data(Transitions.confirm, task_id=task_id))],
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.client_confirm
+
+
+def client_confirm_task(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    task_id = remember_button_task(context)
+    client = get_cached_user(update.effective_chat.id)
+    Task.objects.filter(id=task_id, client_id=client.id).update(status=Task.Proc.DONE)
+    message = f'Вы подтвердили выполнение задачи №{task_id}'
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.client))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.client_confirm
+
+
+def worker_confirm(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    task_id = remember_button_task(context)
+    message = f'Отправьте результат выполнения задачи №{task_id} текстом'
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.worker_confirm
+
+
+def worker_confirm_task(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    try:
+        text = update.message.text
+    except AttributeError:
+        text = None
+    if text:
+        task = Task.objects.get(id=context.user_data['current_task'])
+        task.task += f'\nЗадача выполнена:\n{text}'
+        task.status = 'WAIT_CONFIRM'
+        task.save()
+        message = f'Вы подтвердили выполнение задачи №{task.id}\n Ожидаем подтверждения заказчиком'
+
+    else:
+        message = "Попробуйте снова"
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        chat_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.worker_confirm
+
+
+def get_deadline(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    try:
+        raw_date = update.message.text
+    except AttributeError:
+        raw_date = None
+    if raw_date:
+        try:
+            date = datetime.datetime.strptime(raw_date, "%d.%m.%y")
+            context.user_data["end_date"] = date
+            message = dedent(
+                f'''
+                Необходимо выполнить этот заказ до {raw_date},
+                Подтвердите принятие заказа
+                '''
+            )
+            keyboard = [
+                [InlineKeyboardButton(
+                    "Подтвердить",
+                    callback_data=button_data(Transitions.take, task_id=context.user_data['current_task']),
+                )],
+                [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            send_message(
+                context,
+                chat_id,
+                text=message,
+                reply_markup=reply_markup,
+            )
+            return States.work_choose
+        except:
+            message = "Неверная дата.\n Введите дату в формате дд.мм.гг"
+    else:
+        message = "Введите дату окончания работы в формате дд.мм.гг"
+    send_message(
+        context,
+        chat_id,
+        text=message,
+    )
+    return States.show_worker_tasks
+
+
+def take_work(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    task_id = remember_button_task(context)
+    query = update.callback_query
+    query.answer()
+
+    user = get_cached_user(chat_id)
+    # Условие на статус не дает двум исполнителям взять одну задачу
+    taken = Task.objects.filter(id=task_id, status=Task.Proc.WAITING).update(
+        worker_id=user.id,
+        status=Task.Proc.IN_WORK,
+        end_at=context.user_data["end_date"],
+    )
+    if not taken:
+        send_message(
+            context,
+            chat_id,
+            text="Этот заказ уже взял другой исполнитель",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+            ]),
+        )
+        return States.show_worker_tasks
+    keyboard = [
+        [InlineKeyboardButton("К задаче", callback_data=button_data(TASK_ACTION, task_id=task_id))],
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text="Теперь вы можете связаться с заказчиком и задать ему уточняющие вопросы",
+        reply_markup=reply_markup,
+    )
+    return States.show_worker_tasks
+
+
+def show_unaccepted(update: Update, context: CallbackContext) -> int:
+    return send_task_list(update, context, 'unaccepted')
+
+
+def show_task_details(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    task_id = context.callback_data.task_id
+    task = Task.objects.get(id=task_id)
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.worker))],
+    ]
+    context.user_data['current_task'] = task_id
+    message = dedent(f'''Заказ №{task.id}\n\n{task.task}
+        Заказчик: {task.client.name}
+        id_заказчика: {task.client.tg_id}
+        Создана: {task.created_at}
+    ''')
+    if task.worker:
+        message += f'Исполнитель: {task.worker}\nid_исполнителя: {task.worker.tg_id}\nдолжен завершить: {task.end_at}'
+        keyboard.append([InlineKeyboardButton("История переписки", callback_data=button_data('history', task_id=task.id))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.show_worker_tasks
+
+
+HISTORY_MENUS = {
+    'CL': (Transitions.client, States.show_client_tasks),
+    'WK': (Transitions.worker, States.show_worker_tasks),
+    'MNG': (Transitions.manager, States.manager),
+}
+
+
+def render_task_history(task_id, role, cursor=None, backwards=True):
+    """Переписка по задаче: сначала последние сообщения, более ранние - по кнопке"""
+    messages, has_previous, has_next = get_task_messages_page(task_id, cursor=cursor, backwards=backwards)
+    keyboard = [
+        [InlineKeyboardButton("К заказу", callback_data=button_data(TASK_ACTION, task_id=task_id))],
+        [InlineKeyboardButton("В меню", callback_data=button_data(HISTORY_MENUS[role][0]))],
+    ]
+    if not messages:
+        return f'По заказу №{task_id} еще нет сообщений', InlineKeyboardMarkup(keyboard)
+
+    lines = [f'Переписка по заказу №{task_id}:']
+    for task_message in messages:
+        author = 'Заказчик' if task_message.first_person_id else 'Исполнитель'
+        created_at = timezone.localtime(task_message.created_at)
+        lines.append(f'{author}, {created_at:%d.%m.%Y %H:%M}:\n{task_message.text[:300]}')
+    navigation = []
+    if has_previous:
+        navigation.append(InlineKeyboardButton(
+            "◀ Раньше",
+            callback_data=button_data('history', task_id=task_id, cursor=encode_cursor(messages[0]), backwards=True),
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "Позже ▶",
+            callback_data=button_data('history', task_id=task_id, cursor=encode_cursor(messages[-1])),
+        ))
+    if navigation:
+        keyboard.append(navigation)
+    return '\n\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def show_task_history(update: Update, context: CallbackContext) -> int:
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    task_id = context.callback_data.task_id
+    user = get_cached_user(chat_id)
+    if user.role not in HISTORY_MENUS or not can_read_task_messages(user, task_id):
+        send_message(context, chat_id, text='Переписка по этому заказу вам недоступна')
+        return None
+    flush_rows(context)
+
+    if context.callback_data.cursor is None:
+        message, reply_markup = render_task_history(task_id, user.role)
+        send_message(
+            context,
+            chat_id,
+            text=message,
+            reply_markup=reply_markup,
+        )
+    else:
+        message, reply_markup = render_task_history(
+            task_id,
+            user.role,
+            cursor=context.callback_data.cursor,
+            backwards=context.callback_data.backwards,
+        )
+        get_outbox(context).enqueue(
+            chat_id,
+            'edit_message_text',
+            message_id=query.message.message_id,
+            text=message,
+            reply_markup=reply_markup,
+        )
+    return HISTORY_MENUS[user.role][1]
+
+
+SEARCH_MENUS = {
+    'WK': (Transitions.worker, States.show_worker_tasks),
+    'MNG': (Transitions.manager, States.manager),
+}
+
+
+def render_search_results(user, text, page=0):
+    """Страница результатов поиска задач, от самых подходящих"""
+    tasks, has_previous, has_next = search_tasks_page(user, text, page)
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(SEARCH_MENUS[user.role][0]))],
+    ]
+    if not tasks:
+        return f'По запросу «{text}» ничего не найдено', InlineKeyboardMarkup(keyboard)
+
+    lines = [f'Заказы по запросу «{text}»:']
+    for task in tasks:
+        lines.append(f'Заказ №{task.id}, {task.preview}')
+        keyboard.append([InlineKeyboardButton(f"К заказу {task.id}", callback_data=button_data(TASK_ACTION, task_id=task.id))])
+    navigation = []
+    if has_previous:
+        navigation.append(InlineKeyboardButton("◀ Назад", callback_data=button_data('search', page=page - 1)))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Дальше ▶", callback_data=button_data('search', page=page + 1)))
+    if navigation:
+        keyboard.append(navigation)
+    return '\n\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def search_tasks(update: Update, context: CallbackContext) -> int:
+    """Команда /search <слова>: поиск заказов для исполнителей и менеджеров"""
+    chat_id = update.effective_chat.id
+    if is_new_user(chat_id) or get_cached_user(chat_id).role not in SEARCH_MENUS:
+        send_message(context, chat_id, text='Поиск заказов доступен исполнителям и менеджерам')
+        return None
+    text = ' '.join(context.args)
+    if not text:
+        send_message(context, chat_id, text='Напишите, что искать, например: /search верстка лендинга')
+        return None
+
+    user = get_cached_user(chat_id)
+    context.user_data['search_query'] = text
+    message, reply_markup = render_search_results(user, text)
+    send_message(
+        context,
+        chat_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return SEARCH_MENUS[user.role][1]
+
+
+def show_search_page(update: Update, context: CallbackContext) -> int:
+    """Листает результаты поиска, редактируя уже отправленное сообщение"""
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    user = get_cached_user(chat_id)
+    text = context.user_data.get('search_query')
+    if user.role not in SEARCH_MENUS or not text:
+        return None
+    message, reply_markup = render_search_results(user, text, page=context.callback_data.page)
+    get_outbox(context).enqueue(
+        chat_id,
+        'edit_message_text',
+        message_id=query.message.message_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return SEARCH_MENUS[user.role][1]
+
+
+def render_support_inbox(cursor=None, backwards=False):
+    """Страница необработанных обращений: один запрос независимо от размера истории"""
+    messages, has_previous, has_next = get_tasks_page(
+        Support.objects.inbox(length=100),
+        cursor=cursor,
+        backwards=backwards,
+    )
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(Transitions.manager))],
+    ]
+    if not messages:
+        return 'Новых обращений в поддержку нет', InlineKeyboardMarkup(keyboard)
+
+    lines = ['Обращения в поддержку:']
+    for support_message in messages:
+        author = support_message.user.name if support_message.user else 'пользователь удален'
+        task = f'заказ №{support_message.task_id}' if support_message.task_id else 'без заказа'
+        lines.append(f'Обращение №{support_message.id} ({author}, {task}):\n{support_message.preview}')
+        keyboard.append([InlineKeyboardButton(
+            f"Обработано №{support_message.id}",
+            callback_data=button_data('support_done', support_id=support_message.id),
+        )])
+    navigation = []
+    if has_previous:
+        navigation.append(InlineKeyboardButton(
+            "◀ Назад",
+            callback_data=button_data('support_page', cursor=encode_cursor(messages[0]), backwards=True),
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "Дальше ▶",
+            callback_data=button_data('support_page', cursor=encode_cursor(messages[-1])),
+        ))
+    if navigation:
+        keyboard.append(navigation)
+    return '\n\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def show_support_messages(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    flush_rows(context)
+    with read_from_replica(update.effective_chat.id):
+        message, reply_markup = render_support_inbox()
+    send_message(
+        context,
+        update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return States.manager
+
+
+def edit_support_inbox(update: Update, context: CallbackContext, cursor=None, backwards=False):
+    with read_from_replica(update.effective_chat.id):
+        message, reply_markup = render_support_inbox(cursor=cursor, backwards=backwards)
+    get_outbox(context).enqueue(
+        update.effective_chat.id,
+        'edit_message_text',
+        message_id=update.callback_query.message.message_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+
+
+def show_support_page(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    edit_support_inbox(
+        update,
+        context,
+        cursor=context.callback_data.cursor,
+        backwards=context.callback_data.backwards,
+    )
+    return States.manager
+
+
+def handle_support_done(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    support_id = context.callback_data.support_id
+    Support.objects.filter(id=support_id, status=Support.Status.NEW).update(status=Support.Status.HANDLED)
+    query.answer(f'Обращение №{support_id} обработано')
+    edit_support_inbox(update, context)
+    return States.manager
+
+
+def show_expired(update: Update, context: CallbackContext) -> int:
+    return send_task_list(update, context, 'expired')
+
+
+class TaskList(NamedTuple):
+    title: str
+    empty: str
+    menu: Transitions
+    state: States
+    get_tasks: Callable[[int], QuerySet]
+    # Читать список с реплики: экран только показывает данные и может немного отставать
+    replica: bool = False
+    # Поле даты, по которому список листается, и направление: для каждого нужен индекс (поле, id)
+    order_by: str = 'created_at'
+    descending: bool = False
+
+
+TASK_LISTS = {
+    'client': TaskList(
+        title='Ваши заказы:',
+        empty='Ваши заказы:\nВы еще не создавали заказов',
+        menu=Transitions.client,
+        state=States.show_client_tasks,
+        get_tasks=lambda chat_id: Task.objects.previews().filter(client_id=get_cached_user(chat_id).id),
+    ),
+    'available': TaskList(
+        title='Выберите задачи:',
+        empty='Нам очень жаль, но на данный момент задачи отсутствуют',
+        menu=Transitions.worker,
+        state=States.show_worker_tasks,
+        get_tasks=lambda chat_id: Task.objects.previews().filter(status=Task.Proc.WAITING),
+        replica=True,
+    ),
+    'worker': TaskList(
+        title='Ваши задачи:',
+        empty='Нам очень жаль, но на данный момент задачи отсутствуют',
+        menu=Transitions.worker,
+        state=States.show_worker_tasks,
+        get_tasks=lambda chat_id: Task.objects.previews().filter(worker_id=get_cached_user(chat_id).id),
+    ),
+    'unaccepted': TaskList(
+        title='Непринятые задачи найдены',
+        empty='Непринятых задач нет',
+        menu=Transitions.manager,
+        state=States.manager,
+        get_tasks=lambda chat_id: Task.objects.previews().filter(status=Task.Proc.WAITING),
+        replica=True,
+    ),
+    'expired': TaskList(
+        title='Задачи с истекшим дедлайном:',
+        empty='Задач с истекшим дедлайном нет',
+        menu=Transitions.manager,
+        state=States.manager,
+        get_tasks=lambda chat_id: Task.objects.previews().filter(end_at__lte=timezone.now()),
+        replica=True,
+        order_by='end_at',
+        descending=True,
+    ),
+}
+
+
+def render_task_list(list_name, chat_id, cursor=None, backwards=False):
+    task_list = TASK_LISTS[list_name]
+    with read_from_replica(chat_id) if task_list.replica else nullcontext():
+        tasks, has_previous, has_next = get_tasks_page(
+            task_list.get_tasks(chat_id),
+            cursor=cursor,
+            backwards=backwards,
+            field=task_list.order_by,
+            descending=task_list.descending,
+        )
+    keyboard = [
+        [InlineKeyboardButton("В меню", callback_data=button_data(task_list.menu))],
+    ]
+    if not tasks:
+        return task_list.empty, InlineKeyboardMarkup(keyboard)
+
+    lines = [task_list.title]
+    for task in tasks:
+        lines.append(f'Заказ №{task.id}, {task.preview}')
+        keyboard.append([InlineKeyboardButton(f"К заказу {task.id}", callback_data=button_data(TASK_ACTION, task_id=task.id))])
+    navigation = []
+    if has_previous:
+        navigation.append(InlineKeyboardButton(
+            "◀ Назад",
+            callback_data=button_data(
+                'page', list_name=list_name, cursor=encode_cursor(tasks[0], task_list.order_by), backwards=True,
+            ),
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "Дальше ▶",
+            callback_data=button_data('page', list_name=list_name, cursor=encode_cursor(tasks[-1], task_list.order_by)),
+        ))
+    if navigation:
+        keyboard.append(navigation)
+    return '\n\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def send_task_list(update: Update, context: CallbackContext, list_name) -> int:
+    chat_id = update.effective_chat.id
+    if update.callback_query:
+        update.callback_query.answer()
+    message, reply_markup = render_task_list(list_name, chat_id)
+    send_message(
+        context,
+        chat_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return TASK_LISTS[list_name].state
+
+
+def show_tasks_page(update: Update, context: CallbackContext) -> int:
+    """Листает список задач, редактируя уже отправленное сообщение"""
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    query.answer()
+    list_name = context.callback_data.list_name
+    message, reply_markup = render_task_list(
+        list_name,
+        chat_id,
+        cursor=context.callback_data.cursor,
+        backwards=context.callback_data.backwards,
+    )
+    get_outbox(context).enqueue(
+        chat_id,
+        'edit_message_text',
+        message_id=query.message.message_id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+    return TASK_LISTS[list_name].state
+
+
+def cancel(update: Update, context: CallbackContext) -> int:
+    send_message(
+        context,
+        update.effective_chat.id,
+        'Надеюсь тебе понравился наш бот!'
+    )
+
+    return ConversationHandler.END
@@ -0,0 +1,74 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from telegram_bot.models import has_active_subscription
+
+
+class CachedUser(NamedTuple):
+    id: int
+    tg_id: int
+    role: str
+    name: str
+    subscription_lvl: str
+    subscription_starts_at: Optional[datetime.datetime]
+    subscription_end_at: Optional[datetime.datetime]
+
+    @property
+    def has_active_subscription(self):
+        return has_active_subscription(self.subscription_lvl, self.subscription_end_at)
+
+
+class UserCache:
+    """LRU-кеш пользователей по Telegram ID с ограниченным временем жизни записи.
+
+    Записи сбрасываются сигналами post_save/post_delete модели User,
+    поэтому TTL лишь ограничивает устаревание данных, измененных в другом процессе.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._tg_ids_by_pk = {}
+        self._lock = threading.Lock()
+
+    def get(self, tg_id):
+        with self._lock:
+            entry = self._users.get(tg_id)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                self._pop(tg_id)
+                return None
+            self._users.move_to_end(tg_id)
+            return user
+
+    def set(self, user: CachedUser):
+        with self._lock:
+            self._pop(user.tg_id)
+            self._users[user.tg_id] = (user, time.monotonic() + self.ttl)
+            self._tg_ids_by_pk[user.id] = user.tg_id
+            while len(self._users) > self.maxsize:
+                tg_id = next(iter(self._users))
+                self._pop(tg_id)
+
+    def invalidate(self, pk=None, tg_id=None):
+        with self._lock:
+            if pk in self._tg_ids_by_pk:
+                self._pop(self._tg_ids_by_pk[pk])
+            if tg_id is not None:
+                self._pop(tg_id)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._tg_ids_by_pk.clear()
+
+    def _pop(self, tg_id):
+        entry = self._users.pop(tg_id, None)
+        if entry is not None:
+            self._tg_ids_by_pk.pop(entry[0].id, None)
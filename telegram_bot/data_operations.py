@@ -1,10 +1,121 @@
+import datetime
+
 import phonenumbers
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+from telegram_bot.cache import CachedUser, UserCache
+from telegram_bot.models import (
+    TASK_LIMITS,
+    TASK_SEARCH_TABLE,
+    Message,
+    Subscription,
+    Task,
+    TaskQuota,
+    User,
+    build_search_query,
+)
+
+user_cache = UserCache(maxsize=settings.TG_USER_CACHE_SIZE, ttl=settings.TG_USER_CACHE_TTL)
+
+
+def get_cached_user(user_id) -> CachedUser:
+    user = user_cache.get(user_id)
+    if user is None:
+        user = CachedUser(**User.objects.values(*CachedUser._fields).get(tg_id=user_id))
+        user_cache.set(user)
+    return user
+
+
+def refresh_subscription_snapshot(user_pk):
+    """Пересчитывает текущую подписку, сохраненную в записи пользователя"""
+    now = timezone.now()
+    subscription = (
+        Subscription.objects
+        .filter(user_id=user_pk, starts_at__lte=now, end_at__gt=now)
+        .exclude(lvl=Subscription.SubscriptionLevel.NOT_ACTIVE)
+        .order_by('-end_at')
+        .first()
+    )
+    User.objects.filter(pk=user_pk).update(
+        subscription_lvl=subscription.lvl if subscription else Subscription.SubscriptionLevel.NOT_ACTIVE,
+        subscription_starts_at=subscription.starts_at if subscription else None,
+        subscription_end_at=subscription.end_at if subscription else None,
+        subscription_changes_at=get_next_subscription_change(user_pk, now),
+    )
+    user_cache.invalidate(pk=user_pk)
+
+
+def get_next_subscription_change(user_pk, now):
+    """Ближайшее будущее начало или конец любой подписки пользователя: тогда текущая подписка может смениться"""
+    boundaries = (
+        Subscription.objects
+        .filter(user_id=user_pk)
+        .exclude(lvl=Subscription.SubscriptionLevel.NOT_ACTIVE)
+        .aggregate(
+            next_start=Min('starts_at', filter=Q(starts_at__gt=now)),
+            next_end=Min('end_at', filter=Q(end_at__gt=now)),
+        )
+    )
+    return min(filter(None, boundaries.values()), default=None)
+
 
-from telegram_bot.models import User
+def get_subscription_changes(now):
+    """Пользователи, у которых подписка могла смениться к моменту now"""
+    # order_by() убирает сортировку по имени из User.Meta.ordering, иначе каждый запуск сортирует во временном B-дереве
+    return User.objects.filter(subscription_changes_at__lte=now).order_by().values_list('pk', flat=True)
+
+
+def refresh_expired_subscriptions():
+    """Снимает истекшие подписки и включает следующие, если они уже начались"""
+    expired = get_subscription_changes(timezone.now())
+    for user_pk in expired.iterator():
+        refresh_subscription_snapshot(user_pk)
+
+
+def get_remaining_tasks(user: CachedUser) -> int:
+    """Сколько задач клиент еще может создать в текущем оплаченном периоде"""
+    if not user.has_active_subscription:
+        return 0
+    used = (
+        TaskQuota.objects
+        .filter(user_id=user.id, period_starts_at=user.subscription_starts_at)
+        .values_list('used', flat=True)
+        .first()
+    )
+    return max(TASK_LIMITS.get(user.subscription_lvl, 0) - (used or 0), 0)
+
+
+def take_task_quota(user: CachedUser) -> bool:
+    """Списывает одну задачу из лимита подписки.
+
+    Вызывается в той же транзакции, что и создание задачи. Счетчик увеличивается
+    одним условным UPDATE по уникальному индексу, поэтому проверка не зависит
+    от количества задач клиента, а параллельные запросы не превысят лимит.
+    """
+    limit = TASK_LIMITS.get(user.subscription_lvl)
+    if not limit or not user.has_active_subscription:
+        return False
+    quotas = TaskQuota.objects.filter(user_id=user.id, period_starts_at=user.subscription_starts_at)
+    if quotas.filter(used__lt=limit).update(used=F('used') + 1):
+        return True
+    _, created = TaskQuota.objects.get_or_create(
+        user_id=user.id,
+        period_starts_at=user.subscription_starts_at,
+        defaults={'used': 1},
+    )
+    # Если запись успел создать параллельный запрос, списываем из нее
+    return created or bool(quotas.filter(used__lt=limit).update(used=F('used') + 1))
 
 
 def is_new_user(user_id):
-    return not User.objects.filter(tg_id=user_id).exists()
+    try:
+        get_cached_user(user_id)
+    except User.DoesNotExist:
+        return True
+    return False
 
 
 def save_user_data(data):
@@ -32,4 +143,108 @@ def delete_user(user_id):
 
 
 def get_user_role(user_id):
-    return User.objects.get(tg_id=user_id).role
+    return get_cached_user(user_id).role
+
+
+
+def encode_cursor(task, field='created_at') -> str:
+    value = int(getattr(task, field).timestamp() * 1_000_000)
+    return f'{value}:{task.id}'
+
+
+def decode_cursor(cursor: str):
+    value, task_id = cursor.split(':')
+    value = datetime.datetime.fromtimestamp(int(value) / 1_000_000, tz=datetime.timezone.utc)
+    return value, int(task_id)
+
+
+def get_tasks_page(tasks, cursor=None, backwards=False, page_size=None, field='created_at', descending=False):
+    """Страница задач (или других записей с полем даты field и id) по курсору (field, id) вместо OFFSET.
+
+    Список идет по возрастанию (field, id), а при descending=True - по убыванию,
+    поэтому для каждого списка нужен индекс (field, id) или индекс по фильтру с этими полями в конце.
+    Возвращает записи страницы и признаки наличия предыдущей и следующей страниц.
+    """
+    page_size = page_size or settings.TG_TASKS_PAGE_SIZE
+    # Читать ли индекс от курсора в сторону меньших значений
+    decreasing = backwards != descending
+    if cursor is not None:
+        value, task_id = decode_cursor(cursor)
+        # Лишнее на первый взгляд условие по field позволяет базе начать чтение индекса
+        # сразу с позиции курсора, а не отбрасывать записи до курсора по одной
+        if decreasing:
+            tasks = tasks.filter(
+                Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': task_id}),
+                **{f'{field}__lte': value},
+            )
+        else:
+            tasks = tasks.filter(
+                Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': task_id}),
+                **{f'{field}__gte': value},
+            )
+    ordering = [f'-{field}', '-id'] if decreasing else [field, 'id']
+    page = list(tasks.order_by(*ordering)[:page_size + 1])
+    has_more = len(page) > page_size
+    page = page[:page_size]
+    if backwards:
+        page.reverse()
+        return page, has_more, cursor is not None
+    return page, cursor is not None, has_more
+
+
+def get_task_messages_page(task_id, cursor=None, backwards=True):
+    """Страница переписки по задаче по индексу (task_message, created_at).
+
+    Без курсора возвращает последние сообщения, поэтому время ответа не зависит
+    от того, сколько всего сообщений в переписке.
+    """
+    messages = Message.objects.filter(task_message_id=task_id).only('id', 'created_at', 'text', 'first_person_id')
+    return get_tasks_page(messages, cursor=cursor, backwards=backwards, page_size=settings.TG_MESSAGES_PAGE_SIZE)
+
+
+def can_read_task_messages(user: CachedUser, task_id) -> bool:
+    if user.role == User.UserRole.MANAGER:
+        return Task.objects.filter(id=task_id).exists()
+    return Task.objects.filter(Q(client_id=user.id) | Q(worker_id=user.id), id=task_id).exists()
+
+
+def search_tasks_page(user: CachedUser, text: str, page: int = 0):
+    """Страница задач, найденных по тексту, от самых подходящих к менее подходящим.
+
+    Менеджер ищет по всем задачам, исполнитель - по ожидающим принятия и своим.
+    Возвращает превью задач страницы и признаки наличия предыдущей и следующей страниц.
+    """
+    page_size = settings.TG_TASKS_PAGE_SIZE
+    query = build_search_query(text)
+    if not query:
+        return [], False, False
+
+    condition, params = '', [query]
+    if user.role != User.UserRole.MANAGER:
+        condition = 'AND (task.status = %s OR task.worker_id = %s)'
+        params += [Task.Proc.WAITING, user.id]
+    if connection.vendor == 'sqlite':
+        # Сортировка только по rank позволяет FTS5 отдавать строки сразу в порядке релевантности
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT task.id FROM {TASK_SEARCH_TABLE} AS search
+                JOIN {Task._meta.db_table} AS task ON task.id = search.rowid
+                WHERE search.{TASK_SEARCH_TABLE} MATCH %s {condition}
+                ORDER BY search.rank
+                LIMIT %s OFFSET %s
+                """,
+                [*params, page_size + 1, page * page_size],
+            )
+            task_ids = [task_id for task_id, in cursor.fetchall()]
+    else:
+        tasks = Task.objects.search(text)
+        if user.role != User.UserRole.MANAGER:
+            tasks = tasks.filter(Q(status=Task.Proc.WAITING) | Q(worker_id=user.id))
+        offset = page * page_size
+        task_ids = list(tasks.order_by('-created_at').values_list('id', flat=True)[offset:offset + page_size + 1])
+
+    has_next = len(task_ids) > page_size
+    task_ids = task_ids[:page_size]
+    tasks = Task.objects.previews().in_bulk(task_ids)
+    return [tasks[task_id] for task_id in task_ids if task_id in tasks], page > 0, has_next
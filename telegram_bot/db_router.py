@@ -0,0 +1,109 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+_local = threading.local()
+# Время последней записи каждого чата: своей или прочитанной из состояния диалога, записанной другим процессом
+_last_writes = {}
+# Записи этого процесса, которые еще не сохранены в состояниях диалогов для других процессов
+_unpublished_writes = {}
+_last_writes_lock = threading.Lock()
+
+# Сколько чатов помнить, прежде чем удалять записи с истекшим окном
+MAX_TRACKED_CHATS = 10000
+
+# Служебные таблицы бота: запись в них не меняет данных, которые пользователь видит в списках
+UNTRACKED_MODELS = {'telegram_bot.conversationstate', 'telegram_bot.telegramfile'}
+
+
+def replica_alias():
+    alias = settings.DATABASE_REPLICA_ALIAS
+    return alias if alias in settings.DATABASES else None
+
+
+def set_current_chat(chat_id):
+    """Запоминает чат обновления, которое обрабатывает текущий поток, чтобы связать с ним записи в базу"""
+    _local.chat_id = chat_id
+
+
+def _remember(writes, chat_id, written_at):
+    if chat_id in writes and writes[chat_id] >= written_at:
+        return
+    writes[chat_id] = written_at
+    if len(writes) > MAX_TRACKED_CHATS:
+        expired_before = written_at - timezone.timedelta(seconds=settings.DATABASE_REPLICA_STICKY_SECONDS)
+        for tracked_chat_id, tracked_at in list(writes.items()):
+            if tracked_at < expired_before:
+                del writes[tracked_chat_id]
+
+
+def record_write(chat_id, written_at=None):
+    """Отмечает запись в базу, сделанную этим процессом при обработке обновления чата"""
+    written_at = written_at or timezone.now()
+    with _last_writes_lock:
+        _remember(_last_writes, chat_id, written_at)
+        _remember(_unpublished_writes, chat_id, written_at)
+
+
+def remember_write(chat_id, written_at):
+    """Отмечает запись чата, о которой процесс узнал из базы, например из состояния диалога"""
+    with _last_writes_lock:
+        _remember(_last_writes, chat_id, written_at)
+
+
+def take_unpublished_writes() -> dict:
+    """Записи процесса, о которых еще не знают другие процессы; после вызова считаются опубликованными"""
+    with _last_writes_lock:
+        writes = dict(_unpublished_writes)
+        _unpublished_writes.clear()
+    return writes
+
+
+def wrote_recently(chat_id) -> bool:
+    with _last_writes_lock:
+        written_at = _last_writes.get(chat_id)
+    sticky = timezone.timedelta(seconds=settings.DATABASE_REPLICA_STICKY_SECONDS)
+    return written_at is not None and timezone.now() - written_at < sticky
+
+
+@contextmanager
+def read_from_replica(chat_id=None):
+    """Чтения внутри блока идут на реплику.
+
+    Если чат chat_id недавно писал в базу, чтения остаются на основной базе,
+    чтобы пользователь сразу увидел свои изменения, даже если реплика отстает.
+    Записи других процессов видны через состояние диалога, см. DjangoPersistence.
+    """
+    previous = getattr(_local, 'replica', False)
+    _local.replica = chat_id is None or not wrote_recently(chat_id)
+    try:
+        yield
+    finally:
+        _local.replica = previous
+
+
+class ReplicaRouter:
+    """Направляет чтения из блоков read_from_replica на реплику DATABASE_REPLICA_ALIAS.
+
+    Записи и чтения внутри транзакции идут на основную базу, как и все чтения вне read_from_replica,
+    в том числе связанных объектов, прочитанных с реплики. Если реплика не настроена, все идет на основную базу.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(_local, 'replica', False) and not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return replica_alias() or DEFAULT_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Основная база возвращается явно: иначе Django сохранил бы объект, прочитанный с реплики, туда же
+        chat_id = getattr(_local, 'chat_id', None)
+        if chat_id is not None and model._meta.label_lower not in UNTRACKED_MODELS:
+            record_write(chat_id)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплика - копия основной базы, объекты из обеих можно связывать
+        return True
@@ -0,0 +1,60 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    """Обрабатывает обновления разных чатов параллельно в пуле потоков.
+
+    Обновления одного чата выполняются строго по очереди, поэтому переходы
+    состояний ConversationHandler остаются такими же, как при последовательной обработке.
+    """
+
+    def __init__(self, *args, pool_size: int = 8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_size = pool_size
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='chat-worker')
+        self._chat_queues = {}
+        self._chat_queues_lock = threading.Lock()
+
+    def process_update(self, update: object) -> None:
+        if not isinstance(update, Update) or not update.effective_chat:
+            super().process_update(update)
+            return
+
+        chat_id = update.effective_chat.id
+        with self._chat_queues_lock:
+            pending = self._chat_queues.get(chat_id)
+            if pending is not None:
+                pending.append(update)
+                return
+            self._chat_queues[chat_id] = deque()
+        self._executor.submit(self._process_chat, chat_id, update)
+
+    def _process_chat(self, chat_id: int, update: Update) -> None:
+        while True:
+            close_old_connections()
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception('Ошибка при обработке обновления %s', update.update_id)
+            finally:
+                close_old_connections()
+
+            with self._chat_queues_lock:
+                pending = self._chat_queues[chat_id]
+                if not pending:
+                    del self._chat_queues[chat_id]
+                    return
+                update = pending.popleft()
+
+    def stop(self) -> None:
+        super().stop()
+        self._executor.shutdown(wait=True)
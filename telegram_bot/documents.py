@@ -0,0 +1,84 @@
+import hashlib
+import os
+import threading
+
+from telegram.error import BadRequest
+
+from telegram_bot.models import TelegramFile
+from telegram_bot.outbox import Outbox
+
+_digests = {}
+_file_ids = {}
+_lock = threading.Lock()
+
+
+def get_file_digest(path) -> str:
+    """SHA-256 файла, пересчитывается только при изменении размера или времени изменения"""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _digests.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    with open(path, 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+    with _lock:
+        _digests[path] = (version, digest)
+    return digest
+
+
+def get_file_id(digest):
+    with _lock:
+        file_id = _file_ids.get(digest)
+    if file_id is None:
+        file_id = TelegramFile.objects.filter(sha256=digest).values_list('file_id', flat=True).first()
+        if file_id is not None:
+            with _lock:
+                _file_ids[digest] = file_id
+    return file_id
+
+
+def save_file_id(digest, file_id):
+    TelegramFile.objects.update_or_create(sha256=digest, defaults={'file_id': file_id})
+    with _lock:
+        _file_ids[digest] = file_id
+
+
+def forget_file_id(digest):
+    with _lock:
+        _file_ids.pop(digest, None)
+    TelegramFile.objects.filter(sha256=digest).delete()
+
+
+def is_file_id_rejected(error) -> bool:
+    """Telegram не принял сам file_id, а не отказал в отправке этому чату"""
+    message = str(error).lower()
+    return isinstance(error, BadRequest) and ('file identifier' in message or 'file_id' in message)
+
+
+def upload_document(outbox: Outbox, chat_id, path, digest, **kwargs):
+    with open(path, 'rb') as file:
+        content = file.read()
+
+    def remember_file_id(sent):
+        save_file_id(digest, sent.document.file_id)
+
+    outbox.enqueue(chat_id, 'send_document', on_sent=remember_file_id, document=content, **kwargs)
+
+
+def send_cached_document(outbox: Outbox, chat_id, path, **kwargs):
+    """Отправляет документ по сохраненному file_id, а файл загружает только при первой отправке
+    или после изменения его содержимого"""
+    digest = get_file_digest(path)
+    file_id = get_file_id(digest)
+    if file_id is None:
+        upload_document(outbox, chat_id, path, digest, **kwargs)
+        return
+
+    def reupload_if_rejected(error):
+        if is_file_id_rejected(error):
+            forget_file_id(digest)
+            upload_document(outbox, chat_id, path, digest, **kwargs)
+
+    outbox.enqueue(chat_id, 'send_document', on_error=reupload_if_rejected, document=file_id, **kwargs)
@@ -0,0 +1,102 @@
+import functools
+import logging
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+from telegram.ext import ConversationHandler
+
+from telegram_bot import metrics
+from telegram_bot.routing import CallbackRouter
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    """Считает запросы к базе через execute_wrapper, поэтому работает и без DEBUG"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started_at
+
+
+def get_update_id(args):
+    update = args[0] if args else None
+    return getattr(update, 'update_id', None)
+
+
+def instrument_callback(callback, state: str, budget: float, query_budget: int):
+    """Оборачивает callback обработчика: время выполнения, число и время запросов к базе"""
+    handler = getattr(callback, '__name__', repr(callback))
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        counter = QueryCounter()
+        failed = False
+        started_at = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(counter))
+                return callback(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            slow = duration > budget or counter.count > query_budget
+            metrics.updates.inc(handler, state)
+            metrics.update_duration.observe(handler, state, value=duration)
+            metrics.db_queries.inc(handler, state, value=counter.count)
+            metrics.db_query_duration.inc(handler, state, value=counter.duration)
+            if failed:
+                metrics.update_errors.inc(handler, state)
+            if slow:
+                metrics.slow_updates.inc(handler, state)
+                logger.warning(
+                    'slow_handler handler=%s state=%s update_id=%s duration_ms=%.1f queries=%d query_ms=%.1f',
+                    handler,
+                    state,
+                    get_update_id(args),
+                    duration * 1000,
+                    counter.count,
+                    counter.duration * 1000,
+                    extra={
+                        'handler': handler,
+                        'state': state,
+                        'duration': duration,
+                        'queries': counter.count,
+                        'query_duration': counter.duration,
+                    },
+                )
+
+    return wrapper
+
+
+def instrument_conversation_handler(
+        conversation_handler: ConversationHandler,
+        budget: float,
+        query_budget: int,
+) -> ConversationHandler:
+    """Оборачивает все обработчики диалога, подписывая их состоянием, в котором они вызываются"""
+
+    def instrument(handlers, state):
+        for handler in handlers:
+            if isinstance(handler, CallbackRouter):
+                handler.wrap_callbacks(lambda callback: instrument_callback(callback, state, budget, query_budget))
+            else:
+                handler.callback = instrument_callback(handler.callback, state, budget, query_budget)
+
+    instrument(conversation_handler.entry_points, 'entry')
+    for state, handlers in conversation_handler.states.items():
+        instrument(handlers, getattr(state, 'name', str(state)))
+    instrument(conversation_handler.fallbacks, 'fallback')
+    return conversation_handler
@@ -0,0 +1,44 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from telegram_bot.benchmark import BenchmarkError, format_result, run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест бота на локальной замене Bot API, без доступа в сеть'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', type=int, default=1000, help='Сколько пар клиент-исполнитель прогнать')
+        parser.add_argument('--concurrency', type=int, default=50, help='Сколько сценариев выполняется одновременно')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.TG_BOT_WORKERS,
+            help='Количество потоков диспетчера, как у команды telegram-bot',
+        )
+        parser.add_argument('--timeout', type=float, default=30, help='Сколько секунд ждать ответа бота на шаг')
+
+    def handle(self, *args, **kwargs):
+        # Тест пишет тысячи пользователей и задач, поэтому работает на отдельной временной базе
+        with tempfile.TemporaryDirectory() as directory:
+            settings.DATABASES[connection.alias].setdefault('TEST', {})['NAME'] = os.path.join(
+                directory,
+                'benchmark.sqlite3',
+            )
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                result = run_benchmark(
+                    scenarios=kwargs['scenarios'],
+                    concurrency=kwargs['concurrency'],
+                    workers=kwargs['workers'],
+                    timeout=kwargs['timeout'],
+                )
+            except BenchmarkError as error:
+                raise CommandError(error)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.stdout.write(format_result(result))
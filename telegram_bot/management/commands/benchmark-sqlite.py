@@ -0,0 +1,27 @@
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from telegram_bot.benchmark import DEFAULT_PRAGMAS, compare_write_profiles, format_write_results
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость записи в SQLite с настройками по умолчанию и с SQLITE_PRAGMAS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writes', type=int, default=2000, help='Сколько строк записать, по строке на транзакцию')
+        parser.add_argument('--writers', type=int, default=8, help='Сколько потоков пишут одновременно')
+        parser.add_argument('--readers', type=int, default=4, help='Сколько потоков читают во время записи')
+
+    def handle(self, *args, **kwargs):
+        # Файлы пишутся во временный каталог, рабочая база не затрагивается
+        with tempfile.TemporaryDirectory() as directory:
+            results = compare_write_profiles(
+                directory,
+                {'default': DEFAULT_PRAGMAS, 'tuned': settings.SQLITE_PRAGMAS},
+                writers=kwargs['writers'],
+                readers=kwargs['readers'],
+                writes=kwargs['writes'],
+            )
+        self.stdout.write(format_write_results(results))
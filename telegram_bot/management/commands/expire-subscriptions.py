@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from telegram_bot.data_operations import refresh_expired_subscriptions
+
+
+class Command(BaseCommand):
+    help = 'Снимает истекшие подписки пользователей (для запуска по расписанию при работе через вебхук)'
+
+    def handle(self, *args, **kwargs):
+        refresh_expired_subscriptions()
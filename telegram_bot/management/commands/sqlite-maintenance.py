@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from telegram_bot.sqlite import run_maintenance
+
+
+class Command(BaseCommand):
+    help = 'Переносит журнал WAL в базу и выполняет PRAGMA optimize (для запуска по расписанию при работе через вебхук)'
+
+    def handle(self, *args, **kwargs):
+        run_maintenance()
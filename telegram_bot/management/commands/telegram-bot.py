@@ -1,980 +1,55 @@
-import datetime
-import logging
-from enum import Enum, auto
-from textwrap import dedent
-
-import phonenumbers
-from telegram import (
-    KeyboardButton,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    ReplyKeyboardMarkup,
-    Update,
-)
-from telegram.ext import (
-    Updater,
-    CommandHandler,
-    MessageHandler,
-    Filters,
-    ConversationHandler,
-    CallbackContext,
-    CallbackQueryHandler,
-)
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from django.utils import timezone
-
-from telegram_bot.models import User, Subscription, Task, Message, Support
-from telegram_bot.data_operations import (
-    is_new_user,
-    save_user_data,
-    validate_fullname,
-    validate_phonenumber,
-    get_user_role,
-)
-
-logger = logging.getLogger(__name__)
-
 
-class States(Enum):
-    start = auto()
-    authorization = auto()
-    get_phone = auto()
-    choose_role = auto()
-    client = auto()
-    worker = auto()
-    manager = auto()
-    handle_subscriptions = auto()
-    handle_task = auto()
-    show_client_tasks = auto()
-    handle_subscribe = auto()
-    handle_payment = auto()
-    work_choose = auto()
-    show_worker_tasks = auto()
-    take_work = auto()
-    handle_message = auto()
-    handle_support_message = auto()
-    worker_confirm = auto()
-    client_confirm = auto()
-
-
-class Transitions(Enum):
-    authorization_reject = auto()
-    authorization_approve = auto()
-    client = auto()
-    worker = auto()
-    manager = auto()
-    subscriptions = ()
-    create_task = auto()
-    tasks = auto()
-    subscribe = auto()
-    worklist = auto()
-    current_tasks = auto()
-    take = auto()
-    tech = auto()
-    unaccepted = auto()
-    expired = auto()
-    message = auto()
-    support_message = auto()
-    confirm = auto()
+from telegram_bot.bot import build_persistence, build_updater, setup_dispatcher, stop_dispatcher
+from telegram_bot.metrics import serve_metrics
 
 
 class Command(BaseCommand):
     help = 'Implemented to Django application telegram bot setup command'
 
-    def handle(self, *args, **kwargs):
-        updater = Updater(token=settings.TG_BOT_TOKEN)
-
-        dispatcher = updater.dispatcher
-
-        conv_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler('start', start),
-            ],
-            states={
-                States.authorization:
-                    [
-                        CallbackQueryHandler(
-                            callback=callback_approve_handler,
-                            pass_chat_data=True
-                        ),
-                        MessageHandler(Filters.text, get_phone),
-                    ],
-                States.get_phone:
-                    [
-                        MessageHandler(Filters.text, handle_phone),
-                        MessageHandler(Filters.contact, handle_phone),
-                    ],
-                States.choose_role:
-                    [
-                        CallbackQueryHandler(handle_role),
-                    ],
-                States.client:
-                    [
-                        CallbackQueryHandler(show_subscriptions, pattern=f'^{Transitions.subscriptions}$'),
-                        CallbackQueryHandler(create_task, pattern=f'^{Transitions.create_task}$'),
-                        CallbackQueryHandler(show_client_tasks, pattern=f'^{Transitions.tasks}$'),
-                    ],
-                States.handle_subscriptions:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                        CallbackQueryHandler(subscribe, pattern=f'^{Transitions.subscribe}$'),
-                    ],
-                States.handle_subscribe:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                        CallbackQueryHandler(handle_payment),
-                    ],
-                States.handle_payment:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                        CallbackQueryHandler(create_subscription),
-                    ],
-                States.handle_task:
-                    [
-                        MessageHandler(Filters.text, register_task),
-                        CallbackQueryHandler(show_subscriptions, pattern=f'^{Transitions.subscribe}$'),
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                    ],
-                States.show_client_tasks:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                        CallbackQueryHandler(create_message, pattern=f'^{Transitions.message}$'),
-                        CallbackQueryHandler(create_support_message, pattern=f'^{Transitions.support_message}$'),
-                        CallbackQueryHandler(client_confirm, pattern=f'^{Transitions.confirm}$'),
-                        CallbackQueryHandler(show_client_task),
-                    ],
-                States.worker:
-                    [
-                        CallbackQueryHandler(show_available_tasks, pattern=f'^{Transitions.worklist}$'),
-                        CallbackQueryHandler(show_worker_tasks, pattern=f'^{Transitions.current_tasks}$'),
-                    ],
-                States.show_worker_tasks:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.worker}$'),
-                        CallbackQueryHandler(get_deadline, pattern=f'^{Transitions.take}$'),
-                        CallbackQueryHandler(create_message, pattern=f'^{Transitions.message}$'),
-                        CallbackQueryHandler(create_support_message, pattern=f'^{Transitions.support_message}$'),
-                        CallbackQueryHandler(worker_confirm, pattern=f'^{Transitions.confirm}$'),
-                        CallbackQueryHandler(show_worker_task),
-                        MessageHandler(Filters.text, get_deadline),
-                    ],
-                States.work_choose:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.worker}$'),
-                        CallbackQueryHandler(take_work, pattern=f'^{Transitions.take}$'),
-                        MessageHandler(Filters.text, get_deadline),
-                    ],
-                States.handle_message:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.worker}$'),
-                        MessageHandler(Filters.text, handle_message),
-                    ],
-                States.handle_support_message:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.worker}$'),
-                        MessageHandler(Filters.text, handle_support_message),
-                    ],
-
-                States.manager:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.manager}$'),
-                        CallbackQueryHandler(show_support_messages, pattern=f'^{Transitions.tech}$'),
-                        CallbackQueryHandler(show_unaccepted, pattern=f'^{Transitions.unaccepted}$'),
-                        CallbackQueryHandler(show_expired, pattern=f'^{Transitions.expired}$'),
-                        CallbackQueryHandler(show_task_details),
-                    ],
-                States.client_confirm:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.client}$'),
-                        CallbackQueryHandler(client_confirm_task, pattern=f'^{Transitions.confirm}$'),
-                        MessageHandler(Filters.text, client_confirm_task),
-                    ],
-                States.worker_confirm:
-                    [
-                        CallbackQueryHandler(handle_role, pattern=f'^{Transitions.worker}$'),
-                        CallbackQueryHandler(worker_confirm_task, pattern=f'^{Transitions.confirm}$'),
-                        MessageHandler(Filters.text, worker_confirm_task),
-                    ],
-            },
-            fallbacks=[
-                CommandHandler('cancel', cancel),
-                CommandHandler('start', cancel),
-            ],
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--webhook',
+            action='store_true',
+            help='Зарегистрировать вебхук TG_WEBHOOK_URL вместо запуска long polling',
         )
-
-        dispatcher.add_handler(conv_handler)
-
-        updater.start_polling()
-        updater.idle()
-
-
-def start(update: Update, context: CallbackContext) -> int:
-    user_id = update.effective_user.id
-    if is_new_user(user_id):
-        with open("agreement.pdf", "rb") as image:
-            agreement = image.read()
-
-        keyboard = [
-            [InlineKeyboardButton("Принимаю", callback_data=str(Transitions.authorization_approve))],
-            [InlineKeyboardButton("Отказываюсь", callback_data=str(Transitions.authorization_reject))],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        update.message.reply_document(
-            agreement,
-            filename="Соглашение на обработку персональных данных.pdf",
-            caption="Для использования сервиса, примите соглашение об обработке персональных данных",
-            reply_markup=reply_markup,
-            parse_mode="Markdown"
-        )
-        return States.authorization
-    else:
-        keyboard = [
-            [InlineKeyboardButton("Клиент", callback_data=str(Transitions.client))],
-            [InlineKeyboardButton("Исполнитель", callback_data=str(Transitions.worker))],
-            [InlineKeyboardButton("Менеджер", callback_data=str(Transitions.manager))],
-        ]
-        context.bot.send_message(
-            chat_id=user_id,
-            text=f"Клиент - разместить заказ\nИсполнитель - получить заказы\nМенеджер - для управляющих",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.TG_BOT_WORKERS,
+            help='Количество потоков для параллельной обработки чатов (1 - последовательная обработка)',
         )
-        return States.choose_role
-
-
-def callback_approve_handler(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    data = query.data
-
-    if data == str(Transitions.authorization_approve):
-        context.bot.send_message(
-            chat_id=chat_id,
-            text="Введите имя и фамилию"
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            default=settings.TG_METRICS_PORT,
+            help='Порт, на котором процесс бота отдает метрики в формате Prometheus',
         )
-        return States.authorization
-    elif data == str(Transitions.authorization_reject):
-        context.bot.send_message(
-            chat_id=chat_id,
-            text="Без соглашения на обработку мы не можем оказать вам услугу"
-        )
-        return ConversationHandler.END
-
-
-def get_phone(update: Update, context: CallbackContext) -> int:
-    user_name = update.message.text
-    context.user_data["user_id"] = update.message.from_user.id
-    context.user_data["full_name"] = user_name
-    split_name = user_name.split()
-    if not validate_fullname(split_name):
-        update.message.reply_text(
-            "*Введите корректные имя и фамилию!*\nПример: Василий Петров",
-            parse_mode="Markdown"
-        )
-    if validate_fullname(split_name):
-        message_keyboard = [[
-            KeyboardButton(
-                "Отправить свой номер телефона", request_contact=True
-            )
-        ]]
-        markup = ReplyKeyboardMarkup(
-            message_keyboard, one_time_keyboard=True, resize_keyboard=True
-        )
-        update.message.reply_text(
-            f"Введите телефон в формате +7... или нажав на кнопку ниже:",
-            reply_markup=markup
-        )
-        return States.get_phone
-
-
-def handle_phone(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    try:
-        phone = update.message.contact.phone_number
-    except AttributeError:
-        phone = update.message.text
-    check_number = validate_phonenumber(phone)
-    if not check_number:
-        context.bot.send_message(
-            chat_id=chat_id,
-            text="Введен невалидный номер, попробуйте снова."
-        )
-        return States.get_phone
-    context.user_data["phone_number"] = phonenumbers.parse(phone, "RU")
-    if is_new_user(context.user_data["user_id"]):
-        save_user_data(context.user_data)
-    chat_id = update.effective_chat.id
-    context.bot.send_message(
-        chat_id=chat_id,
-        text="*Вы прошли регистрацию*",
-        parse_mode="Markdown"
-    )
-    keyboard = [
-        [InlineKeyboardButton("Клиент", callback_data=str(Transitions.client))],
-        [InlineKeyboardButton("Исполнитель", callback_data=str(Transitions.worker))],
-        [InlineKeyboardButton("Менеджер", callback_data=str(Transitions.manager))],
-    ]
-    context.bot.send_message(
-        chat_id=chat_id,
-        text=f"Клиент - разместить заказ\nИсполнитель - получить заказы\nМенеджер - для управляющих",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
-    return States.choose_role
-
-
-def handle_role(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    user_role = get_user_role(chat_id)
-    query = update.callback_query
-    query.answer()
-    data = query.data
-    if data == str(Transitions.client):
-        keyboard = [
-            [InlineKeyboardButton("Подписки", callback_data=str(Transitions.subscriptions))],
-            [InlineKeyboardButton("Оформить заказ", callback_data=str(Transitions.create_task))],
-            [InlineKeyboardButton("История заказов", callback_data=str(Transitions.tasks))],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.message.reply_text(
-            text="Куда отправимся?",
-            reply_markup=reply_markup,
-        )
-        return States.client
-    elif data == str(Transitions.worker):
-        if user_role == "WK":
-            keyboard = [
-                [InlineKeyboardButton("Список задач", callback_data=str(Transitions.worklist))],
-                [InlineKeyboardButton("Текущие задачи", callback_data=str(Transitions.current_tasks))],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.message.reply_text(
-                text="Выберете меню",
-                reply_markup=reply_markup,
-            )
-            return States.worker
-        else:
-            message = "К сожалению вы не исполнитель"
-    elif data == str(Transitions.manager):
-        if user_role == "MNG":
-            keyboard = [
-                [InlineKeyboardButton("Обращения в техподдержку", callback_data=str(Transitions.tech))],
-                [InlineKeyboardButton("Непринятые заказы", callback_data=str(Transitions.unaccepted))],
-                [InlineKeyboardButton("Заказы с истекшим сроком", callback_data=str(Transitions.expired))],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.message.reply_text(
-                text="Выберете меню",
-                reply_markup=reply_markup,
-            )
-            return States.manager
-        else:
-            message = "К сожалению, вы не менеджер"
-    keyboard = [
-        [InlineKeyboardButton("Клиент", callback_data=str(Transitions.client))],
-        [InlineKeyboardButton("Исполнитель", callback_data=str(Transitions.worker))],
-        [InlineKeyboardButton("Менеджер", callback_data=str(Transitions.manager))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.choose_role
-
-
-def show_subscriptions(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    subscriptions = User.objects.get(tg_id=chat_id).subscriptions.filter(starts_at__lte=timezone.now(), end_at__gte=timezone.now())
-    if len(subscriptions):
-        message = ''.join([f'{subscription.lvl}, которая истекает {subscription.end_at}\n' for subscription in subscriptions])
-    else:
-        message = 'У вас нет активных подписок'
-    keyboard = [
-        [InlineKeyboardButton("Оформить подписку", callback_data=str(Transitions.subscribe))],
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.handle_subscriptions
-
-
-def handle_payment(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    data = query.data
-    price = ''
-    if data == 'economy':
-        message = 'Стоимость подписки 100$'
-        price = '100'
-    elif data == 'default':
-        message = 'Стоимость подписки 200$'
-        price = '200'
-    elif data == 'vip':
-        message = 'Стоимость подписки 300$'
-        price = '300'
-    keyboard = [
-        [InlineKeyboardButton("Оплатить подписку", callback_data=price)],
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.handle_payment
-
-
-def create_subscription(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    data = query.data
-    user = User.objects.get(tg_id=chat_id)
-    starts_at = timezone.now()
-    end_at = starts_at + timezone.timedelta(days=30)
-    if data == '100':
-        subscription_level = 'Экономный'
-    elif data == '200':
-        subscription_level = 'Стандарт'
-    elif data == '300':
-        subscription_level = 'ВИП'
-    Subscription.objects.create(user=user, lvl=subscription_level, starts_at=starts_at, end_at=end_at)
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text='Подписка успешно оплачена',
-        reply_markup=reply_markup,
-    )
-    return States.handle_subscriptions
-
-
-def create_task(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    subscriptions = User.objects.get(tg_id=chat_id).subscriptions.filter(starts_at__lte=timezone.now(),
-                                                                         end_at__gte=timezone.now())
-    if len(subscriptions):
-        message = dedent('''
-            Для того чтобы создать задачу, отправьте задание в текстовом формате
-            Не указывайте в задаче паролей/логинов или других чувствительных данных
-        ''')
-    else:
-        message = 'У вас нет активных подписок'
-        keyboard.append([InlineKeyboardButton("К подпискам", callback_data=str(Transitions.subscribe))])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.handle_task
-
-
-def register_task(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    text = update.effective_message.text
-
-    user = User.objects.get(tg_id=chat_id)
-    Task.objects.create(client=user, task=text, created_at=timezone.now())
-
-    message = f'Задача успешно создана\n\nТекст:\n{text}\n\nМы оповестим Вас как только найдем исполнителя '
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(
-        chat_id,
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.handle_task
-
-
-def show_client_tasks(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    message = 'Ваши заказы:\n'
-    tasks = User.objects.get(tg_id=chat_id).client_tasks.all()
-
-    if len(tasks):
-        for task in tasks:
-            message += f'Заказ №{task.id}, {task.task[:30]}\n\n'
-            keyboard.append([InlineKeyboardButton(f"К заказу {task.id}", callback_data=str(task.id))])
-    else:
-        message += 'Вы еще не создавали заказов'
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.show_client_tasks
-
-
-def subscribe(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    message = dedent('''
-        Тарифы:
-        Эконом - до 5 заявок в месяц на помощь, по заявке ответят в течение суток
-        Стандарт - до 15 заявок в месяц, возможность закрепить подрядчика за собой, заявка будет рассмотрена в течение часа
-        VIP - до 60 заявок в месяц, возможность увидеть контакты подрядчика, заявка будет рассмотрена в течение часа 
-    ''')
-    keyboard = [
-        [InlineKeyboardButton("Эконом - 100$", callback_data='economy')],
-        [InlineKeyboardButton("Стандарт - 200$", callback_data='default')],
-        [InlineKeyboardButton("♂dungeon master♂ - 300$", callback_data='vip')],
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.handle_subscribe
-
-
-def show_client_task(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    data = query.data
-    context.user_data['current_task'] = int(data)
-    task = Task.objects.get(id=int(data))
-    worker = task.worker
-    message = f'Заказ №{task.id}\n\n{task.task}'
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-        [InlineKeyboardButton("Написать в поддержку", callback_data=str(Transitions.support_message))],
-    ]
-    if worker:
-        message += f"Над вашим заказом работает {worker.name} Вы в любой момент можете связаться с ним"
-        keyboard.append([InlineKeyboardButton("Написать исполнителю", callback_data=str(Transitions.message))],)
-    if task.status == 'WAIT_CONFIRM':
-        keyboard.append([InlineKeyboardButton("Подтвердить выполнение", callback_data=str(Transitions.confirm))], )
-    if task.status == 'DONE':
-        message += '\n\nВы подтвердили выполнение'
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.show_client_tasks
-
-
-def create_message(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    message = 'Введите ваше сообщение текстом:'
-    query.message.reply_text(
-        text=message,
-    )
-    return States.handle_message
-
-
-def handle_message(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    user_message = update.message.text
-    context.user_data['message'] = user_message
-    message = f'Ваше сообщение:\n {user_message}\nДоставлено'
-    user = User.objects.get(tg_id=chat_id)
-    task = Task.objects.get(id=context.user_data['current_task'])
-    if user.role == 'CL':
-        recipient_id = task.client.tg_id
-        Message.objects.create(task_message=task, first_person=user, text=user_message, created_at=timezone.now())
-        context.bot.send_message(
-            recipient_id,
-            text=f'Сообщение от Исполниеля по вашему заказу №{task.id}:\n {user_message}',
-        )
-        keyboard = [
-            [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-        ]
-    elif user.role == 'WK':
-        recipient_id = task.worker.tg_id
-        Message.objects.create(task_message=task, second_person=user, text=user_message, created_at=timezone.now())
-        context.bot.send_message(
-            recipient_id,
-            text=f'Сообщение от Заказчика по вашему заказу №{task.id}:\n {user_message}',
-        )
-        keyboard = [
-            [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-        ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(
-        chat_id,
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.handle_message
-
-
-def create_support_message(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    message = 'Введите причину вашего обращения в поддержку и ваше сообщение текстом:'
-    query.message.reply_text(
-        text=message,
-    )
-    return States.handle_support_message
-
-
-def handle_support_message(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    user_message = update.message.text
-    context.user_data['message'] = user_message
-    message = f'Ваше сообщение:\n {user_message}\nДоставлено в поддержку.'
-    user = User.objects.get(tg_id=chat_id)
-    task = Task.objects.get(id=context.user_data['current_task'])
-    Support.objects.create(user=user, task=task, created_at=timezone.now(), text=user_message)
-    if user.role == 'CL':
-        keyboard = [
-            [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-        ]
-    elif user.role == 'WK':
-        keyboard = [
-            [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-        ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(
-        chat_id,
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.handle_support_message
-
-
-def show_available_tasks(update: Update, context: CallbackContext) -> int:
-    """Показывает доступные задачи"""
-    user_id = update.effective_user.id
-    tasks = Task.objects.filter(status="WAIT")
-
-    query = update.callback_query
-    query.answer()
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    if len(tasks):
-        message = "Выберите задачи"
-        for task in tasks:
-            message += f'Заказ №{task.id}, {task.task[:30]}\n\n'
-            keyboard.append([InlineKeyboardButton(f"К заказу {task.id}", callback_data=str(task.id))])
-    else:
-        message = "Нам очень жаль, но на данный момент задачи отсутствуют"
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.show_worker_tasks
-
-
-def show_worker_tasks(update: Update, context: CallbackContext) -> int:
-    """Показывает задачи, которые исполнитель уже принял"""
-    user_id = update.effective_user.id
-    tasks_in_work = User.objects.get(tg_id=user_id).worker_tasks.all()
-    query = update.callback_query
-    query.answer()
-
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    if len(tasks_in_work):
-        message = "Ваши задачи:\n\n"
-        for task in tasks_in_work:
-            message += f'Заказ №{task.id}, {task.task[:30]}\n\n'
-            keyboard.append([InlineKeyboardButton(f"К заказу {task.id}", callback_data=str(task.id))])
-    else:
-        message = "Нам очень жаль, но на данный момент задачи отсутствуют"
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.show_worker_tasks
-
-
-def show_worker_task(update: Update, context: CallbackContext) -> int:
-    """Показывает задачу по id, если задача взята, дает связаться с заказчиком, иначе дает принять задачу"""
-    chat_id = update.effective_chat.id
-    query = update.callback_query
-    query.answer()
-    data = query.data
-    task = Task.objects.get(id=int(data))
-    context.user_data['current_task'] = int(data)
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    try:
-        worker_id = task.worker.tg_id
-    except AttributeError:
-        worker_id = None
-    if worker_id == chat_id:
-
-        context.user_data['current_task'] = int(data)
-        message = f'Заказ №{task.id}\n\n{task.task}\n'
-        keyboard.append([InlineKeyboardButton("Написать заказчику", callback_data=str(Transitions.message))],)
-        keyboard.append([InlineKeyboardButton("Написать в поддержку", callback_data=str(Transitions.support_message))],)
-        if task.status == 'WAIT_CONFIRM':
-            message += '\nОжидает принятия заказчиком'
-        else:
-            keyboard.append([InlineKeyboardButton("Сдать задачу", callback_data=str(Transitions.confirm))], )
-        if task.status == 'DONE':
-            message += '\nЗаказчик подтвердил выполнение'
-    else:
-        context.user_data['current_task'] = int(data)
-        message = f'Заказ №{task.id}\n\n{task.task}\n'
-        message += 'За выполнение заказа вы получите 0$'
-        keyboard.append([InlineKeyboardButton("Взять заказ", callback_data=str(Transitions.take))])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.show_worker_tasks
-
-
-def client_confirm(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    task = Task.objects.get(id=context.user_data['current_task'])
-    message = f'Вы подтверждаете выполнение задачи №{task.id}'
-    keyboard = [
-        [InlineKeyboardButton("Подтвердить", callback_data=str(Transitions.confirm))],
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.client_confirm
-
-
-def client_confirm_task(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    task = Task.objects.get(id=context.user_data['current_task'])
-    task.status = 'DONE'
-    task.save()
-    message = f'Вы подтвердили выполнение задачи №{task.id}'
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.client))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.client_confirm
-
-
-def worker_confirm(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    task = Task.objects.get(id=context.user_data['current_task'])
-    message = f'Отправьте результат выполнения задачи №{task.id} текстом'
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.worker_confirm
-
-
-def worker_confirm_task(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    try:
-        text = update.message.text
-    except AttributeError:
-        text = None
-    if text:
-        task = Task.objects.get(id=context.user_data['current_task'])
-        task.task += f'\nЗадача выполнена:\n{text}'
-        task.status = 'WAIT_CONFIRM'
-        task.save()
-        message = f'Вы подтвердили выполнение задачи №{task.id}\n Ожидаем подтверждения заказчиком'
-
-    else:
-        message = "Попробуйте снова"
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(
-        chat_id,
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.worker_confirm
-
-
-def get_deadline(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    try:
-        raw_date = update.message.text
-    except AttributeError:
-        raw_date = None
-    if raw_date:
-        try:
-            date = datetime.datetime.strptime(raw_date, "%d.%m.%y")
-            context.user_data["end_date"] = date
-            message = dedent(
-                f'''
-                Необходимо выполнить этот заказ до {raw_date},
-                Подтвердите принятие заказа
-                '''
-            )
-            keyboard = [
-                [InlineKeyboardButton("Подтвердить", callback_data=str(Transitions.take))],
-                [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            context.bot.send_message(
-                chat_id,
-                text=message,
-                reply_markup=reply_markup,
-            )
-            return States.work_choose
-        except:
-            message = "Неверная дата.\n Введите дату в формате дд.мм.гг"
-    else:
-        message = "Введите дату окончания работы в формате дд.мм.гг"
-    context.bot.send_message(
-        chat_id,
-        text=message,
-    )
-    return States.show_worker_tasks
-
-
-def take_work(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    task_id = context.user_data['current_task']
-    query = update.callback_query
-    query.answer()
-
-    user = User.objects.get(tg_id=chat_id)
-    task = Task.objects.get(id=task_id)
-    task.worker = user
-    task.status = task.Proc.IN_WORK
-    task.end_at = context.user_data["end_date"]
-    task.save()
-    keyboard = [
-        [InlineKeyboardButton("К задаче", callback_data=str(task_id))],
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text="Теперь вы можете связаться с заказчиком и задать ему уточняющие вопросы",
-        reply_markup=reply_markup,
-    )
-    return States.show_worker_tasks
-
-
-def show_unaccepted(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    tasks = Task.objects.filter(status="WAIT")
-    message = f'Непринятые задачи найдены\n\n'
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.manager))],
-    ]
-    for task in tasks:
-        message += f'Заказ №{task.id}, {task.task[:30]}\n\n'
-        keyboard.append([InlineKeyboardButton(f"К заказу {task.id}", callback_data=str(task.id))])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(
-        chat_id,
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.manager
-
-
-def show_task_details(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    data = query.data
-    task = Task.objects.get(id=int(data))
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    context.user_data['current_task'] = int(data)
-    message = dedent(f'''Заказ №{task.id}\n\n{task.task}
-        Заказчик: {task.client.name}
-        id_заказчика: {task.client.tg_id}
-        Создана: {task.created_at}
-    ''')
-    if task.worker:
-        message += f'Исполнитель: {task.worker}\nid_исполнителя: {task.worker.tg_id}\nдолжен завершить: {task.end_at}'
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.show_worker_tasks
-
-
-def show_support_messages(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    query.answer()
-    messages = Support.objects.all().order_by('-created_at')
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.worker))],
-    ]
-    message = 'Обращения в поддержку:'.join([f'Заказ №{support_message.task.id} {support_message.text[:30]}' for support_message in messages])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.show_worker_tasks
-
-
-def show_expired(update: Update, context: CallbackContext) -> int:
-    chat_id = update.effective_chat.id
-    tasks = Task.objects.filter(end_at__lte=timezone.now())
-    message = f'Задачи с истекшим дедлайном:\n\n'
-    keyboard = [
-        [InlineKeyboardButton("В меню", callback_data=str(Transitions.manager))],
-    ]
-    for task in tasks:
-        message += f'Заказ №{task.id}, {task.task[:30]}\n\n'
-        keyboard.append([InlineKeyboardButton(f"К заказу {task.id}", callback_data=str(task.id))])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(
-        chat_id,
-        text=message,
-        reply_markup=reply_markup,
-    )
-    return States.manager
+    def handle(self, *args, **kwargs):
+        persistence = build_persistence()
+        updater = build_updater(kwargs['workers'], persistence)
 
+        if kwargs['webhook']:
+            self.set_webhook(updater.bot)
+            return
 
-def cancel(update: Update, context: CallbackContext) -> int:
-    update.message.reply_text(
-        'Надеюсь тебе понравился наш бот!'
-    )
+        setup_dispatcher(updater.dispatcher)
+        if kwargs['metrics_port']:
+            serve_metrics(kwargs['metrics_port'])
 
-    return ConversationHandler.END
+        updater.start_polling()
+        updater.idle()
+        stop_dispatcher(updater.dispatcher)
+
+    def set_webhook(self, bot):
+        if not settings.TG_WEBHOOK_URL or not settings.TG_WEBHOOK_SECRET:
+            self.stderr.write('Для работы через вебхук задайте TG_WEBHOOK_URL и TG_WEBHOOK_SECRET')
+            return
+        bot.set_webhook(
+            url=settings.TG_WEBHOOK_URL,
+            secret_token=settings.TG_WEBHOOK_SECRET,
+            max_connections=settings.TG_WEBHOOK_MAX_CONNECTIONS,
+        )
+        self.stdout.write(f'Вебхук установлен: {settings.TG_WEBHOOK_URL}')
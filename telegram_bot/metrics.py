@@ -0,0 +1,247 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from django.db import close_old_connections
+from django.db.models import Count
+from telegram.error import TelegramError
+from telegram.utils.request import Request
+
+from telegram_bot.models import ConversationState
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+class Metric:
+    """Метрика, значения которой каждый поток пишет в свой словарь.
+
+    Запись не берет блокировок: блокировка нужна только при первом обращении нового потока
+    и при сборе значений, который суммирует словари всех потоков.
+    """
+    type = None
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _collect_shards(self):
+        with self._lock:
+            shards = list(self._shards)
+        return [dict(shard) for shard in shards]
+
+    def clear(self):
+        with self._lock:
+            for shard in self._shards:
+                shard.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, value=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + value
+
+    def collect(self):
+        totals = {}
+        for shard in self._collect_shards():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        for labels, value in sorted(totals.items()):
+            yield self.name, dict(zip(self.labels, labels)), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, *labels, value):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # Счетчики по корзинам, затем корзина +Inf, сумма и количество
+            counts = shard[labels] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def collect(self):
+        totals = {}
+        for shard in self._collect_shards():
+            for labels, counts in shard.items():
+                total = totals.setdefault(labels, [0] * len(counts))
+                for position, count in enumerate(list(counts)):
+                    total[position] += count
+        for labels, counts in sorted(totals.items()):
+            label_values = dict(zip(self.labels, labels))
+            cumulative = 0
+            for bucket, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', {**label_values, 'le': str(bucket)}, cumulative
+            yield f'{self.name}_sum', label_values, counts[-2]
+            yield f'{self.name}_count', label_values, counts[-1]
+
+
+class Gauge(Metric):
+    """Значение, которое вычисляется в момент сбора метрик"""
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, labels=(), callback: Callable[[], dict] = None):
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def collect(self):
+        if self.callback is None:
+            return
+        for labels, value in sorted(self.callback().items()):
+            yield self.name, dict(zip(self.labels, labels)), value
+
+
+updates = Counter(
+    'telegram_updates_total',
+    'Обновления, обработанные обработчиком в состоянии диалога',
+    ('handler', 'state'),
+)
+update_errors = Counter(
+    'telegram_update_errors_total',
+    'Обновления, при обработке которых возникло исключение',
+    ('handler', 'state'),
+)
+slow_updates = Counter(
+    'telegram_slow_updates_total',
+    'Обновления, обработка которых превысила бюджет по времени или запросам',
+    ('handler', 'state'),
+)
+update_duration = Histogram(
+    'telegram_update_duration_seconds',
+    'Время обработки обновления',
+    ('handler', 'state'),
+)
+db_queries = Counter(
+    'telegram_db_queries_total',
+    'Запросы к базе при обработке обновлений',
+    ('handler', 'state'),
+)
+db_query_duration = Counter(
+    'telegram_db_query_seconds_total',
+    'Время запросов к базе при обработке обновлений',
+    ('handler', 'state'),
+)
+api_requests = Counter(
+    'telegram_api_requests_total',
+    'Запросы к Bot API',
+    ('method',),
+)
+api_errors = Counter(
+    'telegram_api_errors_total',
+    'Ошибки запросов к Bot API',
+    ('method', 'error'),
+)
+api_duration = Histogram(
+    'telegram_api_duration_seconds',
+    'Время запроса к Bot API',
+    ('method',),
+)
+outbox_depth = Gauge(
+    'telegram_outbox_depth',
+    'Сообщения, ожидающие отправки в очереди исходящих',
+)
+
+
+def count_active_conversations():
+    states = (
+        ConversationState.objects
+        .exclude(state='')
+        .values_list('state')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    return {(state,): count for state, count in states}
+
+
+active_conversations = Gauge(
+    'telegram_active_conversations',
+    'Диалоги по текущему состоянию',
+    ('state',),
+    callback=count_active_conversations,
+)
+
+
+class InstrumentedRequest(Request):
+    """Request, который считает запросы к Bot API и ошибки по методам"""
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        started_at = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except TelegramError as error:
+            api_errors.inc(method, type(error).__name__)
+            raise
+        finally:
+            api_requests.inc(method)
+            api_duration.observe(method, value=time.perf_counter() - started_at)
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_sample(name, labels, value) -> str:
+    if labels:
+        labels = ','.join(f'{label}="{escape_label(label_value)}"' for label, label_value in labels.items())
+        name = f'{name}{{{labels}}}'
+    return f'{name} {value}'
+
+
+def render_metrics() -> str:
+    """Метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(format_sample(*sample) for sample in metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        close_old_connections()
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int, host: str = '') -> ThreadingHTTPServer:
+    """Отдает метрики процесса бота при работе через long polling, где нет Django-сервера"""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
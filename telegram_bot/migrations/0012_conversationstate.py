@@ -0,0 +1,27 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0011_alter_task_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tg_id', models.BigIntegerField(unique=True, verbose_name='Telegram ID юзера')),
+                ('state', models.CharField(blank=True, max_length=50, verbose_name='Состояние диалога')),
+                ('user_data', models.BinaryField(blank=True, null=True, verbose_name='Данные диалога')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Состояние диалога',
+                'verbose_name_plural': 'Состояния диалогов',
+            },
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:17
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def merge_duplicate_users(apps, schema_editor):
+    """Перед уникальным индексом на tg_id сливает дубли пользователей, созданные гонкой при регистрации.
+
+    Остается самая ранняя запись, ссылки остальных таблиц переводятся на нее, лишние записи удаляются.
+    """
+    User = apps.get_model('telegram_bot', 'User')
+    duplicates = (
+        User.objects
+        .values('tg_id')
+        .annotate(count=Count('id'), keep_id=Min('id'))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    relations = [
+        relation for relation in User._meta.related_objects
+        if relation.one_to_many or relation.one_to_one
+    ]
+    for duplicate in duplicates:
+        extra_ids = list(
+            User.objects
+            .filter(tg_id=duplicate['tg_id'])
+            .exclude(id=duplicate['keep_id'])
+            .values_list('id', flat=True)
+        )
+        for relation in relations:
+            field_name = relation.field.name
+            relation.related_model.objects.filter(**{f'{field_name}__in': extra_ids}).update(
+                **{field_name: duplicate['keep_id']},
+            )
+        User.objects.filter(id__in=extra_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0012_conversationstate'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_users, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='tg_id',
+            field=models.BigIntegerField(unique=True, verbose_name='Telegram ID юзера'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['task_message', 'created_at'], name='message_task_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='support',
+            index=models.Index(fields=['task', 'created_at'], name='support_task_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='support',
+            index=models.Index(fields=['created_at'], name='support_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status', 'created_at'], name='task_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['client', 'created_at'], name='task_client_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['worker', 'created_at'], name='task_worker_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['end_at'], name='task_end_at_idx'),
+        ),
+    ]
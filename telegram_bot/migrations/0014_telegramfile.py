@@ -0,0 +1,26 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0013_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True, verbose_name='SHA-256 содержимого')),
+                ('file_id', models.CharField(max_length=255, verbose_name='file_id в Telegram')),
+                ('uploaded_at', models.DateTimeField(auto_now=True, verbose_name='Загружен')),
+            ],
+            options={
+                'verbose_name': 'Загруженный файл',
+                'verbose_name_plural': 'Загруженные файлы',
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0014_telegramfile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskBroadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_user_id', models.BigIntegerField(default=0, verbose_name='Последний оповещенный исполнитель')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='Занята обработчиком до')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершена')),
+            ],
+            options={
+                'verbose_name': 'Рассылка о задаче',
+                'verbose_name_plural': 'Рассылки о задачах',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['role', 'id'], name='user_role_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='taskbroadcast',
+            name='task',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='broadcast', to='telegram_bot.task', verbose_name='Задача'),
+        ),
+        migrations.AddIndex(
+            model_name='taskbroadcast',
+            index=models.Index(condition=models.Q(('finished_at__isnull', True)), fields=['created_at'], name='broadcast_unfinished_idx'),
+        ),
+    ]
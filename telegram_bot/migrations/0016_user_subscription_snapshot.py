@@ -0,0 +1,52 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:24
+
+from django.db import migrations, models
+from django.utils import timezone
+
+LEVELS_BY_LABEL = {
+    'Экономный': 'ECO',
+    'Стандарт': 'DEFAULT',
+    'ВИП': 'VIP',
+}
+
+
+def fill_subscription_snapshot(apps, schema_editor):
+    Subscription = apps.get_model('telegram_bot', 'Subscription')
+    User = apps.get_model('telegram_bot', 'User')
+    for label, lvl in LEVELS_BY_LABEL.items():
+        Subscription.objects.filter(lvl=label).update(lvl=lvl)
+
+    now = timezone.now()
+    active = Subscription.objects.filter(starts_at__lte=now, end_at__gt=now).exclude(lvl='NA').order_by('user_id', 'end_at')
+    for subscription in active.iterator():
+        User.objects.filter(pk=subscription.user_id).update(
+            subscription_lvl=subscription.lvl,
+            subscription_starts_at=subscription.starts_at,
+            subscription_end_at=subscription.end_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0015_taskbroadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='subscription_end_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Конец текущей подписки'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='subscription_lvl',
+            field=models.CharField(default='NA', editable=False, max_length=50, verbose_name='Текущая подписка'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='subscription_starts_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Начало текущей подписки'),
+        ),
+        migrations.RunPython(fill_subscription_snapshot, migrations.RunPython.noop),
+    ]
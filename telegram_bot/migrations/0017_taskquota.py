@@ -0,0 +1,31 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0016_user_subscription_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_starts_at', models.DateTimeField(verbose_name='Начало оплаченного периода')),
+                ('used', models.PositiveIntegerField(default=0, verbose_name='Создано задач')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_quotas', to='telegram_bot.user', verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Лимит задач',
+                'verbose_name_plural': 'Лимиты задач',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='taskquota',
+            constraint=models.UniqueConstraint(fields=('user', 'period_starts_at'), name='task_quota_user_period_uniq'),
+        ),
+    ]
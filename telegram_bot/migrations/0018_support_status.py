@@ -0,0 +1,22 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0017_taskquota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='support',
+            name='status',
+            field=models.CharField(choices=[('NEW', 'Новое'), ('HANDLED', 'Обработано')], default='NEW', max_length=50, verbose_name='Статус'),
+        ),
+        migrations.AddIndex(
+            model_name='support',
+            index=models.Index(condition=models.Q(('status', 'NEW')), fields=['created_at', 'id'], name='support_new_created_idx'),
+        ),
+    ]
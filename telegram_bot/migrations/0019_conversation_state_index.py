@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0018_support_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationstate',
+            index=models.Index(fields=['state'], name='conversation_state_idx'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+from django.db import migrations
+
+# Полнотекстовый индекс FTS5 по тексту задач, который триггеры обновляют при любом
+# изменении таблицы задач, в том числе через update() и bulk_create.
+# Django пересоздает таблицу SQLite при некоторых изменениях схемы и теряет при этом триггеры,
+# поэтому такие миграции модели Task должны заново выполнить CREATE_TRIGGERS.
+
+CREATE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS telegram_bot_task_search_insert AFTER INSERT ON telegram_bot_task BEGIN
+        INSERT INTO telegram_bot_task_search(rowid, task) VALUES (new.id, new.task);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS telegram_bot_task_search_delete AFTER DELETE ON telegram_bot_task BEGIN
+        INSERT INTO telegram_bot_task_search(telegram_bot_task_search, rowid, task) VALUES ('delete', old.id, old.task);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS telegram_bot_task_search_update AFTER UPDATE OF task ON telegram_bot_task BEGIN
+        INSERT INTO telegram_bot_task_search(telegram_bot_task_search, rowid, task) VALUES ('delete', old.id, old.task);
+        INSERT INTO telegram_bot_task_search(rowid, task) VALUES (new.id, new.task);
+    END
+    """,
+]
+
+CREATE_SEARCH = [
+    """
+    CREATE VIRTUAL TABLE telegram_bot_task_search USING fts5(
+        task,
+        content='telegram_bot_task',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    *CREATE_TRIGGERS,
+    "INSERT INTO telegram_bot_task_search(telegram_bot_task_search) VALUES ('rebuild')",
+]
+
+DROP_SEARCH = [
+    'DROP TRIGGER IF EXISTS telegram_bot_task_search_insert',
+    'DROP TRIGGER IF EXISTS telegram_bot_task_search_delete',
+    'DROP TRIGGER IF EXISTS telegram_bot_task_search_update',
+    'DROP TABLE IF EXISTS telegram_bot_task_search',
+]
+
+
+def execute_on_sqlite(statements):
+    def execute(apps, schema_editor):
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return execute
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0019_conversation_state_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(execute_on_sqlite(CREATE_SEARCH), execute_on_sqlite(DROP_SEARCH)),
+    ]
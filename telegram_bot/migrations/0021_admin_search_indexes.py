@@ -0,0 +1,67 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:47
+
+import re
+
+from django.db import migrations, models
+
+
+# Копии функций из telegram_bot.models на момент миграции: их дальнейшие изменения не должны менять ее результат
+def normalize_name(name):
+    return ' '.join(str(name).casefold().replace('ё', 'е').split())
+
+
+def normalize_phone(phone):
+    digits = re.sub(r'\D', '', str(phone or ''))
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = f'7{digits[1:]}'
+    return digits
+
+
+def fill_search_fields(apps, schema_editor):
+    User = apps.get_model('telegram_bot', 'User')
+    users = list(User.objects.only('id', 'name', 'phonenumber'))
+    for user in users:
+        user.name_search = normalize_name(user.name)
+        user.phone_search = normalize_phone(user.phonenumber)
+    User.objects.bulk_update(users, ['name_search', 'phone_search'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0020_task_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='name_search',
+            field=models.CharField(default='', editable=False, max_length=50, verbose_name='Имя для поиска'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_search',
+            field=models.CharField(default='', editable=False, max_length=20, verbose_name='Номер для поиска'),
+        ),
+        migrations.RunPython(fill_search_fields, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created_at'], name='message_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['created_at'], name='task_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['name_search'], name='user_name_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['phone_search'], name='user_phone_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['role', 'name_search'], name='user_role_name_search_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:20
+
+from django.db import migrations, models
+from django.db.models import Min, Q
+from django.utils import timezone
+
+
+def fill_subscription_changes_at(apps, schema_editor):
+    Subscription = apps.get_model('telegram_bot', 'Subscription')
+    User = apps.get_model('telegram_bot', 'User')
+    now = timezone.now()
+    boundaries = (
+        Subscription.objects
+        .exclude(lvl='NA')
+        .values('user_id')
+        .annotate(
+            next_start=Min('starts_at', filter=Q(starts_at__gt=now)),
+            next_end=Min('end_at', filter=Q(end_at__gt=now)),
+        )
+        .order_by()
+    )
+    for row in boundaries.iterator():
+        changes_at = min(filter(None, (row['next_start'], row['next_end'])), default=None)
+        if changes_at is not None:
+            User.objects.filter(pk=row['user_id']).update(subscription_changes_at=changes_at)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0021_admin_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='subscription_changes_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Ближайшее изменение подписки'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['subscription_changes_at'], name='user_subscription_changes_idx'),
+        ),
+        migrations.RunPython(fill_subscription_changes_at, migrations.RunPython.noop),
+    ]
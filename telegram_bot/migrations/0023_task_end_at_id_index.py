@@ -0,0 +1,21 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0022_subscription_changes_at'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='task',
+            name='task_end_at_idx',
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['end_at', 'id'], name='task_end_at_id_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0023_task_end_at_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationstate',
+            name='written_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Последняя запись чата в базу'),
+        ),
+    ]
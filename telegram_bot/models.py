@@ -1,7 +1,25 @@
-from django.db import models
+import re
+
+from django.db import connections, models
+from django.utils import timezone
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Substr
 from phonenumber_field.modelfields import PhoneNumberField
 
 
+def normalize_name(name: str) -> str:
+    """Имя для поиска: без учета регистра, буквы ё и лишних пробелов"""
+    return ' '.join(str(name).casefold().replace('ё', 'е').split())
+
+
+def normalize_phone(phone) -> str:
+    """Номер для поиска: только цифры, российский номер с 8 приводится к 7"""
+    digits = re.sub(r'\D', '', str(phone or ''))
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = f'7{digits[1:]}'
+    return digits
+
+
 class User(models.Model):
     class UserRole(models.TextChoices):
         CLIENT = "CL", "Клиент"
@@ -21,17 +39,67 @@ class User(models.Model):
         default=UserRole.CLIENT,
     )
 
-    tg_id = models.IntegerField('Telegram ID юзера')
+    tg_id = models.BigIntegerField('Telegram ID юзера', unique=True)
     phonenumber = PhoneNumberField('Контактный номер', region="RU", )
 
+    # Заполняются в save() для индексированного поиска в админке
+    name_search = models.CharField('Имя для поиска', max_length=50, default='', editable=False)
+    phone_search = models.CharField('Номер для поиска', max_length=20, default='', editable=False)
+
+    subscription_lvl = models.CharField(
+        'Текущая подписка',
+        max_length=50,
+        default='NA',
+        editable=False,
+    )
+    subscription_starts_at = models.DateTimeField(
+        'Начало текущей подписки',
+        null=True,
+        editable=False,
+    )
+    subscription_end_at = models.DateTimeField(
+        'Конец текущей подписки',
+        null=True,
+        editable=False,
+    )
+    # Конец текущей или начало следующей подписки: по нему фоновая задача находит, кого пересчитать
+    subscription_changes_at = models.DateTimeField(
+        'Ближайшее изменение подписки',
+        null=True,
+        editable=False,
+    )
+
     class Meta:
         ordering = ['name']
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            models.Index(fields=['role', 'id'], name='user_role_id_idx'),
+            models.Index(fields=['name_search'], name='user_name_search_idx'),
+            models.Index(fields=['phone_search'], name='user_phone_search_idx'),
+            models.Index(fields=['role', 'name_search'], name='user_role_name_search_idx'),
+            models.Index(fields=['subscription_changes_at'], name='user_subscription_changes_idx'),
+        ]
 
     def __str__(self):
         return f"{self.phonenumber}"
 
+    def save(self, *args, **kwargs):
+        self.name_search = normalize_name(self.name)
+        self.phone_search = normalize_phone(self.phonenumber)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'name_search', 'phone_search'}
+        super().save(*args, **kwargs)
+
+    @property
+    def has_active_subscription(self):
+        return has_active_subscription(self.subscription_lvl, self.subscription_end_at)
+
+
+def has_active_subscription(lvl, end_at):
+    return lvl != Subscription.SubscriptionLevel.NOT_ACTIVE and end_at is not None and end_at > timezone.now()
+
 
 class Subscription(models.Model):
     class SubscriptionLevel(models.TextChoices):
@@ -64,6 +132,68 @@ class Subscription(models.Model):
         return f"{self.user} - {self.lvl}"
 
 
+TASK_LIMITS = {
+    Subscription.SubscriptionLevel.ECONOMY: 5,
+    Subscription.SubscriptionLevel.DEFAULT: 15,
+    Subscription.SubscriptionLevel.VIP: 60,
+}
+
+
+class TaskQuota(models.Model):
+    """Сколько задач клиент создал за оплаченный период подписки"""
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        related_name='task_quotas',
+        on_delete=models.CASCADE,
+    )
+    period_starts_at = models.DateTimeField('Начало оплаченного периода')
+    used = models.PositiveIntegerField('Создано задач', default=0)
+
+    class Meta:
+        verbose_name = 'Лимит задач'
+        verbose_name_plural = 'Лимиты задач'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'period_starts_at'], name='task_quota_user_period_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.period_starts_at} {self.used}"
+
+
+TASK_SEARCH_TABLE = 'telegram_bot_task_search'
+
+
+def build_search_query(text: str, max_words: int = 10) -> str:
+    """Запрос FTS5 из введенного текста: все слова, каждое как префикс.
+
+    Слова берутся в кавычки, поэтому операторы и спецсимволы FTS5 во вводе не работают.
+    """
+    words = re.findall(r'\w+', text.lower())[:max_words]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class TaskQuerySet(models.QuerySet):
+    def previews(self, length=30):
+        """Только поля для списков и начало текста задачи, обрезанное на стороне базы"""
+        return self.only('id', 'status', 'created_at', 'end_at').annotate(preview=Substr('task', 1, length))
+
+    def search(self, text: str):
+        """Задачи, текст которых содержит все слова из text, по полнотекстовому индексу.
+
+        На базах без FTS5 индекса ищет через icontains.
+        """
+        query = build_search_query(text)
+        if not query:
+            return self.none()
+        if connections[self.db].vendor != 'sqlite':
+            return self.filter(task__icontains=text)
+        return self.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {TASK_SEARCH_TABLE} WHERE {TASK_SEARCH_TABLE} MATCH %s',
+            (query,),
+        ))
+
+
 class Task(models.Model):
     class Proc(models.TextChoices):
         WAITING = "WAIT", "Ожидает принятия"
@@ -101,10 +231,19 @@ class Task(models.Model):
         null=True,
     )
 
+    objects = TaskQuerySet.as_manager()
+
     class Meta:
         ordering = ['created_at']
         verbose_name = 'Задание'
         verbose_name_plural = 'Задания'
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='task_status_created_idx'),
+            models.Index(fields=['client', 'created_at'], name='task_client_created_idx'),
+            models.Index(fields=['worker', 'created_at'], name='task_worker_created_idx'),
+            models.Index(fields=['end_at', 'id'], name='task_end_at_id_idx'),
+            models.Index(fields=['created_at'], name='task_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.client} {self.task} {self.status}"
@@ -141,12 +280,31 @@ class Message(models.Model):
         ordering = ['created_at']
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
+        indexes = [
+            models.Index(fields=['task_message', 'created_at'], name='message_task_created_idx'),
+            models.Index(fields=['created_at'], name='message_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.first_person} {self.second_person} {self.task_message}"
 
 
+class SupportQuerySet(models.QuerySet):
+    def inbox(self, length=30):
+        """Необработанные обращения с именем отправителя и началом текста для списка менеджера"""
+        return (
+            self.filter(status=Support.Status.NEW)
+            .select_related('user')
+            .only('id', 'task', 'created_at', 'user__name')
+            .annotate(preview=Substr('text', 1, length))
+        )
+
+
 class Support(models.Model):
+    class Status(models.TextChoices):
+        NEW = "NEW", "Новое"
+        HANDLED = "HANDLED", "Обработано"
+
     user = models.ForeignKey(
         User,
         verbose_name='Отправитель',
@@ -164,11 +322,96 @@ class Support(models.Model):
     )
     created_at = models.DateTimeField('Дата отправки')
     text = models.TextField('Сообщение')
+    status = models.CharField(
+        'Статус',
+        max_length=50,
+        choices=Status.choices,
+        default=Status.NEW,
+    )
+
+    objects = SupportQuerySet.as_manager()
 
     class Meta:
         ordering = ['created_at']
         verbose_name = 'Поддержка'
         verbose_name_plural = 'Поддержка'
+        indexes = [
+            models.Index(fields=['task', 'created_at'], name='support_task_created_idx'),
+            models.Index(fields=['created_at'], name='support_created_idx'),
+            models.Index(
+                fields=['created_at', 'id'],
+                name='support_new_created_idx',
+                condition=models.Q(status='NEW'),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user} {self.task} {self.created_at}"
+
+
+class ConversationState(models.Model):
+    tg_id = models.BigIntegerField('Telegram ID юзера', unique=True)
+    state = models.CharField(
+        'Состояние диалога',
+        max_length=50,
+        blank=True,
+    )
+    user_data = models.BinaryField(
+        'Данные диалога',
+        null=True,
+        blank=True,
+    )
+    updated_at = models.DateTimeField('Обновлено', auto_now=True)
+    # Процессы вебхука по нему оставляют чтения чата на основной базе, пока реплика может отставать
+    written_at = models.DateTimeField('Последняя запись чата в базу', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Состояние диалога'
+        verbose_name_plural = 'Состояния диалогов'
+        indexes = [
+            models.Index(fields=['state'], name='conversation_state_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.tg_id} {self.state}"
+
+
+class TelegramFile(models.Model):
+    sha256 = models.CharField('SHA-256 содержимого', max_length=64, unique=True)
+    file_id = models.CharField('file_id в Telegram', max_length=255)
+    uploaded_at = models.DateTimeField('Загружен', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Загруженный файл'
+        verbose_name_plural = 'Загруженные файлы'
+
+    def __str__(self):
+        return self.sha256
+
+
+
+class TaskBroadcast(models.Model):
+    task = models.OneToOneField(
+        Task,
+        verbose_name='Задача',
+        related_name='broadcast',
+        on_delete=models.CASCADE,
+    )
+    last_user_id = models.BigIntegerField('Последний оповещенный исполнитель', default=0)
+    locked_until = models.DateTimeField('Занята обработчиком до', null=True, blank=True)
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+    finished_at = models.DateTimeField('Завершена', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Рассылка о задаче'
+        verbose_name_plural = 'Рассылки о задачах'
+        indexes = [
+            models.Index(
+                fields=['created_at'],
+                name='broadcast_unfinished_idx',
+                condition=models.Q(finished_at__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.task_id} {self.last_user_id}"
@@ -0,0 +1,147 @@
+import logging
+import queue
+import threading
+
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from telegram_bot.models import Task, TaskBroadcast, User
+from telegram_bot.outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+
+def create_task_with_broadcast(**fields) -> Task:
+    """Создает задачу вместе с записью о рассылке, чтобы рассылка не потерялась при падении процесса"""
+    with transaction.atomic():
+        task = Task.objects.create(**fields)
+        TaskBroadcast.objects.create(task=task)
+    return task
+
+
+class TaskBroadcaster:
+    """Оповещает исполнителей о новых задачах.
+
+    Исполнители выбираются по индексу (role, id) порциями по chunk_size.
+    После отправки каждой порции в базе сохраняется id последнего исполнителя,
+    поэтому после перезапуска рассылка продолжается с того же места.
+    Рассылку одновременно ведет только один процесс: он продлевает аренду locked_until.
+    Раз в rescan_interval секунд простоя незавершенные рассылки без действующей аренды снова ставятся в очередь,
+    поэтому рассылка процесса, упавшего с неистекшей арендой, продолжится, как только аренда истечет.
+    """
+
+    def __init__(
+            self,
+            outbox: Outbox,
+            chunk_size: int = 100,
+            rate: float = 20,
+            lease: float = 300,
+            rescan_interval: float = 60,
+    ):
+        self.outbox = outbox
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self.lease = timezone.timedelta(seconds=lease)
+        self.rescan_interval = rescan_interval
+        self._broadcasts = queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.rescan()
+        self._thread = threading.Thread(target=self._run, name='task-broadcaster', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._broadcasts.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def rescan(self):
+        """Ставит в очередь незавершенные рассылки, которые сейчас никто не ведет"""
+        unfinished = TaskBroadcast.objects.filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lt=timezone.now()),
+            finished_at__isnull=True,
+        ).order_by('created_at')
+        for broadcast_id in unfinished.values_list('id', flat=True):
+            self._broadcasts.put(broadcast_id)
+
+    def notify(self, task: Task):
+        self._broadcasts.put(task.broadcast.id)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                broadcast_id = self._broadcasts.get(timeout=self.rescan_interval)
+            except queue.Empty:
+                close_old_connections()
+                try:
+                    self.rescan()
+                except Exception:
+                    logger.exception('Не удалось найти незавершенные рассылки')
+                continue
+            if broadcast_id is None:
+                return
+            close_old_connections()
+            try:
+                self.run_broadcast(broadcast_id)
+            except Exception:
+                logger.exception('Рассылка %s прервана', broadcast_id)
+
+    def _claim(self, broadcast_id) -> bool:
+        now = timezone.now()
+        claimed = TaskBroadcast.objects.filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+            id=broadcast_id,
+            finished_at__isnull=True,
+        ).update(locked_until=now + self.lease)
+        return bool(claimed)
+
+    def run_broadcast(self, broadcast_id):
+        if not self._claim(broadcast_id):
+            return
+        broadcast = TaskBroadcast.objects.get(id=broadcast_id)
+        task = Task.objects.previews(length=100).get(id=broadcast.task_id)
+        text = f'Появилась новая задача №{task.id}:\n{task.preview}\n\nОткройте «Список задач», чтобы взять ее'
+
+        last_user_id = broadcast.last_user_id
+        while not self._stop_event.is_set():
+            recipients = list(
+                User.objects
+                .filter(role=User.UserRole.WORKER, id__gt=last_user_id)
+                .order_by('id')
+                .values_list('id', 'tg_id')[:self.chunk_size]
+            )
+            if not recipients:
+                TaskBroadcast.objects.filter(id=broadcast_id).update(finished_at=timezone.now(), locked_until=None)
+                return
+
+            self._send_chunk([tg_id for _, tg_id in recipients], text)
+            last_user_id = recipients[-1][0]
+            TaskBroadcast.objects.filter(id=broadcast_id).update(
+                last_user_id=last_user_id,
+                locked_until=timezone.now() + self.lease,
+            )
+        TaskBroadcast.objects.filter(id=broadcast_id).update(locked_until=None)
+
+    def _send_chunk(self, tg_ids, text):
+        """Ставит порцию в очередь и ждет, пока она уйдет, не превышая rate сообщений в секунду"""
+        remaining = len(tg_ids)
+        lock = threading.Lock()
+        sent = threading.Event()
+
+        def on_done(result):
+            nonlocal remaining
+            with lock:
+                remaining -= 1
+                if not remaining:
+                    sent.set()
+
+        for tg_id in tg_ids:
+            self.outbox.enqueue(tg_id, 'send_message', on_sent=on_done, on_error=on_done, text=text)
+        self._stop_event.wait(len(tg_ids) / self.rate)
+        while not sent.wait(1):
+            if self._stop_event.is_set():
+                return
@@ -0,0 +1,286 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now) -> float:
+        """Через сколько секунд появится токен"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutgoingRequest:
+    chat_id: int
+    method: str
+    kwargs: dict
+    on_sent: Optional[Callable] = None
+    on_error: Optional[Callable] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+    def can_absorb(self, other: 'OutgoingRequest') -> bool:
+        """Можно ли дописать текст следующего сообщения в это"""
+        if self.method != 'send_message' or other.method != 'send_message':
+            return False
+        if self.on_sent or self.on_error or other.on_sent or other.on_error:
+            return False
+        if self.kwargs.get('reply_markup') is not None:
+            return False
+        if self.kwargs.get('parse_mode') != other.kwargs.get('parse_mode'):
+            return False
+        return len(self.kwargs['text']) + len(other.kwargs['text']) + 2 <= MAX_MESSAGE_LENGTH
+
+    def absorb(self, other: 'OutgoingRequest'):
+        self.kwargs = {**other.kwargs, 'text': f"{self.kwargs['text']}\n\n{other.kwargs['text']}"}
+
+
+class Outbox:
+    """Очередь исходящих запросов к Bot API с ограничением частоты.
+
+    Соблюдает общий лимит бота и лимит на чат, при 429 ждет retry_after,
+    а несколько подряд идущих сообщений без клавиатуры в один чат склеивает в одно.
+    Запросы одного чата отправляются строго по очереди, разные чаты - параллельно.
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            workers: int = 4,
+            global_rate: float = 30,
+            chat_rate: float = 1,
+            chat_burst: float = 3,
+            max_attempts: int = 5,
+    ):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._chat_queues = {}
+        self._in_flight = set()
+        self._ready = []
+        self._sequence = itertools.count()
+        self._paused_until = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        self._stats = {'sent': 0, 'failed': 0, 'retries': 0, 'coalesced': 0}
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return
+            self._stopping = False
+            self._threads = [
+                threading.Thread(target=self._run, name=f'outbox-{number}', daemon=True)
+                for number in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 30):
+        """Останавливает отправку, дождавшись отправки накопленных сообщений"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            threads, self._threads = self._threads, []
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def enqueue(self, chat_id, method, on_sent=None, on_error=None, **kwargs):
+        request = OutgoingRequest(chat_id, method, kwargs, on_sent=on_sent, on_error=on_error)
+        with self._condition:
+            self._push(request)
+            self._condition.notify()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.enqueue(chat_id, 'send_message', text=text, **kwargs)
+
+    def stats(self) -> dict:
+        with self._condition:
+            depth = sum(len(queue) for queue in self._chat_queues.values())
+            sent = self._stats['sent']
+            return {
+                'depth': depth,
+                'chats': len(self._chat_queues),
+                **self._stats,
+                'latency_avg': self._latency_total / sent if sent else 0.0,
+                'latency_max': self._latency_max,
+            }
+
+    def _push(self, request, front=False):
+        queue = self._chat_queues.get(request.chat_id)
+        if queue is None:
+            queue = self._chat_queues[request.chat_id] = deque()
+            if request.chat_id not in self._in_flight:
+                self._schedule(request.chat_id, 0.0)
+        if front:
+            queue.appendleft(request)
+        else:
+            queue.append(request)
+
+    def _schedule(self, chat_id, ready_at):
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_request(self):
+        """Ждет, пока какой-нибудь чат можно обслужить, и забирает его запрос"""
+        with self._condition:
+            while True:
+                if not self._ready:
+                    if self._stopping and not self._in_flight:
+                        return None
+                    self._condition.wait()
+                    continue
+
+                now = time.monotonic()
+                ready_at, _, chat_id = self._ready[0]
+                delay = max(
+                    ready_at - now,
+                    self._paused_until - now,
+                    self._chat_bucket(chat_id).delay(now),
+                    self._global_bucket.delay(now),
+                )
+                if delay > 0:
+                    if now + delay > ready_at:
+                        # Чат ждет токена: переставляем его в очереди, чтобы не задерживать остальные
+                        heapq.heapreplace(self._ready, (now + delay, next(self._sequence), chat_id))
+                    else:
+                        self._condition.wait(delay)
+                    continue
+
+                heapq.heappop(self._ready)
+                self._chat_bucket(chat_id).take(now)
+                self._global_bucket.take(now)
+                queue = self._chat_queues.pop(chat_id)
+                request = queue.popleft()
+                while queue and request.can_absorb(queue[0]):
+                    request.absorb(queue.popleft())
+                    self._stats['coalesced'] += 1
+                if queue:
+                    self._chat_queues[chat_id] = queue
+                self._in_flight.add(chat_id)
+                return request
+
+    def _done(self, chat_id, ready_at=0.0):
+        """Запрос чата завершен: следующий запрос этого чата снова можно отправлять"""
+        with self._condition:
+            self._in_flight.discard(chat_id)
+            if chat_id in self._chat_queues:
+                self._schedule(chat_id, ready_at)
+            else:
+                self._forget_idle_buckets(time.monotonic())
+            self._condition.notify_all()
+
+    def _forget_idle_buckets(self, now):
+        if len(self._chat_buckets) < 1000:
+            return
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._chat_queues and chat_id not in self._in_flight and bucket.is_full(now):
+                del self._chat_buckets[chat_id]
+
+    def _run(self):
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+            self._send(request)
+
+    def _send(self, request):
+        request.attempts += 1
+        try:
+            result = getattr(self.bot, request.method)(chat_id=request.chat_id, **request.kwargs)
+        except RetryAfter as error:
+            self._retry(request, error.retry_after, pause_all=True)
+            return
+        except (BadRequest, Unauthorized) as error:
+            self._fail(request, error)
+            return
+        except NetworkError as error:
+            if request.attempts < self.max_attempts:
+                self._retry(request, 2 ** request.attempts)
+            else:
+                self._fail(request, error)
+            return
+        except Exception as error:
+            self._fail(request, error)
+            return
+
+        latency = time.monotonic() - request.enqueued_at
+        with self._condition:
+            self._stats['sent'] += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+        self._done(request.chat_id)
+        if request.on_sent:
+            self._callback(request.on_sent, result)
+
+    def _retry(self, request, delay, pause_all=False):
+        logger.warning('Повторная отправка %s в чат %s через %s с', request.method, request.chat_id, delay)
+        ready_at = time.monotonic() + delay
+        with self._condition:
+            self._stats['retries'] += 1
+            if pause_all:
+                self._paused_until = max(self._paused_until, ready_at)
+            queue = self._chat_queues.setdefault(request.chat_id, deque())
+            queue.appendleft(request)
+        self._done(request.chat_id, ready_at)
+
+    def _fail(self, request, error):
+        logger.error('Не удалось выполнить %s в чат %s: %s', request.method, request.chat_id, error)
+        with self._condition:
+            self._stats['failed'] += 1
+        self._done(request.chat_id)
+        if request.on_error:
+            self._callback(request.on_error, error)
+
+    @staticmethod
+    def _callback(callback, argument):
+        try:
+            callback(argument)
+        except Exception:
+            logger.exception('Ошибка в обработчике результата отправки')
@@ -0,0 +1,259 @@
+import logging
+import pickle
+import threading
+from collections import defaultdict
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from telegram.ext import BasePersistence
+
+from telegram_bot.db_router import record_write, remember_write, take_unpublished_writes
+from telegram_bot.models import ConversationState
+
+logger = logging.getLogger(__name__)
+
+
+# Загрузчик возвращает его, если в базе нет изменений, о которых процесс еще не знает
+UNCHANGED = object()
+
+
+class LazyConversations(dict):
+    """Состояния диалогов, которые подгружаются из базы при первом обращении к чату.
+
+    С reload=True состояние перечитывается при каждом get: ConversationHandler вызывает его
+    один раз на обновление, поэтому процесс видит переходы, сделанные другими процессами.
+    """
+
+    def __init__(self, loader, reload: bool = False):
+        super().__init__()
+        self._loader = loader
+        self._reload = reload
+        self._loaded = set()
+
+    def _ensure_loaded(self, key, reload=False):
+        if key in self._loaded and not reload:
+            return
+        self._loaded.add(key)
+        state = self._loader(key)
+        if state is UNCHANGED:
+            return
+        if state is not None:
+            super().__setitem__(key, state)
+        else:
+            super().pop(key, None)
+
+    def get(self, key, default=None):
+        self._ensure_loaded(key, reload=self._reload)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._ensure_loaded(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self._ensure_loaded(key)
+        return super().__getitem__(key)
+
+
+class LazyUserData(defaultdict):
+    """user_data, которая подгружается из базы при первом обращении к пользователю.
+
+    default_factory получает id пользователя, поэтому словарь переживает
+    копирование внутри BasePersistence.insert_bot.
+    """
+
+    def __missing__(self, key):
+        value = self.default_factory(key)
+        self[key] = value
+        return value
+
+
+class DjangoPersistence(BasePersistence):
+    """Хранит состояния ConversationHandler и user_data в модели ConversationState.
+
+    Изменения копятся в памяти и записываются в базу одной транзакцией
+    раз в flush_interval секунд, а также при остановке бота.
+    При flush_interval=0 запись происходит только при явном вызове flush.
+    Бот работает только в личных чатах, поэтому ключом служит Telegram ID пользователя.
+
+    Без shared состояние чата читается из базы один раз, поэтому с базой должен работать
+    один процесс бота, как при long polling. С shared=True (вебхук, несколько процессов Django)
+    на каждое обновление строка чата перечитывается, если ее updated_at отличается от известного
+    процессу, а несохраненные изменения самого процесса важнее базы. Вызывающий код должен
+    вызывать flush после каждого обновления, чтобы другие процессы сразу видели переходы.
+
+    Вместе с состоянием сохраняется время последней записи чата в базу (см. db_router),
+    чтобы после записи чат читал с основной базы и в других процессах.
+    """
+
+    def __init__(self, states, flush_interval: float = 5.0, shared: bool = False):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.states = states
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._dirty_states = {}
+        self._dirty_user_data = {}
+        self._saved_user_data = {}
+        # updated_at строки каждого чата, которую процесс последним прочитал или записал
+        self._versions = {}
+        # user_data, перечитанные вместе с состоянием и еще не переданные в словарь диспетчера
+        self._fresh_user_data = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flusher = None
+
+    def get_user_data(self):
+        return LazyUserData(self._load_user_data)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return LazyConversations(self._load_state, reload=self.shared)
+
+    def refresh_user_data(self, user_id, user_data):
+        """Подставляет user_data, перечитанные из базы вместе с состоянием диалога"""
+        with self._lock:
+            payload = self._fresh_user_data.pop(user_id, None)
+        if payload is not None:
+            user_data.clear()
+            user_data.update(pickle.loads(payload) if payload else {})
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            return
+        with self._lock:
+            self._dirty_states[key[-1]] = new_state.name if new_state else ''
+        self._start_flusher()
+
+    def update_user_data(self, user_id, data):
+        payload = pickle.dumps(dict(data))
+        with self._lock:
+            if self._saved_user_data.get(user_id) == payload:
+                self._dirty_user_data.pop(user_id, None)
+                return
+            self._dirty_user_data[user_id] = payload
+        self._start_flusher()
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        with self._lock:
+            states, self._dirty_states = self._dirty_states, {}
+            user_data, self._dirty_user_data = self._dirty_user_data, {}
+        writes = take_unpublished_writes()
+        tg_ids = states.keys() | user_data.keys() | writes.keys()
+        if not tg_ids:
+            return
+
+        try:
+            with transaction.atomic():
+                existing = ConversationState.objects.in_bulk(tg_ids, field_name='tg_id')
+                new_rows = []
+                now = timezone.now()
+                for tg_id in tg_ids:
+                    row = existing.get(tg_id) or ConversationState(tg_id=tg_id)
+                    row.updated_at = now
+                    if tg_id in states:
+                        row.state = states[tg_id]
+                    if tg_id in user_data:
+                        row.user_data = user_data[tg_id]
+                    if tg_id in writes and (row.written_at is None or row.written_at < writes[tg_id]):
+                        row.written_at = writes[tg_id]
+                    if row.pk is None:
+                        new_rows.append(row)
+                ConversationState.objects.bulk_update(
+                    existing.values(),
+                    ['state', 'user_data', 'updated_at', 'written_at'],
+                )
+                ConversationState.objects.bulk_create(new_rows)
+                rows = [*existing.values(), *new_rows]
+        except Exception:
+            with self._lock:
+                self._dirty_states = {**states, **self._dirty_states}
+                self._dirty_user_data = {**user_data, **self._dirty_user_data}
+            for tg_id, written_at in writes.items():
+                record_write(tg_id, written_at)
+            raise
+
+        with self._lock:
+            self._saved_user_data.update(user_data)
+            for row in rows:
+                self._versions[row.tg_id] = row.updated_at
+
+    def stop(self):
+        self._stop_event.set()
+        self.flush()
+
+    def _start_flusher(self):
+        if not self.flush_interval or self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_periodically,
+                name='persistence-flusher',
+                daemon=True,
+            )
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self.flush_interval):
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Не удалось сохранить состояния диалогов')
+
+    def _load_state(self, key):
+        tg_id = key[-1]
+        if self.shared:
+            return self._reload_chat(tg_id)
+        state = ConversationState.objects.filter(tg_id=tg_id).values_list('state', flat=True).first()
+        if not state:
+            return None
+        return self.states.__members__.get(state)
+
+    def _reload_chat(self, tg_id):
+        """Перечитывает состояние и user_data чата, если их изменил другой процесс, и время его последней записи"""
+        row = (
+            ConversationState.objects
+            .filter(tg_id=tg_id)
+            .values_list('state', 'user_data', 'updated_at', 'written_at')
+            .first()
+        )
+        state, payload, updated_at, written_at = row or ('', None, None, None)
+        if written_at is not None:
+            remember_write(tg_id, written_at)
+        with self._lock:
+            if tg_id in self._dirty_states or tg_id in self._dirty_user_data:
+                return UNCHANGED
+            if tg_id in self._versions and self._versions[tg_id] == updated_at:
+                return UNCHANGED
+            self._versions[tg_id] = updated_at
+            payload = bytes(payload) if payload else b''
+            self._saved_user_data[tg_id] = payload or None
+            self._fresh_user_data[tg_id] = payload
+        return self.states.__members__.get(state) if state else None
+
+    def _load_user_data(self, user_id):
+        with self._lock:
+            fresh = self._fresh_user_data.pop(user_id, None)
+        if fresh is not None:
+            # Уже прочитаны вместе с состоянием диалога в этом обновлении
+            return pickle.loads(fresh) if fresh else {}
+        payload = ConversationState.objects.filter(tg_id=user_id).values_list('user_data', flat=True).first()
+        if not payload:
+            return {}
+        payload = bytes(payload)
+        with self._lock:
+            self._saved_user_data[user_id] = payload
+        return pickle.loads(payload)
@@ -0,0 +1,230 @@
+import base64
+import binascii
+import struct
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from telegram import Update
+from telegram.ext import Handler
+
+TASK_ACTION = 'task'
+
+# Версия двоичного формата: первый байт данных кнопки.
+# Если коды действий или состав полей меняются несовместимо, версию нужно увеличить,
+# а кнопки старых версий, оставшиеся в чатах, будут разбираться как устаревший текстовый формат
+CALLBACK_VERSION = 1
+
+MAX_CALLBACK_DATA_LENGTH = 64
+
+# Коды действий не должны меняться: кнопки с ними остаются в уже отправленных сообщениях
+ACTION_CODES = {
+    TASK_ACTION: 1,
+    'page': 2,
+    'history': 3,
+    'search': 4,
+    'support_page': 5,
+    'support_done': 6,
+    'tier': 7,
+    'pay': 8,
+}
+ACTIONS = {code: action for action, code in ACTION_CODES.items()}
+
+# Действия переходов по меню регистрирует бот, их коды начинаются отсюда
+FIRST_REGISTERED_CODE = 32
+
+HAS_TASK_ID = 1
+HAS_SUPPORT_ID = 2
+HAS_LIST_NAME = 4
+HAS_CURSOR = 8
+BACKWARDS = 16
+HAS_PAGE = 32
+HAS_TIER = 64
+
+HEADER = struct.Struct('>BBB')
+ID = struct.Struct('>I')
+CURSOR = struct.Struct('>qI')
+PAGE = struct.Struct('>H')
+
+# Устаревшие названия тарифов в кнопках, отправленных до перехода на двоичный формат
+LEGACY_TIERS = {'economy': 'ECO', 'default': 'DEFAULT', 'vip': 'VIP'}
+# Кнопки оплаты того же времени передавали цену тарифа
+LEGACY_PRICES = {'100': 'ECO', '200': 'DEFAULT', '300': 'VIP'}
+
+
+class CallbackData(NamedTuple):
+    """Разобранные данные нажатой кнопки: действие и его параметры"""
+    action: str
+    task_id: Optional[int] = None
+    support_id: Optional[int] = None
+    list_name: Optional[str] = None
+    cursor: Optional[str] = None
+    backwards: bool = False
+    page: int = 0
+    tier: Optional[str] = None
+
+
+def register_actions(actions: Iterable[str]):
+    """Назначает коды действиям без параметров, например переходам по меню, в порядке их перечисления.
+
+    Новые действия нужно добавлять в конец, иначе коды в отправленных кнопках поменяют смысл.
+    """
+    for code, action in enumerate(actions, start=FIRST_REGISTERED_CODE):
+        if ACTIONS.get(code, action) != action or ACTION_CODES.get(action, code) != code:
+            raise ValueError(f'Код {code} действия {action} уже занят')
+        ACTION_CODES[action] = code
+        ACTIONS[code] = action
+
+
+def pack_string(value: str) -> bytes:
+    encoded = value.encode()
+    return bytes([len(encoded)]) + encoded
+
+
+def unpack_string(payload: bytes, offset: int):
+    length = payload[offset]
+    offset += 1
+    return payload[offset:offset + length].decode(), offset + length
+
+
+def encode_callback_data(
+        action: str,
+        task_id: int = None,
+        support_id: int = None,
+        list_name: str = None,
+        cursor: str = None,
+        backwards: bool = False,
+        page: int = None,
+        tier: str = None,
+) -> str:
+    """Данные кнопки в двоичном виде в base64: версия, код действия, флаги полей и сами поля"""
+    flags = 0
+    fields = []
+    if task_id is not None:
+        flags |= HAS_TASK_ID
+        fields.append(ID.pack(task_id))
+    if support_id is not None:
+        flags |= HAS_SUPPORT_ID
+        fields.append(ID.pack(support_id))
+    if list_name is not None:
+        flags |= HAS_LIST_NAME
+        fields.append(pack_string(list_name))
+    if cursor is not None:
+        flags |= HAS_CURSOR
+        created_at, object_id = cursor.split(':')
+        fields.append(CURSOR.pack(int(created_at), int(object_id)))
+    if backwards:
+        flags |= BACKWARDS
+    if page is not None:
+        flags |= HAS_PAGE
+        fields.append(PAGE.pack(page))
+    if tier is not None:
+        flags |= HAS_TIER
+        fields.append(pack_string(tier))
+    payload = HEADER.pack(CALLBACK_VERSION, ACTION_CODES[action], flags) + b''.join(fields)
+    data = base64.urlsafe_b64encode(payload).rstrip(b'=').decode()
+    if len(data) > MAX_CALLBACK_DATA_LENGTH:
+        raise ValueError(f'Данные кнопки длиннее {MAX_CALLBACK_DATA_LENGTH} байт: {data}')
+    return data
+
+
+def decode_callback_data(data: str) -> Optional[CallbackData]:
+    """Разбирает двоичный формат, для данных другой версии или формата возвращает None"""
+    try:
+        payload = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(payload) < HEADER.size:
+        return None
+    version, code, flags = HEADER.unpack_from(payload)
+    if version != CALLBACK_VERSION or code not in ACTIONS:
+        return None
+
+    params = {}
+    offset = HEADER.size
+    if flags & HAS_TASK_ID:
+        params['task_id'], = ID.unpack_from(payload, offset)
+        offset += ID.size
+    if flags & HAS_SUPPORT_ID:
+        params['support_id'], = ID.unpack_from(payload, offset)
+        offset += ID.size
+    if flags & HAS_LIST_NAME:
+        params['list_name'], offset = unpack_string(payload, offset)
+    if flags & HAS_CURSOR:
+        created_at, object_id = CURSOR.unpack_from(payload, offset)
+        params['cursor'] = f'{created_at}:{object_id}'
+        offset += CURSOR.size
+    if flags & HAS_PAGE:
+        params['page'], = PAGE.unpack_from(payload, offset)
+        offset += PAGE.size
+    if flags & HAS_TIER:
+        params['tier'], offset = unpack_string(payload, offset)
+    return CallbackData(ACTIONS[code], backwards=bool(flags & BACKWARDS), **params)
+
+
+def parse_callback_data(data: str) -> CallbackData:
+    """Разбирает данные кнопки: двоичный формат или устаревший текстовый.
+
+    В текстовом формате номер задачи - действие TASK_ACTION, название тарифа - выбор тарифа,
+    цена тарифа - оплата, остальные строки, например str(Transitions.client), - действия без параметров.
+    Кнопки в этом формате остаются в сообщениях, отправленных до перехода на двоичный.
+    """
+    callback_data = decode_callback_data(data)
+    if callback_data is not None:
+        return callback_data
+    if data in LEGACY_TIERS:
+        return CallbackData('tier', tier=LEGACY_TIERS[data])
+    if data in LEGACY_PRICES:
+        return CallbackData('pay', tier=LEGACY_PRICES[data])
+    if data.isdigit():
+        return CallbackData(TASK_ACTION, task_id=int(data))
+    return CallbackData(data)
+
+
+class CallbackRouter(Handler):
+    """Обработчик нажатий кнопок одного состояния диалога.
+
+    Вместо перебора CallbackQueryHandler с регулярными выражениями находит callback
+    по действию из словаря routes, а если действия там нет - вызывает default.
+    Разобранные параметры кнопки доступны обработчику в context.callback_data.
+    """
+
+    def __init__(self, routes: dict, default: Callable = None):
+        super().__init__(default)
+        self.routes = routes
+        self.default = default
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        if update.callback_query.data is None:
+            return None
+        try:
+            data = parse_callback_data(update.callback_query.data)
+        except (ValueError, struct.error, IndexError, UnicodeDecodeError):
+            return None
+        if data.action not in self.routes and update.callback_query.data in LEGACY_PRICES:
+            # В старом формате кнопка оплаты за 100$ и кнопка задачи №100 совпадают, различает их только состояние
+            data = CallbackData(TASK_ACTION, task_id=int(update.callback_query.data))
+        callback = self.routes.get(data.action, self.default)
+        if callback is None:
+            return None
+        return callback, data
+
+    def collect_additional_context(self, context, update, dispatcher, check_result):
+        context.callback_data = check_result[1]
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        self.collect_additional_context(context, update, dispatcher, check_result)
+        return check_result[0](update, context)
+
+    def wrap_callbacks(self, wrapper: Callable[[Callable], Callable]):
+        """Оборачивает все callback роутера, например для инструментирования"""
+        wrapped = {}
+
+        def wrap(callback):
+            if callback not in wrapped:
+                wrapped[callback] = wrapper(callback)
+            return wrapped[callback]
+
+        self.routes = {action: wrap(callback) for action, callback in self.routes.items()}
+        if self.default is not None:
+            self.default = self.callback = wrap(self.default)
@@ -0,0 +1,21 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from telegram_bot.data_operations import refresh_subscription_snapshot, user_cache
+from telegram_bot.models import Subscription, User
+from telegram_bot.sqlite import configure_connection
+
+connection_created.connect(configure_connection, dispatch_uid='telegram_bot.sqlite')
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(pk=instance.pk, tg_id=instance.tg_id)
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def update_subscription_snapshot(sender, instance, **kwargs):
+    refresh_subscription_snapshot(instance.user_id)
@@ -0,0 +1,47 @@
+import logging
+import re
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+PRAGMA_VALUE = re.compile(r'-?\w+')
+
+
+def apply_pragmas(cursor, pragmas: dict):
+    """Выполняет PRAGMA из словаря имя - значение.
+
+    Значения PRAGMA нельзя передать параметрами запроса, поэтому они подставляются в текст
+    и допускаются только числа и слова.
+    """
+    for name, value in pragmas.items():
+        if not PRAGMA_VALUE.fullmatch(str(name)) or not PRAGMA_VALUE.fullmatch(str(value)):
+            raise ValueError(f'Недопустимая настройка SQLite: {name}={value}')
+        cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def configure_connection(sender, connection, **kwargs):
+    """Применяет SQLITE_PRAGMAS к каждому новому соединению с SQLite (сигнал connection_created)"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        apply_pragmas(cursor, settings.SQLITE_PRAGMAS)
+
+
+def run_maintenance():
+    """Переносит журнал WAL в файл базы, обрезает его и обновляет статистику планировщика запросов"""
+    for connection in connections.all():
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            continue
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            busy, log_pages, checkpointed_pages = cursor.fetchone()
+            cursor.execute('PRAGMA optimize')
+        logger.debug(
+            'SQLite %s: checkpoint busy=%s, страниц в журнале %s, перенесено %s',
+            connection.alias,
+            busy,
+            log_pages,
+            checkpointed_pages,
+        )
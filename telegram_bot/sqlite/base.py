@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """SQLite, в котором транзакции начинаются в режиме SQLITE_TRANSACTION_MODE.
+
+    По умолчанию Django начинает транзакцию с BEGIN, и блокировка на запись берется только
+    при первой записи. Если транзакция уже читала, а другое соединение успело записать,
+    SQLite сразу возвращает "database is locked", не дожидаясь busy_timeout.
+    BEGIN IMMEDIATE берет блокировку на запись в начале транзакции, и ожидание работает.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {settings.SQLITE_TRANSACTION_MODE}')
@@ -1,3 +1,1349 @@
-from django.test import TestCase
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from queue import Queue
+from unittest import mock
+from urllib.parse import unquote
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from telegram import Bot, CallbackQuery, Chat, MessageEntity, Update
+from telegram import Message as TelegramMessage
+from telegram import User as TelegramUser
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import CommandHandler, TypeHandler
+
+from telegram_bot.admin import CappedCountPaginator, startswith_range
+from telegram_bot.bot import (
+    TASK_LISTS,
+    States,
+    Transitions,
+    build_conversation_handler,
+    build_persistence,
+    build_updater,
+    render_search_results,
+    render_support_inbox,
+    render_task_history,
+    render_task_list,
+)
+from telegram_bot.data_operations import (
+    decode_cursor,
+    encode_cursor,
+    get_cached_user,
+    get_remaining_tasks,
+    get_tasks_page,
+    can_read_task_messages,
+    get_subscription_changes,
+    refresh_expired_subscriptions,
+    search_tasks_page,
+    take_task_quota,
+    user_cache,
+)
+from telegram_bot.db_router import (
+    ReplicaRouter,
+    read_from_replica,
+    record_write,
+    set_current_chat,
+    take_unpublished_writes,
+    wrote_recently,
+)
+from telegram_bot.dispatcher import ChatOrderedDispatcher
+from telegram_bot.documents import send_cached_document
+from telegram_bot import metrics
+from telegram_bot.instrumentation import instrument_callback, instrument_conversation_handler
+from telegram_bot.models import ConversationState, Message, Subscription, Support, Task, TaskBroadcast, TelegramFile, User
+from telegram_bot.notifications import TaskBroadcaster, create_task_with_broadcast
+from telegram_bot.outbox import Outbox
+from telegram_bot.persistence import DjangoPersistence
+from telegram_bot.benchmark import run_write_benchmark
+from telegram_bot.routing import TASK_ACTION, CallbackData, CallbackRouter, encode_callback_data, parse_callback_data
+from telegram_bot.sqlite import apply_pragmas
+from telegram_bot.write_buffer import WriteBuffer
+
+
+def pressed_buttons(reply_markup):
+    return [parse_callback_data(button.callback_data) for row in reply_markup.inline_keyboard for button in row]
+
+
+@override_settings(TG_WEBHOOK_SECRET='secret')
+class TelegramWebhookTest(TestCase):
+    def post_update(self, **headers):
+        return self.client.post(
+            reverse('telegram_webhook'),
+            data=json.dumps({'update_id': 1}),
+            content_type='application/json',
+            **headers,
+        )
+
+    def test_rejects_request_without_secret(self):
+        self.assertEqual(self.post_update().status_code, 403)
+
+    def test_rejects_wrong_secret(self):
+        response = self.post_update(HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN='wrong')
+        self.assertEqual(response.status_code, 403)
+
+    @mock.patch('telegram_bot.views.get_webhook_dispatcher')
+    def test_passes_update_to_dispatcher(self, get_dispatcher):
+        response = self.post_update(HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN='secret')
+        self.assertEqual(response.status_code, 200)
+        update = get_dispatcher.return_value.process_update.call_args.args[0]
+        self.assertEqual(update.update_id, 1)
+        get_dispatcher.return_value.persistence.flush.assert_called_once_with()
+
+
+class ChatOrderedDispatcherTest(SimpleTestCase):
+    def test_keeps_order_within_chat(self):
+        processed = []
+        lock = threading.Lock()
+
+        def record(update, context):
+            time.sleep(0.001 * (update.update_id % 3))
+            with lock:
+                processed.append((update.effective_chat.id, update.update_id))
+
+        dispatcher = ChatOrderedDispatcher(Bot('123:abc'), Queue(), use_context=True, pool_size=4)
+        dispatcher.add_handler(TypeHandler(Update, record))
+        for update_id in range(60):
+            chat_id = update_id % 5
+            dispatcher.process_update(Update.de_json({
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'date': 0,
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'text': 'test',
+                },
+            }, dispatcher.bot))
+        dispatcher.stop()
+
+        self.assertEqual(len(processed), 60)
+        for chat_id in range(5):
+            chat_updates = [update_id for chat, update_id in processed if chat == chat_id]
+            self.assertEqual(chat_updates, sorted(chat_updates))
+
+    def test_polling_updater_uses_parallel_dispatcher(self):
+        updater = build_updater(4, build_persistence())
+        try:
+            self.assertIsInstance(updater.dispatcher, ChatOrderedDispatcher)
+            self.assertEqual(updater.dispatcher.pool_size, 4)
+            self.assertIs(updater.dispatcher.job_queue._dispatcher, updater.dispatcher)
+        finally:
+            updater.dispatcher.stop()
+
+
+class DjangoPersistenceTest(TestCase):
+    def setUp(self):
+        # Записи чатов из других тестов не должны попасть в flush
+        take_unpublished_writes()
+
+    def test_writes_are_batched_until_flush(self):
+        persistence = DjangoPersistence(states=States, flush_interval=0)
+        persistence.update_conversation('conversation', (10, 10), States.client)
+        persistence.update_user_data(10, {'current_task': 5})
+        self.assertFalse(ConversationState.objects.exists())
+
+        with self.assertNumQueries(4):
+            persistence.flush()
+        self.assertEqual(ConversationState.objects.get(tg_id=10).state, States.client.name)
+
+    def test_state_is_loaded_lazily_per_chat(self):
+        persistence = DjangoPersistence(states=States, flush_interval=0)
+        persistence.update_conversation('conversation', (10, 10), States.worker)
+        persistence.update_user_data(10, {'current_task': 5})
+        persistence.flush()
+
+        restarted = DjangoPersistence(states=States, flush_interval=0)
+        with self.assertNumQueries(0):
+            conversations = restarted.get_conversations('conversation')
+            user_data = restarted.get_user_data()
+        self.assertEqual(conversations.get((10, 10)), States.worker)
+        self.assertEqual(user_data[10], {'current_task': 5})
+        self.assertIsNone(conversations.get((20, 20)))
+
+    def test_shared_processes_see_each_others_transitions(self):
+        # Два процесса Django, которые получают обновления одного чата через вебхук
+        first = DjangoPersistence(states=States, flush_interval=0, shared=True)
+        second = DjangoPersistence(states=States, flush_interval=0, shared=True)
+        first_conversations = first.get_conversations('conversation')
+        second_conversations = second.get_conversations('conversation')
+        first_user_data = first.get_user_data()
+
+        self.assertIsNone(first_conversations.get((10, 10)))
+        first.update_conversation('conversation', (10, 10), States.choose_role)
+        first.flush()
+
+        self.assertEqual(second_conversations.get((10, 10)), States.choose_role)
+        second.update_conversation('conversation', (10, 10), States.worker)
+        second.update_user_data(10, {'current_task': 7})
+        second.flush()
+
+        self.assertEqual(first_conversations.get((10, 10)), States.worker)
+        first.refresh_user_data(10, first_user_data[10])
+        self.assertEqual(first_user_data[10], {'current_task': 7})
+
+        # Строка не менялась с последнего чтения: только проверка updated_at
+        with self.assertNumQueries(1):
+            self.assertEqual(first_conversations.get((10, 10)), States.worker)
+
+    @mock.patch.dict('telegram_bot.db_router._last_writes', clear=True)
+    def test_shared_processes_see_each_others_writes(self):
+        first = DjangoPersistence(states=States, flush_interval=0, shared=True)
+        second = DjangoPersistence(states=States, flush_interval=0, shared=True)
+        router = ReplicaRouter()
+        try:
+            set_current_chat(10)
+            router.db_for_write(Task)
+            set_current_chat(20)
+            first.update_conversation('conversation', (20, 20), States.client)
+            # Сохранение состояния диалога - служебная запись, она не привязывает чат к основной базе
+            first.flush()
+        finally:
+            set_current_chat(None)
+        self.assertIsNotNone(ConversationState.objects.get(tg_id=10).written_at)
+        self.assertIsNone(ConversationState.objects.get(tg_id=20).written_at)
+
+        # Второй процесс ничего не знает о записях первого, пока не прочитает состояние диалога
+        with mock.patch.dict('telegram_bot.db_router._last_writes', clear=True):
+            self.assertFalse(wrote_recently(10))
+            conversations = second.get_conversations('conversation')
+            conversations.get((10, 10))
+            conversations.get((20, 20))
+            self.assertTrue(wrote_recently(10))
+            self.assertFalse(wrote_recently(20))
+
+    def test_shared_unsaved_changes_win_over_database(self):
+        first = DjangoPersistence(states=States, flush_interval=0, shared=True)
+        second = DjangoPersistence(states=States, flush_interval=0, shared=True)
+        first_conversations = first.get_conversations('conversation')
+        first_conversations.get((10, 10))
+        first.update_conversation('conversation', (10, 10), States.manager)
+        first_conversations[(10, 10)] = States.manager
+
+        second.update_conversation('conversation', (10, 10), States.client)
+        second.flush()
+        self.assertEqual(first_conversations.get((10, 10)), States.manager)
+
+
+# Дубли tg_id из базы до уникального индекса сливаются в самую раннюю запись вместе со ссылками на них
+MERGE_USERS_SCRIPT = """
+import json
+from django.core.management import call_command
+from django.db import connection
+
+call_command('migrate', 'telegram_bot', '0012', verbosity=0)
+with connection.cursor() as cursor:
+    for name in ('first', 'second', 'third'):
+        cursor.execute(
+            "INSERT INTO telegram_bot_user (role, tg_id, phonenumber, name) VALUES ('CL', 42, '+79990000000', %s)",
+            [name],
+        )
+    cursor.execute(
+        "INSERT INTO telegram_bot_task (task, status, client_id, created_at) VALUES ('t', 'WAIT', 3, '2026-01-01')"
+    )
+    cursor.execute(
+        "INSERT INTO telegram_bot_subscription (user_id, lvl, starts_at, end_at) VALUES (2, 'VIP', '2026-01-01', '2026-02-01')"
+    )
+call_command('migrate', verbosity=0)
+with connection.cursor() as cursor:
+    cursor.execute('SELECT id, name FROM telegram_bot_user')
+    users = cursor.fetchall()
+    cursor.execute('SELECT client_id FROM telegram_bot_task')
+    clients = cursor.fetchall()
+    cursor.execute('SELECT user_id FROM telegram_bot_subscription')
+    subscribers = cursor.fetchall()
+print(json.dumps({'users': users, 'clients': clients, 'subscribers': subscribers}))
+"""
+
+
+class MergeDuplicateUsersMigrationTest(SimpleTestCase):
+    def test_duplicates_are_merged_before_unique_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            completed = subprocess.run(
+                [sys.executable, 'manage.py', 'shell', '-c', MERGE_USERS_SCRIPT],
+                cwd=settings.BASE_DIR,
+                env={**os.environ, 'DB_NAME': os.path.join(directory, 'legacy.sqlite3')},
+                capture_output=True,
+                text=True,
+                timeout=120,
+            )
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        result = json.loads(completed.stdout.splitlines()[-1])
+        self.assertEqual(result, {'users': [[1, 'first']], 'clients': [[1]], 'subscribers': [[1]]})
+
+
+class UserCacheTest(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.user = User.objects.create(tg_id=100, name='Иван Петров', phonenumber='+79990000000')
+
+    def test_second_lookup_hits_cache(self):
+        get_cached_user(100)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cached_user(100).role, User.UserRole.CLIENT)
+
+    def test_role_change_invalidates_cache(self):
+        get_cached_user(100)
+        self.user.role = User.UserRole.WORKER
+        self.user.save()
+        self.assertEqual(get_cached_user(100).role, User.UserRole.WORKER)
+
+    def test_delete_invalidates_cache(self):
+        get_cached_user(100)
+        self.user.delete()
+        with self.assertRaises(User.DoesNotExist):
+            get_cached_user(100)
+
+
+class SubscriptionSnapshotTest(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.user = User.objects.create(tg_id=100, name='Иван Петров', phonenumber='+79990000000')
+        self.now = timezone.now()
+
+    def subscribe(self, lvl, starts_at, end_at):
+        return Subscription.objects.create(user=self.user, lvl=lvl, starts_at=starts_at, end_at=end_at)
+
+    def test_new_subscription_is_visible_without_subscription_query(self):
+        self.assertFalse(get_cached_user(100).has_active_subscription)
+        self.subscribe(Subscription.SubscriptionLevel.VIP, self.now, self.now + timezone.timedelta(days=30))
+        get_cached_user(100)
+        with self.assertNumQueries(0):
+            user = get_cached_user(100)
+        self.assertTrue(user.has_active_subscription)
+        self.assertEqual(user.subscription_lvl, Subscription.SubscriptionLevel.VIP)
+
+    def test_expired_subscription_is_replaced_by_next_one(self):
+        vip = self.subscribe(
+            Subscription.SubscriptionLevel.VIP,
+            self.now - timezone.timedelta(days=30),
+            self.now + timezone.timedelta(days=30),
+        )
+        self.subscribe(
+            Subscription.SubscriptionLevel.ECONOMY,
+            self.now - timezone.timedelta(days=1),
+            self.now + timezone.timedelta(days=10),
+        )
+        self.assertEqual(get_cached_user(100).subscription_lvl, Subscription.SubscriptionLevel.VIP)
+        expired_at = self.now - timezone.timedelta(seconds=1)
+        Subscription.objects.filter(pk=vip.pk).update(end_at=expired_at)
+        User.objects.filter(pk=self.user.pk).update(subscription_end_at=expired_at, subscription_changes_at=expired_at)
+
+        refresh_expired_subscriptions()
+
+        user = get_cached_user(100)
+        self.assertEqual(user.subscription_lvl, Subscription.SubscriptionLevel.ECONOMY)
+        self.assertTrue(user.has_active_subscription)
+
+    def refresh_at(self, moment):
+        with mock.patch('django.utils.timezone.now', return_value=moment):
+            refresh_expired_subscriptions()
+            user = get_cached_user(100)
+            return user.subscription_lvl, user.has_active_subscription
+
+    def test_future_subscription_is_activated_when_it_starts(self):
+        self.subscribe(
+            Subscription.SubscriptionLevel.VIP,
+            self.now + timezone.timedelta(hours=1),
+            self.now + timezone.timedelta(days=30),
+        )
+        self.assertFalse(get_cached_user(100).has_active_subscription)
+        self.assertEqual(
+            self.refresh_at(self.now + timezone.timedelta(hours=2)),
+            (Subscription.SubscriptionLevel.VIP, True),
+        )
+
+    def test_follow_on_subscription_starts_after_gap(self):
+        self.subscribe(
+            Subscription.SubscriptionLevel.ECONOMY,
+            self.now - timezone.timedelta(days=1),
+            self.now + timezone.timedelta(hours=1),
+        )
+        self.subscribe(
+            Subscription.SubscriptionLevel.VIP,
+            self.now + timezone.timedelta(hours=2),
+            self.now + timezone.timedelta(days=30),
+        )
+        self.assertEqual(
+            self.refresh_at(self.now + timezone.timedelta(minutes=90)),
+            (Subscription.SubscriptionLevel.NOT_ACTIVE, False),
+        )
+        self.assertEqual(
+            self.refresh_at(self.now + timezone.timedelta(hours=3)),
+            (Subscription.SubscriptionLevel.VIP, True),
+        )
+        self.assertEqual(
+            User.objects.get(pk=self.user.pk).subscription_changes_at,
+            self.now + timezone.timedelta(days=30),
+        )
+
+    def test_deleted_subscription_deactivates_user(self):
+        subscription = self.subscribe(
+            Subscription.SubscriptionLevel.DEFAULT, self.now, self.now + timezone.timedelta(days=30),
+        )
+        subscription.delete()
+        user = get_cached_user(100)
+        self.assertEqual(user.subscription_lvl, Subscription.SubscriptionLevel.NOT_ACTIVE)
+        self.assertFalse(user.has_active_subscription)
+
+
+class TaskQuotaTest(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.user = User.objects.create(tg_id=100, name='Иван Петров', phonenumber='+79990000000')
+        self.now = timezone.now()
+        Subscription.objects.create(
+            user=self.user,
+            lvl=Subscription.SubscriptionLevel.ECONOMY,
+            starts_at=self.now - timezone.timedelta(days=1),
+            end_at=self.now + timezone.timedelta(days=30),
+        )
+
+    def test_limit_does_not_depend_on_task_history(self):
+        user = get_cached_user(100)
+        self.assertTrue(take_task_quota(user))
+        for _ in range(4):
+            with self.assertNumQueries(1):
+                self.assertTrue(take_task_quota(user))
+        self.assertFalse(take_task_quota(user))
+        self.assertEqual(get_remaining_tasks(user), 0)
+
+    def test_new_period_resets_limit(self):
+        for _ in range(5):
+            take_task_quota(get_cached_user(100))
+        Subscription.objects.create(
+            user=self.user,
+            lvl=Subscription.SubscriptionLevel.DEFAULT,
+            starts_at=self.now,
+            end_at=self.now + timezone.timedelta(days=60),
+        )
+        self.assertEqual(get_remaining_tasks(get_cached_user(100)), 15)
+
+    def test_no_quota_without_subscription(self):
+        Subscription.objects.all().delete()
+        self.assertFalse(take_task_quota(get_cached_user(100)))
+
+
+class HotQueryPlanTest(TestCase):
+    """Горячие запросы бота не должны читать таблицы целиком"""
+
+    full_scan = re.compile(r'\bSCAN (?:TABLE )?\w+(?!\w| USING (?:COVERING )?INDEX)')
+    index_scan = re.compile(r'^SCAN \w+ USING (?:COVERING )?INDEX (\w+)$')
+
+    def setUp(self):
+        User.objects.create(tg_id=100, name='Иван Петров', phonenumber='+79990000000')
+        user_cache.clear()
+
+    def bot_helpers(self):
+        """Функции, которыми бот читает списки, с курсором и без, в обе стороны"""
+        helpers = {
+            'cached_user': lambda: get_cached_user(100),
+            'subscriptions_to_refresh': lambda: list(get_subscription_changes(timezone.now())),
+        }
+        cursor = encode_cursor(Task(id=5, created_at=timezone.now()))
+        for page_cursor, backwards in ((None, False), (cursor, False), (cursor, True)):
+            page = f'cursor={page_cursor}, backwards={backwards}'
+            for list_name in TASK_LISTS:
+                helpers[f'{list_name}_tasks {page}'] = partial(render_task_list, list_name, 100, page_cursor, backwards)
+            helpers[f'support_inbox {page}'] = partial(render_support_inbox, page_cursor, backwards)
+            helpers[f'task_history {page}'] = partial(
+                render_task_history, 1, User.UserRole.CLIENT, page_cursor, backwards,
+            )
+        return helpers
+
+    def other_queries(self):
+        return {
+            'workers_to_notify': User.objects.filter(role=User.UserRole.WORKER, id__gt=0).order_by('id')[:100],
+            'unfinished_broadcasts': TaskBroadcast.objects.filter(finished_at__isnull=True).order_by('created_at'),
+            'active_subscriptions': Subscription.objects.filter(user_id=1, starts_at__lte=timezone.now()),
+            'task_support_messages': Support.objects.filter(task_id=1),
+            'admin_tasks': Task.objects.order_by('-created_at', '-id')[:100],
+            'admin_tasks_by_status': Task.objects.filter(status=Task.Proc.WAITING).order_by('-created_at', '-id')[:100],
+            'admin_messages': Message.objects.order_by('-created_at', '-id')[:100],
+            'admin_support': Support.objects.order_by('-created_at', '-id')[:100],
+            'admin_users_by_role': User.objects.filter(role=User.UserRole.WORKER).order_by('name_search', '-id')[:100],
+            'admin_user_name_search': User.objects.filter(**startswith_range('name_search', 'иван')),
+            'admin_user_phone_search': User.objects.filter(**startswith_range('phone_search', '7999')),
+        }
+
+    def explain(self, helper):
+        with CaptureQueriesContext(connection) as queries:
+            helper()
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        with connection.cursor() as cursor:
+            return [
+                [row[-1] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()]
+                for sql in selects
+            ]
+
+    def test_bot_helpers_read_only_their_page(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN есть только в SQLite')
+        # Частичный индекс содержит только строки фильтра, а без сортировки LIMIT
+        # останавливает его чтение на конце страницы. Остальные индексы нужно искать, а не читать подряд
+        partial_indexes = {
+            index.name
+            for model in (Task, Message, Support, User)
+            for index in model._meta.indexes
+            if index.condition is not None
+        }
+        for name, helper in self.bot_helpers().items():
+            for plan in self.explain(helper):
+                with self.subTest(helper=name, plan=plan):
+                    self.assertFalse([detail for detail in plan if 'USE TEMP B-TREE' in detail])
+                    for detail in plan:
+                        if detail.startswith('SCAN'):
+                            index_scan = self.index_scan.match(detail)
+                            self.assertTrue(index_scan and index_scan.group(1) in partial_indexes, detail)
+
+    def test_other_hot_queries_use_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN есть только в SQLite')
+        for name, queryset in self.other_queries().items():
+            with self.subTest(query=name):
+                plan = queryset.explain()
+                self.assertIsNone(self.full_scan.search(plan), plan)
+
+
+@mock.patch.dict('telegram_bot.documents._file_ids', clear=True)
+class CachedDocumentTest(TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.pdf')
+        os.write(handle, b'agreement v1')
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.outbox = mock.Mock()
+
+    def send(self):
+        send_cached_document(self.outbox, 1, self.path)
+        kwargs = self.outbox.enqueue.call_args.kwargs
+        if kwargs.get('on_sent'):
+            sent = mock.Mock()
+            sent.document.file_id = 'file-1'
+            kwargs['on_sent'](sent)
+        return kwargs['document']
+
+    def test_uploads_once_then_sends_file_id(self):
+        self.assertEqual(self.send(), b'agreement v1')
+        self.assertEqual(self.send(), 'file-1')
+
+    def test_reuploads_changed_file(self):
+        self.send()
+        with open(self.path, 'wb') as file:
+            file.write(b'agreement v2 with changes')
+        self.assertEqual(self.send(), b'agreement v2 with changes')
+
+    def reject(self, error):
+        self.outbox.enqueue.call_args.kwargs['on_error'](error)
+
+    def test_reuploads_when_file_id_is_rejected(self):
+        self.send()
+        self.assertEqual(self.send(), 'file-1')
+        self.reject(BadRequest('Wrong file identifier/http url specified'))
+        self.assertEqual(self.outbox.enqueue.call_args.kwargs['document'], b'agreement v1')
+        self.assertFalse(TelegramFile.objects.exists())
+
+    def test_keeps_file_id_when_chat_rejects_message(self):
+        self.send()
+        self.send()
+        calls = self.outbox.enqueue.call_count
+        self.reject(BadRequest('Chat not found'))
+        self.assertEqual(self.outbox.enqueue.call_count, calls)
+        self.assertEqual(self.send(), 'file-1')
+        self.assertTrue(TelegramFile.objects.exists())
+
+
+class TasksPageTest(TestCase):
+    def setUp(self):
+        created_at = timezone.now()
+        self.tasks = [
+            Task.objects.create(task=f'Задача {number}', created_at=created_at + timezone.timedelta(seconds=number // 2))
+            for number in range(7)
+        ]
+
+    def test_walks_forward_and_back_with_equal_timestamps(self):
+        tasks = Task.objects.all()
+        first, has_previous, has_next = get_tasks_page(tasks, page_size=3)
+        self.assertEqual(first, self.tasks[:3])
+        self.assertEqual((has_previous, has_next), (False, True))
+
+        second, has_previous, has_next = get_tasks_page(tasks, encode_cursor(first[-1]), page_size=3)
+        self.assertEqual(second, self.tasks[3:6])
+        self.assertEqual((has_previous, has_next), (True, True))
+
+        last, has_previous, has_next = get_tasks_page(tasks, encode_cursor(second[-1]), page_size=3)
+        self.assertEqual(last, self.tasks[6:])
+        self.assertEqual((has_previous, has_next), (True, False))
+
+        back, has_previous, has_next = get_tasks_page(tasks, encode_cursor(second[0]), backwards=True, page_size=3)
+        self.assertEqual(back, self.tasks[:3])
+        self.assertEqual((has_previous, has_next), (False, True))
+
+    @override_settings(TG_TASKS_PAGE_SIZE=2)
+    def test_expired_list_pages_by_deadline_descending(self):
+        now = timezone.now()
+        # Порядок дедлайнов не совпадает с порядком создания задач
+        for task, hours in zip(self.tasks, (5, 1, 3, 3, 2, 4, -1)):
+            Task.objects.filter(pk=task.pk).update(end_at=now - timezone.timedelta(hours=hours))
+        expected = ['Задача 1', 'Задача 4', 'Задача 3', 'Задача 2', 'Задача 5', 'Задача 0']
+
+        message, reply_markup = render_task_list('expired', 1)
+        pages = [message]
+        while True:
+            following = [data for data in pressed_buttons(reply_markup) if data.action == 'page' and not data.backwards]
+            if not following:
+                break
+            cursor = following[0].cursor
+            last = Task.objects.get(task=re.findall(r'Задача \d', message)[-1])
+            self.assertEqual(decode_cursor(cursor), (last.end_at, last.id))
+            message, reply_markup = render_task_list('expired', 1, cursor)
+            pages.append(message)
+        self.assertEqual([title for page in pages for title in re.findall(r'Задача \d', page)], expected)
+
+        previous = next(data for data in pressed_buttons(reply_markup) if data.action == 'page' and data.backwards)
+        message, _ = render_task_list('expired', 1, previous.cursor, backwards=True)
+        self.assertEqual(re.findall(r'Задача \d', message), expected[2:4])
+
+    def test_previews_do_not_load_task_text(self):
+        Task.objects.filter(pk=self.tasks[0].pk).update(task='Очень длинный текст задачи ' * 1000)
+        task = Task.objects.previews(length=10).get(pk=self.tasks[0].pk)
+        self.assertEqual(task.preview, 'Очень длин')
+        self.assertIn('task', task.get_deferred_fields())
+
+
+class SupportInboxTest(TestCase):
+    def setUp(self):
+        created_at = timezone.now()
+        user = User.objects.create(tg_id=100, name='Иван Петров', phonenumber='+79990000000')
+        task = Task.objects.create(task='Починить сайт', created_at=created_at)
+        self.messages = [
+            Support.objects.create(
+                user=user if number % 2 else None,
+                task=task if number % 3 else None,
+                text=f'Обращение {number}',
+                created_at=created_at + timezone.timedelta(seconds=number),
+            )
+            for number in range(15)
+        ]
+
+    def test_inbox_is_one_query_and_survives_missing_task(self):
+        with self.assertNumQueries(1):
+            message, reply_markup = render_support_inbox()
+        self.assertIn('Иван Петров, без заказа', message)
+        self.assertIn('пользователь удален, заказ №', message)
+        buttons = pressed_buttons(reply_markup)
+        self.assertIn(CallbackData('support_done', support_id=self.messages[0].id), buttons)
+        self.assertTrue(any(data.action == 'support_page' and not data.backwards for data in buttons))
+
+    def test_handled_messages_leave_inbox(self):
+        Support.objects.exclude(pk=self.messages[-1].pk).update(status=Support.Status.HANDLED)
+        message, reply_markup = render_support_inbox()
+        self.assertIn(f'Обращение №{self.messages[-1].id} ', message)
+        self.assertEqual(message.count('Обращение №'), 1)
+
+
+@override_settings(TG_MESSAGES_PAGE_SIZE=4)
+class TaskHistoryTest(TestCase):
+    def setUp(self):
+        created_at = timezone.now()
+        self.client_user = User.objects.create(tg_id=100, name='Иван Петров', phonenumber='+79990000000')
+        self.worker = User.objects.create(
+            tg_id=200, name='Петр Иванов', phonenumber='+79990000001', role=User.UserRole.WORKER,
+        )
+        self.task = Task.objects.create(
+            task='Починить сайт', client=self.client_user, worker=self.worker, created_at=created_at,
+        )
+        self.messages = [
+            Message.objects.create(
+                first_person=self.client_user,
+                task_message=self.task,
+                text=f'Сообщение {number}',
+                created_at=created_at + timezone.timedelta(seconds=number),
+            )
+            for number in range(10)
+        ]
+
+    def history_page(self, reply_markup, backwards):
+        return next(
+            data for data in pressed_buttons(reply_markup)
+            if data.action == 'history' and data.task_id == self.task.id and data.backwards == backwards
+        )
+
+    def test_latest_messages_first_and_older_pages_on_demand(self):
+        with self.assertNumQueries(1):
+            message, reply_markup = render_task_history(self.task.id, User.UserRole.CLIENT)
+        self.assertIn('Сообщение 9', message)
+        self.assertIn('Сообщение 6', message)
+        self.assertNotIn('Сообщение 5', message)
+
+        cursor = self.history_page(reply_markup, backwards=True).cursor
+        with self.assertNumQueries(1):
+            message, reply_markup = render_task_history(self.task.id, User.UserRole.CLIENT, cursor)
+        self.assertIn('Сообщение 5', message)
+        self.assertIn('Сообщение 2', message)
+        self.assertNotIn('Сообщение 6', message)
+        self.assertIsNotNone(self.history_page(reply_markup, backwards=False).cursor)
+
+    def test_only_participants_and_managers_read_history(self):
+        stranger = User.objects.create(tg_id=300, name='Сергей Сидоров', phonenumber='+79990000002')
+        manager = User.objects.create(
+            tg_id=400, name='Анна Смирнова', phonenumber='+79990000003', role=User.UserRole.MANAGER,
+        )
+        self.assertTrue(can_read_task_messages(get_cached_user(100), self.task.id))
+        self.assertTrue(can_read_task_messages(get_cached_user(200), self.task.id))
+        self.assertTrue(can_read_task_messages(get_cached_user(manager.tg_id), self.task.id))
+        self.assertFalse(can_read_task_messages(get_cached_user(stranger.tg_id), self.task.id))
+
+    def test_admin_shows_messages_by_pages(self):
+        admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        url = reverse('admin:telegram_bot_task_messages', args=[self.task.id])
+        with mock.patch('telegram_bot.admin.TaskAdmin.messages_page_size', 4):
+            response = self.client.get(url)
+            self.assertContains(response, 'Сообщение 9')
+            self.assertNotContains(response, 'Сообщение 5')
+            older = re.search(r'href="\?cursor=([^&"]+)&amp;direction=p"', response.content.decode()).group(1)
+            response = self.client.get(url, {'cursor': unquote(older), 'direction': 'p'})
+        self.assertContains(response, 'Сообщение 5')
+        self.assertNotContains(response, 'Сообщение 6')
+
+    def test_admin_messages_require_view_permission(self):
+        url = reverse('admin:telegram_bot_task_messages', args=[self.task.id])
+        staff = get_user_model().objects.create_user('staff', 'staff@example.com', 'secret', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        staff.user_permissions.add(Permission.objects.get(codename='view_task'))
+        self.assertContains(self.client.get(url), 'Сообщение 9')
+
+    def test_admin_rejects_malformed_cursor(self):
+        admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        url = reverse('admin:telegram_bot_task_messages', args=[self.task.id])
+        for cursor in ('abc', '1:2:3', '99999999999999999999999:1', '1:x'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get(url, {'cursor': cursor}).status_code, 400)
+
+
+class TaskSearchTest(TestCase):
+    def setUp(self):
+        created_at = timezone.now()
+        self.worker = User.objects.create(
+            tg_id=200, name='Петр Иванов', phonenumber='+79990000001', role=User.UserRole.WORKER,
+        )
+        self.other_worker = User.objects.create(
+            tg_id=201, name='Сергей Сидоров', phonenumber='+79990000002', role=User.UserRole.WORKER,
+        )
+        self.manager = User.objects.create(
+            tg_id=400, name='Анна Смирнова', phonenumber='+79990000003', role=User.UserRole.MANAGER,
+        )
+        self.waiting = Task.objects.create(task='Сверстать лендинг для магазина', created_at=created_at)
+        self.relevant = Task.objects.create(
+            task='Лендинг: поправить лендинг и форму заявки на лендинге', created_at=created_at,
+        )
+        self.own = Task.objects.create(
+            task='Лендинг на Django', status=Task.Proc.IN_WORK, worker=self.worker, created_at=created_at,
+        )
+        self.foreign = Task.objects.create(
+            task='Перенести лендинг на хостинг', status=Task.Proc.IN_WORK, worker=self.other_worker,
+            created_at=created_at,
+        )
+        Task.objects.create(task='Починить телеграм-бота', created_at=created_at)
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        self.assertEqual(set(Task.objects.search('магазин')), {self.waiting})
+        Task.objects.filter(pk=self.waiting.pk).update(task='Починить сайт')
+        self.assertFalse(Task.objects.search('магазин').exists())
+        self.assertEqual(set(Task.objects.search('сайт')), {self.waiting})
+        self.waiting.delete()
+        self.assertFalse(Task.objects.search('сайт').exists())
+
+    def test_words_are_prefixes_and_input_is_not_fts_syntax(self):
+        self.assertEqual(set(Task.objects.search('ЛЕНД магаз')), {self.waiting})
+        self.assertFalse(Task.objects.search('лендинг AND "(*').exists())
+        self.assertFalse(Task.objects.search('"*').exists())
+
+    def test_ranked_results_by_role(self):
+        tasks, _, _ = search_tasks_page(get_cached_user(self.manager.tg_id), 'лендинг')
+        self.assertEqual(tasks[0], self.relevant)
+        self.assertEqual(set(tasks), {self.waiting, self.relevant, self.own, self.foreign})
+
+        tasks, _, _ = search_tasks_page(get_cached_user(self.worker.tg_id), 'лендинг')
+        self.assertEqual(set(tasks), {self.waiting, self.relevant, self.own})
+
+    @override_settings(TG_TASKS_PAGE_SIZE=2)
+    def test_pages(self):
+        manager = get_cached_user(self.manager.tg_id)
+        with self.assertNumQueries(2):
+            first, has_previous, has_next = search_tasks_page(manager, 'лендинг')
+        self.assertEqual((len(first), has_previous, has_next), (2, False, True))
+        second, has_previous, has_next = search_tasks_page(manager, 'лендинг', page=1)
+        self.assertEqual((len(second), has_previous, has_next), (2, True, False))
+        self.assertFalse(set(first) & set(second))
+
+        message, reply_markup = render_search_results(manager, 'лендинг')
+        buttons = pressed_buttons(reply_markup)
+        self.assertIn(CallbackData(TASK_ACTION, task_id=self.relevant.id), buttons)
+        self.assertIn(CallbackData('search', page=1), buttons)
+
+    def test_admin_search_uses_index(self):
+        admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:telegram_bot_task_changelist'), {'q': 'магазин'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.waiting])
+        if connection.vendor == 'sqlite':
+            self.assertIn('VIRTUAL TABLE INDEX', Task.objects.search('магазин').explain())
+
+    def test_search_command_is_not_taken_as_text(self):
+        def send(text, entities=()):
+            message = TelegramMessage(
+                1, timezone.now(), Chat(1, 'private'), text=text, entities=list(entities), bot=mock.Mock(username='bot'),
+            )
+            return Update(1, message=message)
+
+        command = send('/search лендинг', [MessageEntity(MessageEntity.BOT_COMMAND, 0, len('/search'))])
+        conversation = build_conversation_handler()
+        for state, handlers in conversation.states.items():
+            with self.subTest(state=state):
+                # Первый подходящий обработчик состояния получает обновление, иначе - fallbacks с /search
+                handler = next((handler for handler in handlers if handler.check_update(command)), None)
+                self.assertTrue(handler is None or isinstance(handler, CommandHandler), handler)
+        task_handlers = conversation.states[States.handle_task]
+        self.assertTrue(any(handler.check_update(send('Сверстать лендинг')) for handler in task_handlers))
+
+
+class AdminChangelistTest(TestCase):
+    def setUp(self):
+        admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        self.users = 0
+
+    def create_rows(self, count):
+        for _ in range(count):
+            self.users += 1
+            user = User.objects.create(tg_id=self.users, name=f'Клиент {self.users}', phonenumber='+79990000000')
+            task = Task.objects.create(task='Починить сайт ' * 100, client=user, worker=user, created_at=timezone.now())
+            Message.objects.create(task_message=task, first_person=user, text='Привет', created_at=timezone.now())
+            Support.objects.create(user=user, task=task, text='Помогите', created_at=timezone.now())
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        urls = [
+            reverse(f'admin:telegram_bot_{model}_changelist')
+            for model in ('task', 'message', 'support', 'user')
+        ]
+        self.create_rows(2)
+        before = [self.count_queries(url) for url in urls]
+        self.create_rows(10)
+        self.assertEqual([self.count_queries(url) for url in urls], before)
+
+    def test_count_is_capped(self):
+        self.create_rows(5)
+        with mock.patch.object(CappedCountPaginator, 'max_count', 3):
+            response = self.client.get(reverse('admin:telegram_bot_task_changelist'))
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_list_after_change_reads_primary(self):
+        task = Task.objects.create(task='Починить сайт', created_at=timezone.now())
+        url = reverse('admin:telegram_bot_task_changelist')
+        with mock.patch('telegram_bot.admin.read_from_replica', wraps=read_from_replica) as replica:
+            response = self.client.post(reverse('admin:telegram_bot_task_delete', args=[task.pk]), {'post': 'yes'})
+            self.assertRedirects(response, url, fetch_redirect_response=False)
+            # Список с сообщением об удалении должен показать удаление, даже если реплика отстает
+            self.assertContains(self.client.get(url), 'messagelist')
+            replica.assert_not_called()
+
+            self.client.get(url)
+            replica.assert_called_once()
+
+    def test_user_search_by_normalized_name_and_phone(self):
+        user = User.objects.create(tg_id=100, name='Фёдор  Петров', phonenumber='+79161234567')
+        User.objects.create(tg_id=101, name='Иван Федоров', phonenumber='+79031234567')
+        url = reverse('admin:telegram_bot_user_changelist')
+        for search_term in ('федор петр', 'ФЁДОР', '8 916 123', '+7 (916)'):
+            with self.subTest(search_term=search_term):
+                response = self.client.get(url, {'q': search_term})
+                self.assertEqual(list(response.context['cl'].result_list), [user])
+
+
+class AdminChangeFormTest(TestCase):
+    def setUp(self):
+        admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        self.user = User.objects.create(tg_id=100, name='Иван Петров', phonenumber='+79990000000')
+        self.task = Task.objects.create(task='Починить сайт', client=self.user, created_at=timezone.now())
+
+    def add_history(self, count):
+        for number in range(count):
+            Message.objects.create(
+                task_message=self.task, first_person=self.user, text=f'Сообщение {number}', created_at=timezone.now(),
+            )
+            Support.objects.create(user=self.user, task=self.task, text='Помогите', created_at=timezone.now())
+            Subscription.objects.create(
+                user=self.user, lvl=Subscription.SubscriptionLevel.ECONOMY, starts_at=timezone.now(),
+                end_at=timezone.now(),
+            )
+
+    def get_user_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:telegram_bot_user_change', args=[self.user.pk]))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_user_page_is_bounded_by_history_size(self):
+        self.add_history(3)
+        self.get_user_page()
+        _, before = self.get_user_page()
+        self.add_history(30)
+        response, after = self.get_user_page()
+        self.assertEqual(after, before)
+        self.assertContains(response, 'Сообщение 20')
+        self.assertNotContains(response, 'Сообщение 19')
+
+        for url in re.findall(r'href="([^"]+__id__exact=\d+)"', response.content.decode()):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_foreign_keys_use_autocomplete(self):
+        other = User.objects.create(tg_id=101, name='Петр Иванов', phonenumber='+79990000001')
+        for model, pk in (('task', self.task.pk), ('support', None), ('message', None)):
+            url = reverse(f'admin:telegram_bot_{model}_change', args=[pk]) if pk else reverse(
+                f'admin:telegram_bot_{model}_add',
+            )
+            with self.subTest(model=model):
+                response = self.client.get(url)
+                self.assertContains(response, 'admin-autocomplete')
+                self.assertNotContains(response, f'<option value="{other.pk}"')
+
+
+class WriteBufferTest(TestCase):
+    def setUp(self):
+        self.task = Task.objects.create(task='Починить сайт', created_at=timezone.now())
+        self.buffer = WriteBuffer(max_size=3, flush_interval=0)
+
+    def message(self, number):
+        return Message(task_message=self.task, text=f'Сообщение {number}', created_at=timezone.now())
+
+    def test_flushes_in_batches_and_on_stop(self):
+        self.buffer.add(self.message(0))
+        self.buffer.add(Support(task=self.task, text='Обращение', created_at=timezone.now()))
+        self.assertFalse(Message.objects.exists())
+
+        with self.assertNumQueries(4):
+            # bulk_create по каждой модели внутри savepoint транзакции теста
+            self.buffer.add(self.message(1))
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(Support.objects.count(), 1)
+        self.assertEqual(len(self.buffer), 0)
+
+        self.buffer.add(self.message(2))
+        self.buffer.stop()
+        self.assertEqual(
+            list(Message.objects.order_by('id').values_list('text', flat=True)),
+            ['Сообщение 0', 'Сообщение 1', 'Сообщение 2'],
+        )
+
+    def test_keeps_rows_when_write_fails(self):
+        self.buffer.add(self.message(0))
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        self.assertEqual(len(self.buffer), 1)
+        self.buffer.flush()
+        self.assertEqual(Message.objects.get().text, 'Сообщение 0')
+
+
+class SqliteTuningTest(SimpleTestCase):
+    databases = {'default'}
+
+    def pragma(self, cursor, name):
+        cursor.execute(f'PRAGMA {name}')
+        return cursor.fetchone()[0]
+
+    def test_connection_gets_pragmas(self):
+        with connection.cursor() as cursor:
+            self.assertEqual(self.pragma(cursor, 'busy_timeout'), settings.SQLITE_PRAGMAS['busy_timeout'])
+            self.assertEqual(self.pragma(cursor, 'cache_size'), settings.SQLITE_PRAGMAS['cache_size'])
+            # 1 - NORMAL, 2 - MEMORY
+            self.assertEqual(self.pragma(cursor, 'synchronous'), 1)
+            self.assertEqual(self.pragma(cursor, 'temp_store'), 2)
+
+    def test_rejects_unsafe_values(self):
+        with connection.cursor() as cursor:
+            with self.assertRaises(ValueError):
+                apply_pragmas(cursor, {'journal_mode': 'wal; DROP TABLE telegram_bot_task'})
+
+    def test_file_database_uses_wal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'write.sqlite3')
+            result = run_write_benchmark(path, settings.SQLITE_PRAGMAS, writers=3, readers=1, writes=50)
+            self.assertEqual((result.writes, result.errors), (50, 0))
+            with sqlite3.connect(path) as database:
+                self.assertEqual(database.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                self.assertEqual(database.execute('SELECT COUNT(*) FROM message').fetchone()[0], 50)
+            database.close()
+
+
+# Основная база мигрируется и копируется в реплику, после чего в основную пишется новая задача,
+# которой на реплике нет, как при отставании репликации
+REPLICA_SCRIPT = """
+import json, shutil
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.utils import timezone
+from telegram_bot.bot import render_task_list
+from telegram_bot.db_router import read_from_replica, set_current_chat
+from telegram_bot.models import Task
+
+call_command('migrate', verbosity=0)
+connection.cursor().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+shutil.copy(settings.DATABASES['default']['NAME'], settings.DATABASES['replica']['NAME'])
+
+def tasks():
+    return list(Task.objects.values_list('task', flat=True))
+
+set_current_chat(1)
+Task.objects.create(task='Новая задача', created_at=timezone.now())
+set_current_chat(None)
+with read_from_replica(2):
+    other_chat = tasks()
+with read_from_replica(1):
+    same_chat = tasks()
+with transaction.atomic(), read_from_replica(2):
+    in_transaction = tasks()
+print(json.dumps({
+    'other_chat': other_chat,
+    'same_chat': same_chat,
+    'in_transaction': in_transaction,
+    'outside': tasks(),
+    'unaccepted_for_other_chat': render_task_list('unaccepted', 2)[0],
+}))
+"""
+
+
+class ReplicaRouterTest(SimpleTestCase):
+    def test_reads_go_to_primary_without_replica(self):
+        router = ReplicaRouter()
+        with read_from_replica():
+            self.assertEqual(router.db_for_read(Task), 'default')
+        self.assertEqual(router.db_for_write(Task), 'default')
+
+    def test_chat_sticks_to_primary_after_write(self):
+        self.addCleanup(take_unpublished_writes)
+        record_write(-1)
+        self.assertTrue(wrote_recently(-1))
+        self.assertFalse(wrote_recently(-2))
+        with override_settings(DATABASE_REPLICA_STICKY_SECONDS=0):
+            self.assertFalse(wrote_recently(-1))
+
+    def test_bookkeeping_writes_do_not_stick(self):
+        self.addCleanup(take_unpublished_writes)
+        router = ReplicaRouter()
+        set_current_chat(-3)
+        try:
+            router.db_for_write(ConversationState)
+            router.db_for_write(TelegramFile)
+            self.assertFalse(wrote_recently(-3))
+            router.db_for_write(Task)
+            self.assertTrue(wrote_recently(-3))
+        finally:
+            set_current_chat(None)
+        self.assertIn(-3, take_unpublished_writes())
+
+    def test_two_sqlite_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            completed = subprocess.run(
+                [sys.executable, 'manage.py', 'shell', '-c', REPLICA_SCRIPT],
+                cwd=settings.BASE_DIR,
+                env={
+                    **os.environ,
+                    'DB_NAME': os.path.join(directory, 'primary.sqlite3'),
+                    'DB_REPLICA_NAME': os.path.join(directory, 'replica.sqlite3'),
+                },
+                capture_output=True,
+                text=True,
+                timeout=120,
+            )
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        result = json.loads(completed.stdout.splitlines()[-1])
+        self.assertEqual(result['other_chat'], [])
+        self.assertEqual(result['same_chat'], ['Новая задача'])
+        self.assertEqual(result['in_transaction'], ['Новая задача'])
+        self.assertEqual(result['outside'], ['Новая задача'])
+        self.assertEqual(result['unaccepted_for_other_chat'], 'Непринятых задач нет')
+
+
+class CallbackRouterTest(SimpleTestCase):
+    def press(self, data):
+        return Update(1, callback_query=CallbackQuery('1', TelegramUser(1, 'Иван', False), 'chat', data=data))
+
+    def test_binary_format_round_trip(self):
+        cases = [
+            CallbackData(TASK_ACTION, task_id=2 ** 32 - 1),
+            CallbackData('page', list_name='unaccepted', cursor='1760775000123456:4294967295', backwards=True),
+            CallbackData('history', task_id=7, cursor='1760775000123456:12'),
+            CallbackData('search', page=65535),
+            CallbackData('support_done', support_id=9),
+            CallbackData('pay', tier='DEFAULT'),
+            CallbackData(str(Transitions.message), task_id=123456),
+        ]
+        for callback_data in cases:
+            with self.subTest(callback_data=callback_data):
+                data = encode_callback_data(**callback_data._asdict())
+                self.assertLessEqual(len(data.encode()), 64)
+                self.assertEqual(parse_callback_data(data), callback_data)
+
+    def test_legacy_text_format(self):
+        self.assertEqual(parse_callback_data('123'), CallbackData(TASK_ACTION, task_id=123))
+        self.assertEqual(parse_callback_data('Transitions.client'), CallbackData('Transitions.client'))
+        self.assertEqual(parse_callback_data('vip'), CallbackData('tier', tier='VIP'))
+        self.assertEqual(parse_callback_data('200'), CallbackData('pay', tier='DEFAULT'))
+
+    def test_legacy_price_is_payment_or_task_by_state(self):
+        pay, show_task = mock.Mock(), mock.Mock()
+        update = self.press('100')
+        callback, data = CallbackRouter({'pay': pay}).check_update(update)
+        self.assertEqual((callback, data), (pay, CallbackData('pay', tier='ECO')))
+        callback, data = CallbackRouter({TASK_ACTION: show_task}).check_update(update)
+        self.assertEqual((callback, data), (show_task, CallbackData(TASK_ACTION, task_id=100)))
+
+    def test_routes_by_action_and_passes_params(self):
+        calls = []
+
+        def show_task(update, context):
+            calls.append(context.callback_data.task_id)
+            return States.manager
+
+        router = CallbackRouter({'Transitions.client': mock.Mock(), TASK_ACTION: show_task})
+        self.assertIsNone(router.check_update(self.press('Transitions.worker')))
+        self.assertIsNone(router.check_update(self.press('history:x')))
+
+        update = self.press('42')
+        context = mock.Mock()
+        self.assertEqual(router.handle_update(update, None, router.check_update(update), context), States.manager)
+        self.assertEqual(calls, [42])
+
+        default = mock.Mock(return_value=States.client)
+        router = CallbackRouter({}, default=default)
+        update = self.press('economy')
+        self.assertEqual(router.handle_update(update, None, router.check_update(update), context), States.client)
+        self.assertEqual(context.callback_data, CallbackData('tier', tier='ECO'))
+
+    def test_instrumentation_wraps_each_route(self):
+        def show_task(update, context):
+            return States.manager
+
+        router = CallbackRouter({TASK_ACTION: show_task, 'history': show_task})
+        conversation_handler = mock.Mock(entry_points=[], fallbacks=[], states={States.manager: [router]})
+        instrument_conversation_handler(conversation_handler, budget=60, query_budget=20)
+        self.assertIs(router.routes[TASK_ACTION], router.routes['history'])
+        self.assertIsNot(router.routes[TASK_ACTION], show_task)
+        self.assertEqual(router.routes[TASK_ACTION].__wrapped__, show_task)
+
+
+class HandlerInstrumentationTest(TestCase):
+    def setUp(self):
+        for metric in metrics.registry:
+            metric.clear()
+
+    def test_records_queries_per_handler_and_state(self):
+        def show_users(update, context):
+            list(User.objects.all())
+            list(Task.objects.all())
+            return States.manager
+
+        callback = instrument_callback(show_users, 'manager', budget=60, query_budget=20)
+        self.assertEqual(callback(None, None), States.manager)
+
+        labels = {'handler': 'show_users', 'state': 'manager'}
+        self.assertIn(('telegram_updates_total', labels, 1), list(metrics.updates.collect()))
+        self.assertIn(('telegram_db_queries_total', labels, 2), list(metrics.db_queries.collect()))
+        self.assertEqual(list(metrics.slow_updates.collect()), [])
+
+    def test_logs_handler_over_budget(self):
+        def chatty(update, context):
+            for _ in range(3):
+                User.objects.exists()
+
+        callback = instrument_callback(chatty, 'client', budget=60, query_budget=2)
+        with self.assertLogs('telegram_bot.instrumentation', 'WARNING') as logs:
+            callback(mock.Mock(update_id=7), None)
+        self.assertIn('handler=chatty state=client update_id=7', logs.output[0])
+        self.assertIn('queries=3', logs.output[0])
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        for metric in metrics.registry:
+            metric.clear()
+
+    def test_counts_from_all_threads_are_summed(self):
+        def observe():
+            for _ in range(100):
+                metrics.api_requests.inc('sendMessage')
+                metrics.api_duration.observe('sendMessage', value=0.02)
+
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        text = metrics.render_metrics()
+        self.assertIn('telegram_api_requests_total{method="sendMessage"} 400', text)
+        self.assertIn('telegram_api_duration_seconds_bucket{method="sendMessage",le="0.01"} 0', text)
+        self.assertIn('telegram_api_duration_seconds_bucket{method="sendMessage",le="0.025"} 400', text)
+        self.assertIn('telegram_api_duration_seconds_count{method="sendMessage"} 400', text)
+
+    @override_settings(TG_METRICS_TOKEN=None)
+    def test_endpoint_reports_active_conversations(self):
+        ConversationState.objects.create(tg_id=1, state='client')
+        ConversationState.objects.create(tg_id=2, state='client')
+        ConversationState.objects.create(tg_id=3, state='')
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('telegram_active_conversations{state="client"} 2', response.content.decode())
+
+    @override_settings(TG_METRICS_TOKEN='token')
+    def test_endpoint_requires_token_when_configured(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer token')
+        self.assertEqual(response.status_code, 200)
+
+
+class OutboxTest(SimpleTestCase):
+    def setUp(self):
+        self.bot = mock.Mock()
+        self.outbox = Outbox(self.bot, workers=2, global_rate=1000, chat_rate=1000, chat_burst=1000)
+
+    def sent_texts(self, chat_id):
+        return [
+            call.kwargs['text'] for call in self.bot.send_message.call_args_list
+            if call.kwargs['chat_id'] == chat_id
+        ]
+
+    def test_coalesces_plain_messages_to_same_chat(self):
+        self.outbox.send_message(1, 'Вы прошли регистрацию')
+        self.outbox.send_message(1, 'Выберите роль', reply_markup='keyboard')
+        self.outbox.send_message(1, 'После клавиатуры')
+        self.outbox.start()
+        self.outbox.stop()
+
+        self.assertEqual(self.sent_texts(1), ['Вы прошли регистрацию\n\nВыберите роль', 'После клавиатуры'])
+        self.assertEqual(self.bot.send_message.call_args_list[0].kwargs['reply_markup'], 'keyboard')
+        self.assertEqual(self.outbox.stats()['coalesced'], 1)
+
+    def test_retries_after_flood_control_in_order(self):
+        self.bot.send_message.side_effect = [RetryAfter(0.01), None, None]
+        self.outbox.send_message(1, 'первое', reply_markup='keyboard')
+        self.outbox.send_message(1, 'второе', reply_markup='keyboard')
+        self.outbox.start()
+        self.outbox.stop()
+
+        self.assertEqual(self.sent_texts(1), ['первое', 'первое', 'второе'])
+        stats = self.outbox.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['depth']), (2, 1, 0))
+
+    def test_limits_messages_per_chat(self):
+        outbox = Outbox(self.bot, global_rate=1000, chat_rate=20, chat_burst=1)
+        for number in range(3):
+            outbox.send_message(1, str(number), reply_markup='keyboard')
+        started_at = time.monotonic()
+        outbox.start()
+        outbox.stop()
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.09)
+
+
+class TaskBroadcasterTest(TestCase):
+    def setUp(self):
+        self.outbox = mock.Mock()
+        self.outbox.enqueue.side_effect = lambda chat_id, method, on_sent, on_error, **kwargs: on_sent(None)
+        self.workers = [
+            User.objects.create(tg_id=1000 + number, name=f'Исполнитель {number}', role=User.UserRole.WORKER)
+            for number in range(5)
+        ]
+        User.objects.create(tg_id=2000, name='Клиент', role=User.UserRole.CLIENT)
+        self.task = create_task_with_broadcast(task='Починить сайт', created_at=timezone.now())
+
+    def notified(self):
+        return [call.args[0] for call in self.outbox.enqueue.call_args_list]
+
+    def test_notifies_only_workers_in_chunks(self):
+        broadcaster = TaskBroadcaster(self.outbox, chunk_size=2, rate=10000)
+        broadcaster.run_broadcast(self.task.broadcast.id)
+
+        self.assertEqual(self.notified(), [worker.tg_id for worker in self.workers])
+        broadcast = TaskBroadcast.objects.get()
+        self.assertIsNotNone(broadcast.finished_at)
+        self.assertEqual(broadcast.last_user_id, self.workers[-1].id)
+
+    def test_resumes_from_checkpoint(self):
+        TaskBroadcast.objects.update(last_user_id=self.workers[2].id)
+        TaskBroadcaster(self.outbox, chunk_size=2, rate=10000).run_broadcast(self.task.broadcast.id)
+        self.assertEqual(self.notified(), [worker.tg_id for worker in self.workers[3:]])
+
+    def test_skips_broadcast_claimed_by_another_process(self):
+        TaskBroadcast.objects.update(locked_until=timezone.now() + timezone.timedelta(minutes=5))
+        TaskBroadcaster(self.outbox).run_broadcast(self.task.broadcast.id)
+        self.assertEqual(self.notified(), [])
+
+    def test_resumes_after_crash_once_lease_expires(self):
+        # Процесс упал посреди рассылки, не сняв аренду, и сразу перезапустился
+        crashed_at = timezone.now()
+        TaskBroadcast.objects.update(
+            last_user_id=self.workers[2].id,
+            locked_until=crashed_at + timezone.timedelta(minutes=5),
+        )
+        broadcaster = TaskBroadcaster(self.outbox, chunk_size=2, rate=10000)
+        broadcaster.rescan()
+        self.assertTrue(broadcaster._broadcasts.empty())
+
+        with mock.patch('django.utils.timezone.now', return_value=crashed_at + timezone.timedelta(minutes=6)):
+            broadcaster.rescan()
+            broadcaster.run_broadcast(broadcaster._broadcasts.get_nowait())
+        self.assertEqual(self.notified(), [worker.tg_id for worker in self.workers[3:]])
+        self.assertIsNotNone(TaskBroadcast.objects.get().finished_at)
+
+    def test_idle_loop_rescans_for_abandoned_broadcasts(self):
+        broadcaster = TaskBroadcaster(self.outbox, chunk_size=2, rate=10000, rescan_interval=0.01)
+        with mock.patch.object(broadcaster, 'rescan', side_effect=broadcaster.stop) as rescan:
+            broadcaster._run()
+        rescan.assert_called_once_with()
+
+
+class BenchmarkCommandTest(SimpleTestCase):
+    def test_scenarios_run_through_fake_bot_api(self):
+        # Отдельный процесс: бот пишет в базу из нескольких потоков, а тестовая база SQLite в памяти
+        # такого не выдерживает. Команда сама создает и удаляет временную базу.
+        completed = subprocess.run(
+            [
+                sys.executable, 'manage.py', 'benchmark-bot',
+                '--scenarios', '3', '--concurrency', '2', '--workers', '2', '--timeout', '10',
+            ],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        self.assertIn('Сценариев: 3', completed.stdout)
+        self.assertIn('p99=', completed.stdout)
+        self.assertIn('sendDocument=3', completed.stdout)
@@ -1,3 +1,43 @@
-from django.shortcuts import render
+import json
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from telegram import Update
+
+from telegram_bot.bot import get_webhook_dispatcher
+from telegram_bot.metrics import CONTENT_TYPE, render_metrics
+
+
+@csrf_exempt
+@require_POST
+def telegram_webhook(request):
+    """Принимает обновления от Telegram и передает их в ConversationHandler бота"""
+    secret = settings.TG_WEBHOOK_SECRET
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secret or not constant_time_compare(token, secret):
+        return HttpResponseForbidden()
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    dispatcher = get_webhook_dispatcher()
+    update = Update.de_json(payload, dispatcher.bot)
+    try:
+        dispatcher.process_update(update)
+    finally:
+        # Следующее обновление этого чата может прийти в другой процесс
+        dispatcher.persistence.flush()
+    return HttpResponse()
+
+
+@require_GET
+def metrics(request):
+    """Метрики бота в текстовом формате Prometheus"""
+    token = settings.TG_METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
@@ -0,0 +1,84 @@
+import logging
+import threading
+from collections import defaultdict
+
+from django.db import close_old_connections, models, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    """Отложенная запись новых строк в базу пачками.
+
+    Строки копятся в памяти и записываются через bulk_create одной транзакцией,
+    как только их набирается max_size или раз в flush_interval секунд, а также при остановке бота.
+    Если запись не удалась, строки возвращаются в буфер и записываются при следующей попытке.
+    """
+
+    def __init__(self, max_size: int = 100, flush_interval: float = 1.0):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flusher = None
+
+    def add(self, row: models.Model):
+        with self._lock:
+            self._rows.append(row)
+            full = len(self._rows) >= self.max_size
+        if full:
+            self.flush()
+        else:
+            self._start_flusher()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows)
+
+    def flush(self):
+        # Отдельная блокировка не дает двум потокам записывать пачки одновременно
+        # и сохраняет порядок строк в таблице
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return
+
+            rows_by_model = defaultdict(list)
+            for row in rows:
+                rows_by_model[type(row)].append(row)
+            try:
+                with transaction.atomic():
+                    for model, model_rows in rows_by_model.items():
+                        model.objects.bulk_create(model_rows)
+            except Exception:
+                with self._lock:
+                    self._rows = rows + self._rows
+                raise
+
+    def stop(self):
+        self._stop_event.set()
+        self.flush()
+
+    def _start_flusher(self):
+        if not self.flush_interval or self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_periodically,
+                name='write-buffer-flusher',
+                daemon=True,
+            )
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self.flush_interval):
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Не удалось записать сообщения в базу')